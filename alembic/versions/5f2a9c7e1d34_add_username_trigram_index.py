@@ -0,0 +1,27 @@
+"""Add trigram index on usernames
+
+Revision ID: 5f2a9c7e1d34
+Revises: c3d8f1a4e6b2
+Create Date: 2026-10-18 12:07:31.645280
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '5f2a9c7e1d34'
+down_revision: Union[str, None] = 'c3d8f1a4e6b2'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+    op.execute("CREATE INDEX IF NOT EXISTS ix_users_username_trgm ON users USING gin (username gin_trgm_ops)")
+
+
+def downgrade() -> None:
+    op.execute("DROP INDEX IF EXISTS ix_users_username_trgm")
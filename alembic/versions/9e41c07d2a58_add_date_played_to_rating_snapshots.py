@@ -0,0 +1,35 @@
+"""Add date_played to rating snapshots
+
+Revision ID: 9e41c07d2a58
+Revises: 4bb3a6254b64
+Create Date: 2026-10-18 10:02:17.226904
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '9e41c07d2a58'
+down_revision: Union[str, None] = '4bb3a6254b64'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column('rating_snapshots', sa.Column('date_played', sa.Date(), nullable=True))
+    op.execute("""
+        UPDATE rating_snapshots
+        SET date_played = matches.date_played
+        FROM matches
+        WHERE matches.id = rating_snapshots.match_id
+    """)
+    op.alter_column('rating_snapshots', 'date_played', nullable=False)
+    op.create_index('ix_rating_snapshots_user_id_date_played', 'rating_snapshots', ['user_id', 'date_played'], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index('ix_rating_snapshots_user_id_date_played', table_name='rating_snapshots')
+    op.drop_column('rating_snapshots', 'date_played')
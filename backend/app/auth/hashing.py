@@ -0,0 +1,142 @@
+import asyncio
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Optional
+from fastapi import HTTPException
+from passlib.context import CryptContext
+from starlette import status
+from dotenv import load_dotenv
+from app.monitoring.metrics import bcrypt_duration
+
+load_dotenv()
+
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "12"))
+# Bcrypt runs in this many worker processes, 0 runs it in a single thread of the API process instead
+HASH_WORKERS = int(os.getenv("HASH_WORKERS", str(os.cpu_count() or 1)))
+# Hashes allowed to wait for a free worker, anything beyond that is turned away with a 503
+HASH_QUEUE_SIZE = int(os.getenv("HASH_QUEUE_SIZE", str(max(HASH_WORKERS, 1) * 8)))
+# Store a fresh hash on login when the stored one was made with other bcrypt parameters
+PASSWORD_REHASH = os.getenv("PASSWORD_REHASH", "false").lower() in ("1", "true", "yes")
+
+bcrypt_context = CryptContext(schemes=["bcrypt"], deprecated="auto", bcrypt__rounds=BCRYPT_ROUNDS)
+
+
+def _timed_hash(password: str) -> tuple[str, float]:
+    started = time.perf_counter()
+    hashed_password = bcrypt_context.hash(password)
+    return hashed_password, time.perf_counter() - started
+
+def _timed_verify(password: str, hashed_password: str) -> tuple[tuple[bool, Optional[str]], float]:
+    started = time.perf_counter()
+    result = bcrypt_context.verify_and_update(password, hashed_password)
+    return result, time.perf_counter() - started
+
+
+class PasswordHasher:
+    # Bounded pool for bcrypt, so a burst of logins neither blocks the event loop nor queues up without limit
+
+    def __init__(self, workers: int, queue_size: int):
+        self.workers = workers
+        self.size = max(workers, 1)
+        self.queue_size = queue_size
+        self._lock = threading.Lock()
+        self._executor: Optional[Executor] = None
+        self.pending = 0
+        self.rejected = 0
+        self.count = 0
+        self.hash_seconds = 0.0
+        self.max_hash_seconds = 0.0
+        self.wait_seconds = 0.0
+
+    def start(self) -> Executor:
+        with self._lock:
+            if self._executor is None:
+                if self.workers > 0:
+                    # Started lazily, when the writer, sync and event loop threads already exist. Forking a copy of
+                    # them (and of any lock they hold) isn't safe, the workers come from a clean process instead.
+                    method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+                    self._executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context(method))
+                else:
+                    self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="bcrypt")
+            return self._executor
+
+    def shutdown(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def _acquire(self):
+        with self._lock:
+            if self.pending >= self.size + self.queue_size:
+                self.rejected += 1
+                raise HTTPException(
+                    status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                    detail="Too many password checks in progress, try again shortly",
+                    headers={"Retry-After": "1"},
+                )
+            self.pending += 1
+
+    def _release(self, started: float, hash_seconds: Optional[float], func):
+        if hash_seconds is not None:
+            bcrypt_duration.observe(hash_seconds, func.__name__.removeprefix("_timed_"))
+        with self._lock:
+            self.pending -= 1
+            if hash_seconds is not None:
+                self.count += 1
+                self.hash_seconds += hash_seconds
+                self.max_hash_seconds = max(self.max_hash_seconds, hash_seconds)
+                self.wait_seconds += max(time.perf_counter() - started - hash_seconds, 0)
+
+    async def run(self, func, *args):
+        self._acquire()
+        started = time.perf_counter()
+        hash_seconds = None
+        try:
+            result, hash_seconds = await asyncio.wrap_future(self.start().submit(func, *args))
+            return result
+        finally:
+            self._release(started, hash_seconds, func)
+
+    def run_blocking(self, func, *args):
+        # For callers already off the event loop, e.g. crud functions running in the threadpool
+        self._acquire()
+        started = time.perf_counter()
+        hash_seconds = None
+        try:
+            result, hash_seconds = self.start().submit(func, *args).result()
+            return result
+        finally:
+            self._release(started, hash_seconds, func)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "workers": self.size,
+                "queue_size": self.queue_size,
+                "in_flight": min(self.pending, self.size),
+                "queue_depth": max(self.pending - self.size, 0),
+                "rejected": self.rejected,
+                "count": self.count,
+                "hash_seconds": self.hash_seconds,
+                "max_hash_seconds": self.max_hash_seconds,
+                "wait_seconds": self.wait_seconds,
+            }
+
+
+password_hasher = PasswordHasher(HASH_WORKERS, HASH_QUEUE_SIZE)
+
+
+async def hash_password(password: str) -> str:
+    return await password_hasher.run(_timed_hash, password)
+
+async def verify_password(password: str, hashed_password: str) -> tuple[bool, Optional[str]]:
+    # Returns whether the password matches and, with PASSWORD_REHASH on, the upgraded hash to store
+    valid, new_hash = await password_hasher.run(_timed_verify, password, hashed_password)
+    return valid, new_hash if valid and PASSWORD_REHASH else None
+
+def hash_password_blocking(password: str) -> str:
+    return password_hasher.run_blocking(_timed_hash, password)
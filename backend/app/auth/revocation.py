@@ -0,0 +1,110 @@
+import asyncio
+import hashlib
+import heapq
+import logging
+import os
+import threading
+import time
+from sqlalchemy import delete, select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+from starlette.concurrency import run_in_threadpool
+from dotenv import load_dotenv
+from app.database.database import SessionLocal
+from app.models.models import RevokedToken
+
+load_dotenv()
+
+# How often each worker pulls revocations made by the other workers
+REVOCATION_SYNC_SECONDS = float(os.getenv("REVOCATION_SYNC_SECONDS", "1"))
+# How often the whole table is re-read and expired rows are deleted
+REVOCATION_FULL_SYNC_SECONDS = float(os.getenv("REVOCATION_FULL_SYNC_SECONDS", "60"))
+
+logger = logging.getLogger(__name__)
+
+
+def token_key(token: str, payload: dict) -> str:
+    # Tokens carry a jti, older ones without it are keyed by their hash
+    return payload.get("jti") or hashlib.sha256(token.encode()).hexdigest()
+
+
+class RevocationStore:
+    # Revoked token ids with their expiry. The revoked_tokens table is shared by all workers,
+    # every worker keeps a copy in a dict for lookups and a heap to drop entries once they expire.
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._expiry: dict[str, int] = {}
+        self._heap: list[tuple[int, str]] = []
+        self._last_id = 0
+        self._last_full_sync = 0.0
+
+    def _add(self, token_id: str, expires_at: int):
+        if token_id not in self._expiry:
+            self._expiry[token_id] = expires_at
+            heapq.heappush(self._heap, (expires_at, token_id))
+
+    def _prune(self, now: float):
+        while self._heap and self._heap[0][0] <= now:
+            _, token_id = heapq.heappop(self._heap)
+            self._expiry.pop(token_id, None)
+
+    def __len__(self) -> int:
+        return len(self._expiry)
+
+    def is_revoked(self, token_id: str) -> bool:
+        expires_at = self._expiry.get(token_id)
+        return expires_at is not None and expires_at > time.time()
+
+    def revoke(self, db: Session, token_id: str, expires_at: int):
+        if not db.query(RevokedToken.id).filter(RevokedToken.token_id == token_id).first():
+            db.add(RevokedToken(token_id=token_id, expires_at=expires_at))
+            try:
+                db.commit()
+            except IntegrityError:
+                # Revoked by another request in the meantime
+                db.rollback()
+        with self._lock:
+            self._add(token_id, expires_at)
+            self._prune(time.time())
+
+    def sync(self, db: Session, full: bool = False):
+        now = time.time()
+        query = select(RevokedToken.id, RevokedToken.token_id, RevokedToken.expires_at).where(RevokedToken.expires_at > now)
+        if not full:
+            # Ids are only mostly increasing under concurrent commits, the periodic full sync picks up stragglers
+            query = query.where(RevokedToken.id > self._last_id)
+        rows = db.execute(query).all()
+
+        with self._lock:
+            if full:
+                self._expiry = {}
+                self._heap = []
+            for row_id, token_id, expires_at in rows:
+                self._add(token_id, expires_at)
+                self._last_id = max(self._last_id, row_id)
+            self._prune(now)
+
+        if full:
+            db.execute(delete(RevokedToken).where(RevokedToken.expires_at <= now))
+            db.commit()
+            self._last_full_sync = now
+
+    def _sync_now(self):
+        db = SessionLocal()
+        try:
+            self.sync(db, full=time.time() - self._last_full_sync >= REVOCATION_FULL_SYNC_SECONDS)
+        finally:
+            db.close()
+
+    async def run_sweeper(self):
+        # Background task started with the app, keeps this worker in step with the table
+        while True:
+            try:
+                await run_in_threadpool(self._sync_now)
+            except Exception:
+                logger.exception("Syncing revoked tokens failed")
+            await asyncio.sleep(REVOCATION_SYNC_SECONDS)
+
+
+revocation_store = RevocationStore()
@@ -0,0 +1,55 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+from dotenv import load_dotenv
+
+load_dotenv()
+
+TOKEN_CACHE_SIZE = int(os.getenv("TOKEN_CACHE_SIZE", "10000"))
+
+
+class TokenCache:
+    # Claims of tokens whose signature was already verified, so repeated requests skip jwt.decode.
+    # Entries are never served past their exp, revocation is still checked by the caller on every request.
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._entries: OrderedDict[str, dict] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, token: str) -> Optional[dict]:
+        with self._lock:
+            payload = self._entries.get(token)
+            if payload is not None:
+                expires_at = payload.get("exp")
+                if expires_at is None or expires_at > time.time():
+                    self._entries.move_to_end(token)
+                    self.hits += 1
+                    return payload
+                del self._entries[token]
+            self.misses += 1
+            return None
+
+    def put(self, token: str, payload: dict):
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._entries[token] = payload
+            self._entries.move_to_end(token)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, token: str):
+        with self._lock:
+            self._entries.pop(token, None)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"size": len(self._entries), "max_size": self.max_size, "hits": self.hits, "misses": self.misses}
+
+
+token_cache = TokenCache(TOKEN_CACHE_SIZE)
@@ -1,14 +1,18 @@
 from datetime import timedelta, datetime, timezone
 import imghdr
 import os
+from uuid import uuid4
 from fastapi import Depends, HTTPException
 from pydantic import BaseModel
 from starlette import status
 from sqlalchemy.orm import Session
-from passlib.context import CryptContext
 from fastapi.security import OAuth2PasswordBearer
 from jose import jwt, JWTError
 from dotenv import load_dotenv
+from app.auth.hashing import bcrypt_context, hash_password_blocking, verify_password
+from app.auth.revocation import revocation_store, token_key
+from app.auth.token_cache import token_cache
+from app.database.database import run_crud
 from app.models.models import User
 
 
@@ -18,7 +22,6 @@ SECRET_KEY = os.getenv("SECRET_KEY")
 ALGORITHM = 'HS256'
 ACCESS_TOKEN_EXPIRE_MINUTES = 20
 
-bcrypt_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 oauth2_bearer = OAuth2PasswordBearer(tokenUrl="auth/token")
 
 class Token(BaseModel):
@@ -29,29 +32,51 @@ class LoginRequest(BaseModel):
     username: str
     password: str
 
-def authenticate_user(username: str, password: str, db: Session):
-    user = db.query(User).filter(User.username == username).first()
-    if not user or not bcrypt_context.verify(password, user.hashed_password):
+def _get_user_by_username(db: Session, username: str):
+    return db.query(User).filter(User.username == username).first()
+
+def _store_password_hash(db: Session, user: User, hashed_password: str):
+    user.hashed_password = hashed_password
+    db.commit()
+    db.refresh(user)
+
+async def authenticate_user(username: str, password: str, db):
+    # Only the lookups touch the session, bcrypt itself runs in the hashing pool
+    user = await run_crud(db, _get_user_by_username, username)
+    if not user:
+        return False
+    valid, new_hash = await verify_password(password, user.hashed_password)
+    if not valid:
         return False
+    if new_hash:
+        await run_crud(db, _store_password_hash, user, new_hash)
     return user
 
-blacklist: set[str] = set()
-
-def revoke_token(token: str):
-    blacklist.add(token)
+def revoke_token(token: str, db: Session):
+    try:
+        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+    except JWTError:
+        # Invalid and expired tokens are rejected anyway, there is nothing to revoke
+        return
+    revocation_store.revoke(db, token_key(token, payload), payload["exp"])
+    token_cache.invalidate(token)
 
-def is_token_blacklisted(token: str) -> bool:
-    return token in blacklist
+def is_token_revoked(token: str, payload: dict) -> bool:
+    return revocation_store.is_revoked(token_key(token, payload))
 
 def verify_token(token: str) -> dict:
-    if is_token_blacklisted(token):
+    # Clients resend the same token for its whole lifetime, the signature is only checked the first time
+    payload = token_cache.get(token)
+    if payload is None:
+        try:
+            payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        except JWTError:
+            raise HTTPException(status_code=401, detail="Invalid token")
+        token_cache.put(token, payload)
+
+    if is_token_revoked(token, payload):
         raise HTTPException(status_code=401, detail="Token has been revoked")
-
-    try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        return payload
-    except JWTError:
-        raise HTTPException(status_code=401, detail="Invalid token")
+    return payload
 
 def create_access_token(data: dict, expires_delta: timedelta = None):
     to_encode = data.copy()
@@ -59,7 +84,7 @@ def create_access_token(data: dict, expires_delta: timedelta = None):
         expire = datetime.now(timezone.utc) + expires_delta
     else:
         expire = datetime.now(timezone.utc) + timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
-    to_encode.update({"exp": expire})
+    to_encode.update({"exp": expire, "jti": uuid4().hex})
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
 
     return encoded_jwt
@@ -80,7 +105,7 @@ def get_current_user(token: str = Depends(oauth2_bearer)) -> dict:
     return {"username": username, "id": user_id}
 
 def get_password_hash(password: str) -> str:
-    return bcrypt_context.hash(password)
+    return hash_password_blocking(password)
 
 def save_picture(file_data: bytes, user_id: int) -> str:
     file_extension = imghdr.what(None, file_data)
@@ -0,0 +1,50 @@
+import os
+from datetime import timedelta, timezone
+from email.utils import format_datetime, parsedate_to_datetime
+from typing import Optional
+from fastapi import Request, Response
+from starlette import status
+from dotenv import load_dotenv
+from app.cache.version import data_version
+
+load_dotenv()
+
+# Seconds clients may reuse a response without asking, 0 makes them revalidate every time
+HTTP_CACHE_MAX_AGE = int(os.getenv("HTTP_CACHE_MAX_AGE", "0"))
+CACHE_CONTROL = f"max-age={HTTP_CACHE_MAX_AGE}, must-revalidate" if HTTP_CACHE_MAX_AGE else "no-cache"
+
+
+def _etag_matches(if_none_match: str, etag: str) -> bool:
+    tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+    return "*" in tags or etag in tags
+
+def _not_modified_since(if_modified_since: str, last_modified) -> bool:
+    try:
+        since = parsedate_to_datetime(if_modified_since)
+    except (TypeError, ValueError):
+        return False
+    # Last-Modified only has second precision and a second write within the same second shares it, so only a date
+    # past that whole second proves the copy is current. A client echoing Last-Modified back revalidates by ETag.
+    return since.tzinfo is not None and last_modified + timedelta(seconds=1) <= since
+
+def not_modified(request: Request, response: Response) -> Optional[Response]:
+    # Validators come from the data version alone, so a client with a current copy gets its 304
+    # before the endpoint reads anything. Otherwise the headers are added to the endpoint's response.
+    if not data_version.loaded:
+        return None
+
+    etag = f'"v{data_version.version}"'
+    last_modified = data_version.updated_at.replace(tzinfo=timezone.utc)
+    headers = {"ETag": etag, "Last-Modified": format_datetime(last_modified, usegmt=True), "Cache-Control": CACHE_CONTROL}
+
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        current = _etag_matches(if_none_match, etag)
+    else:
+        if_modified_since = request.headers.get("if-modified-since")
+        current = if_modified_since is not None and _not_modified_since(if_modified_since, last_modified)
+    if current:
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+    response.headers.update(headers)
+    return None
@@ -0,0 +1,236 @@
+import os
+import threading
+from collections import OrderedDict
+from typing import Callable, Iterable, Optional
+from fastapi import Request, Response
+from pydantic import TypeAdapter
+from dotenv import load_dotenv
+from app.cache.version import data_version
+
+# The shared backend for multi-worker deployments is optional, it needs redis installed
+try:
+    import redis
+except ImportError:
+    redis = None
+
+load_dotenv()
+
+# memory (per process), redis (shared by all workers, set RESPONSE_CACHE_URL) or none
+RESPONSE_CACHE_BACKEND = os.getenv("RESPONSE_CACHE_BACKEND", "memory").lower()
+RESPONSE_CACHE_URL = os.getenv("RESPONSE_CACHE_URL", "redis://localhost:6379/0")
+RESPONSE_CACHE_MAX_BYTES = int(os.getenv("RESPONSE_CACHE_MAX_BYTES", str(32 * 1024 * 1024)))
+# Redis entries also expire after this many seconds, memory entries only leave through eviction or invalidation
+RESPONSE_CACHE_TTL = int(os.getenv("RESPONSE_CACHE_TTL", "300"))
+
+RANKING_TAG = "ranking"
+RECENT_TAG = "recent"
+
+
+def user_tag(user_id: int) -> str:
+    return f"user:{user_id}"
+
+
+class MemoryBackend:
+    # LRU bounded by the total size of the cached bodies, with an index from tag to keys for invalidation
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries: OrderedDict[str, tuple[bytes, frozenset]] = OrderedDict()
+        self._tags: dict[str, set[str]] = {}
+        self._generation = 0
+        self.size = 0
+        self.evictions = 0
+
+    def _remove(self, key: str):
+        body, tags = self._entries.pop(key)
+        self.size -= len(body)
+        for tag in tags:
+            keys = self._tags.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._tags[tag]
+
+    def get(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def set(self, key: str, body: bytes, tags: Iterable[str], generation: int):
+        if len(body) > self.max_bytes:
+            return
+        with self._lock:
+            # Something was invalidated while the body was built, it may already be stale
+            if generation != self._generation:
+                return
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (body, frozenset(tags))
+            self.size += len(body)
+            for tag in tags:
+                self._tags.setdefault(tag, set()).add(key)
+            while self.size > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def generation(self) -> int:
+        return self._generation
+
+    def invalidate(self, tags: Iterable[str]):
+        with self._lock:
+            self._generation += 1
+            for tag in tags:
+                for key in list(self._tags.get(tag, ())):
+                    self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+            self._tags.clear()
+            self.size = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+class RedisBackend:
+    # Same contract as MemoryBackend on top of Redis, so every worker sees the invalidations.
+    # The size bound is the server's maxmemory policy together with the TTL.
+
+    PREFIX = "response_cache:"
+
+    def __init__(self, url: str, ttl: int):
+        self._redis = redis.Redis.from_url(url)
+        self.ttl = ttl
+        self.evictions = 0
+
+    def get(self, key: str) -> Optional[bytes]:
+        return self._redis.get(self.PREFIX + key)
+
+    def set(self, key: str, body: bytes, tags: Iterable[str], generation: int):
+        if generation != self.generation():
+            return
+        pipe = self._redis.pipeline()
+        pipe.set(self.PREFIX + key, body, ex=self.ttl)
+        for tag in tags:
+            pipe.sadd(self.PREFIX + "tag:" + tag, key)
+            pipe.expire(self.PREFIX + "tag:" + tag, self.ttl)
+        pipe.execute()
+
+    def generation(self) -> int:
+        return int(self._redis.get(self.PREFIX + "generation") or 0)
+
+    def invalidate(self, tags: Iterable[str]):
+        tag_keys = [self.PREFIX + "tag:" + tag for tag in tags]
+        keys = set()
+        for tag_key in tag_keys:
+            keys.update(key.decode() for key in self._redis.smembers(tag_key))
+        pipe = self._redis.pipeline()
+        pipe.incr(self.PREFIX + "generation")
+        if keys:
+            pipe.delete(*(self.PREFIX + key for key in keys))
+        if tag_keys:
+            pipe.delete(*tag_keys)
+        pipe.execute()
+
+    def clear(self):
+        self._redis.incr(self.PREFIX + "generation")
+        keys = [key for key in self._redis.scan_iter(self.PREFIX + "*") if not key.endswith(b"generation")]
+        if keys:
+            self._redis.delete(*keys)
+
+    def __len__(self) -> int:
+        return 0
+
+
+class ResponseCache:
+    # Rendered JSON bodies of hot GET endpoints, dropped by tag when the data behind them changes
+
+    def __init__(self, backend):
+        self.backend = backend
+        self._lock = threading.Lock()
+        self.hits: dict[str, int] = {}
+        self.misses: dict[str, int] = {}
+        self.invalidations = 0
+
+    def _count(self, counters: dict, name: str):
+        with self._lock:
+            counters[name] = counters.get(name, 0) + 1
+
+    def get_or_render(self, name: str, key: str, tags: Iterable[str], build: Callable[[], bytes]) -> bytes:
+        if self.backend is None:
+            return build()
+        body = self.backend.get(key)
+        if body is not None:
+            self._count(self.hits, name)
+            return body
+        self._count(self.misses, name)
+        generation = self.backend.generation()
+        body = build()
+        self.backend.set(key, body, tags, generation)
+        return body
+
+    def invalidate(self, tags: Iterable[str]):
+        if self.backend is not None:
+            self.backend.invalidate(list(tags))
+            with self._lock:
+                self.invalidations += 1
+
+    def clear(self):
+        if self.backend is not None:
+            self.backend.clear()
+            with self._lock:
+                self.invalidations += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            hits, misses = sum(self.hits.values()), sum(self.misses.values())
+            return {
+                "backend": RESPONSE_CACHE_BACKEND,
+                "entries": len(self.backend) if self.backend is not None else 0,
+                "bytes": getattr(self.backend, "size", 0),
+                "evictions": getattr(self.backend, "evictions", 0),
+                "invalidations": self.invalidations,
+                "hits": dict(self.hits),
+                "misses": dict(self.misses),
+                "hit_ratio": hits / (hits + misses) if hits + misses else 0.0,
+            }
+
+
+def _create_backend():
+    if RESPONSE_CACHE_BACKEND == "none":
+        return None
+    if RESPONSE_CACHE_BACKEND == "redis":
+        if redis is None:
+            raise RuntimeError("RESPONSE_CACHE_BACKEND=redis needs the redis package installed")
+        return RedisBackend(RESPONSE_CACHE_URL, RESPONSE_CACHE_TTL)
+    return MemoryBackend(RESPONSE_CACHE_MAX_BYTES)
+
+
+response_cache = ResponseCache(_create_backend())
+if isinstance(response_cache.backend, MemoryBackend):
+    # Tags only reach the cache of the worker that made the write, another worker's writes clear it once the version
+    # sync sees them. Redis is shared by all workers, the writing worker's tags already cover it.
+    data_version.on_external_change(lambda db: response_cache.clear())
+
+_adapters: dict = {}
+
+def render(model, data) -> bytes:
+    # Same validation and JSON as FastAPI's response_model, done once per cached body
+    adapter = _adapters.get(model)
+    if adapter is None:
+        adapter = _adapters[model] = TypeAdapter(model)
+    return adapter.dump_json(adapter.validate_python(data, from_attributes=True))
+
+def cache_key(request: Request) -> str:
+    return f"{request.url.path}?{request.url.query}"
+
+def json_response(body: bytes, response: Response) -> Response:
+    # Keeps the headers already set on the endpoint's response, e.g. the validators from not_modified
+    headers = {key: value for key, value in response.headers.items() if key != "content-length"}
+    return Response(content=body, media_type="application/json", headers=headers)
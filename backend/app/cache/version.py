@@ -0,0 +1,112 @@
+import asyncio
+import logging
+import os
+import threading
+from datetime import datetime, timezone
+from typing import Callable, Optional
+from sqlalchemy import event, insert, select, update
+from sqlalchemy.orm import Session
+from starlette.concurrency import run_in_threadpool
+from dotenv import load_dotenv
+from app.database.database import SessionLocal
+from app.models.models import DataVersion
+
+load_dotenv()
+
+# How often each worker picks up versions bumped by the other workers
+DATA_VERSION_SYNC_SECONDS = float(os.getenv("DATA_VERSION_SYNC_SECONDS", "1"))
+
+logger = logging.getLogger(__name__)
+
+
+class DataVersionTracker:
+    # Monotonic version of everything the cached read endpoints return. Writes bump the row in their own
+    # transaction, the new version is published in this process once that transaction commits.
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.version = 0
+        self.updated_at: Optional[datetime] = None
+        self.loaded = False
+        # Version as of the last load, and the versions this process committed itself since then
+        self._synced = 0
+        self._written: set[int] = set()
+        self._listeners: list[Callable[[Session], None]] = []
+
+    def _set(self, version: int, updated_at: datetime):
+        with self._lock:
+            if version > self.version or not self.loaded:
+                self.version = version
+                self.updated_at = updated_at
+            self.loaded = True
+
+    def _publish(self, version: int, updated_at: datetime):
+        # A version committed by this process, the sync doesn't take it for another process's write
+        with self._lock:
+            self._written.add(version)
+        self._set(version, updated_at)
+
+    def on_external_change(self, listener: Callable[[Session], None]):
+        # Called from the sync, with its session, once it finds versions that another process wrote. State kept in
+        # this process and only updated by its own writes has to catch up then.
+        self._listeners.append(listener)
+
+    def load(self, db: Session):
+        row = db.execute(select(DataVersion.version, DataVersion.updated_at).where(DataVersion.id == 1)).first()
+        if row is None:
+            row = (0, datetime.now(timezone.utc).replace(tzinfo=None, microsecond=0))
+            db.execute(insert(DataVersion).values(id=1, version=row[0], updated_at=row[1]))
+            db.commit()
+        with self._lock:
+            # Every bump adds one, so any version since the last load that this process didn't commit came from outside
+            written = len([version for version in self._written if self._synced < version <= row[0]])
+            external = self.loaded and row[0] - self._synced > written
+            self._written = {version for version in self._written if version > row[0]}
+            self._synced = row[0]
+        self._set(*row)
+        if external:
+            for listener in self._listeners:
+                listener(db)
+
+    def bump(self, db: Session):
+        # Last-Modified only has second precision
+        now = datetime.now(timezone.utc).replace(tzinfo=None, microsecond=0)
+        version = db.execute(
+            update(DataVersion).where(DataVersion.id == 1)
+            .values(version=DataVersion.version + 1, updated_at=now)
+            .returning(DataVersion.version)
+        ).scalar()
+        if version is None:
+            version = 1
+            db.execute(insert(DataVersion).values(id=1, version=version, updated_at=now))
+        db.info["data_version"] = (version, now)
+
+    def _sync_now(self):
+        db = SessionLocal()
+        try:
+            self.load(db)
+        finally:
+            db.close()
+
+    async def run_sync(self):
+        # Background task started with the app, keeps this worker in step with the other workers
+        while True:
+            await asyncio.sleep(DATA_VERSION_SYNC_SECONDS)
+            try:
+                await run_in_threadpool(self._sync_now)
+            except Exception:
+                logger.exception("Syncing the data version failed")
+
+
+data_version = DataVersionTracker()
+
+
+@event.listens_for(Session, "after_commit")
+def _publish_data_version(session: Session):
+    pending = session.info.pop("data_version", None)
+    if pending:
+        data_version._publish(*pending)
+
+@event.listens_for(Session, "after_rollback")
+def _drop_data_version(session: Session):
+    session.info.pop("data_version", None)
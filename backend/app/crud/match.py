@@ -1,7 +1,17 @@
+from datetime import datetime, timezone
+from typing import Optional
+from fastapi import HTTPException
+from sqlalchemy import func, update
 from sqlalchemy.orm import Session
-from app.crud.statistic import calculate_rating_change, crud_update_rating
-from app.models.models import Match, User
-from app.schemas.schemas import MatchCreate
+from app.cache.responses import RANKING_TAG, RECENT_TAG, response_cache, user_tag
+from app.cache.version import data_version
+from app.crud.statistic import apply_match_statistics, apply_pair_statistics, apply_rating_change, crud_rebuild_pair_statistics
+from app.models.models import DONE, LOSER, PENDING, WINNER, Match, MatchOutbox, MatchParticipant, RatingSnapshot, User
+from app.rating.engines import rating_engine
+from app.rating.incremental import at_or_after, capture_ratings_at, rerate_from
+from app.rating.leaderboard import leaderboard
+from app.rating.lock import lock_ratings
+from app.schemas.schemas import MatchCreate, MatchUpdate
 
 # Match functions
 def crud_get_all_matches(db: Session) -> list[Match]:
@@ -11,103 +21,208 @@ def crud_get_match_by_id(db: Session, match_id: int) -> Match:
     return db.query(Match).filter(Match.id == match_id).first()
 
 def crud_get_recent_matches(db: Session, limit: int = 5) -> list[Match]:
-    return db.query(Match).order_by(Match.date_played.desc()).limit(limit).all()
+    return (
+        db.query(Match)
+        .order_by(Match.date_played.desc())
+        .limit(limit)
+        .all()
+    )
 
-def crud_create_match(db: Session, match: MatchCreate, current_user_id: int) -> Match:
+def validate_match_players(winner_ids: list[int], loser_ids: list[int]):
     # Ensure exactly 4 unique users are provided
-    unique_users = set(match.winners + match.losers)
-    if len(unique_users) != 4:
+    if len(set(winner_ids + loser_ids)) != 4:
         raise ValueError("Exactly 4 unique users must be provided in a match")
 
+def get_match_players(db: Session, winner_ids: list[int], loser_ids: list[int]) -> tuple[list[User], list[User]]:
+    validate_match_players(winner_ids, loser_ids)
+    unique_users = set(winner_ids + loser_ids)
+
+    # Load every participant in a single query
+    users = {user.id: user for user in db.query(User).filter(User.id.in_(unique_users))}
+    if len(users) != 4:
+        raise ValueError("All players in a match must be registered users")
+    return [users[user_id] for user_id in winner_ids], [users[user_id] for user_id in loser_ids]
+
+def check_match_players(db: Session, winner_ids: list[int], loser_ids: list[int]):
+    # Same checks as get_match_players without loading the users
+    validate_match_players(winner_ids, loser_ids)
+    if db.query(func.count(User.id)).filter(User.id.in_(set(winner_ids + loser_ids))).scalar() != 4:
+        raise ValueError("All players in a match must be registered users")
+
+def match_participants(winners: list[User], losers: list[User]) -> list[MatchParticipant]:
+    return (
+        [MatchParticipant(user_id=user.id, side=WINNER) for user in winners]
+        + [MatchParticipant(user_id=user.id, side=LOSER) for user in losers]
+    )
+
+def is_back_dated(db: Session, date_played) -> bool:
+    # A match dated before already recorded ones changes every rating after it. With rating periods that already
+    # holds for any match in its period, they are all rated together.
+    start_date, start_id = rating_engine.align(date_played, None)
+    return db.query(Match.id).filter(at_or_after(start_date, start_id)).first() is not None
+
+def _new_match(match: MatchCreate, current_user_id: int, winners: list[User], losers: list[User]) -> Match:
     db_match = Match(
         winner_score=match.winner_score,
         loser_score=match.loser_score,
         creator_id=current_user_id,
         date_played=match.date_played
     )
+    db_match.participants = match_participants(winners, losers)
+    return db_match
+
+def append_match(db: Session, match: MatchCreate, current_user_id: int, winners: list[User], losers: list[User]) -> Match:
+    # Rates a match played after every recorded one on the loaded users, flushed but not committed.
+    # Appending several matches in one session applies them in order, each sees the ratings of the previous ones.
+    db_match = _new_match(match, current_user_id, winners, losers)
     db.add(db_match)
-    db.commit()
-    db.refresh(db_match)
 
-    def get_users_and_ratings(user_ids):
-        users = db.query(User).filter(User.id.in_(user_ids)).all()
-        usernames = [user.username for user in users]
-        ratings = [user.rating for user in users]
-        return users, usernames, ratings
+    # Calculate the rating change once and apply it to the loaded users
+    # A first match starts from the engine's defaults, stored like a replay would store them
+    states_before = {
+        user.id: (
+            user.rating,
+            rating_engine.default_deviation if user.rating_deviation is None else user.rating_deviation,
+            rating_engine.default_volatility if user.rating_volatility is None else user.rating_volatility
+        )
+        for user in winners + losers
+    }
+    (
+        db_match.winner_avg_rating, db_match.loser_avg_rating,
+        db_match.elo_change_winner, db_match.elo_change_loser
+    ) = apply_rating_change(winners, losers, match.date_played)
+    for participant, user in zip(db_match.participants, winners + losers):
+        participant.rating_before = states_before[user.id][0]
+        participant.rating_delta = user.rating - states_before[user.id][0]
+    db_match.rating_snapshots = [
+        RatingSnapshot(
+            user_id=user.id, rating_before=states_before[user.id][0], rating_after=user.rating, date_played=match.date_played,
+            deviation_before=states_before[user.id][1], volatility_before=states_before[user.id][2]
+        )
+        for user in winners + losers
+    ]
+
+    apply_match_statistics(winners, losers, match.winner_score, match.loser_score, match.date_played)
+    apply_pair_statistics(db, [user.id for user in winners], [user.id for user in losers])
+    db.flush()
+    return db_match
 
-    winners, winner_usernames, winner_ratings = get_users_and_ratings(match.winners)
-    losers, loser_usernames, loser_ratings = get_users_and_ratings(match.losers)
+def utc_now() -> datetime:
+    return datetime.now(timezone.utc).replace(tzinfo=None)
 
-    db_match.winners.extend(winners)
-    db_match.losers.extend(losers)
+def crud_submit_match(db: Session, match: MatchCreate, current_user_id: int) -> MatchOutbox:
+    # Only the players are checked up front, the rating writer creates and rates the match afterwards
+    check_match_players(db, match.winners, match.losers)
+    now = utc_now()
+    submission = MatchOutbox(
+        creator_id=current_user_id,
+        payload=match.model_dump(mode="json"),
+        status=PENDING,
+        attempts=0,
+        created_at=now,
+        next_attempt_at=now
+    )
+    db.add(submission)
+    db.flush()
+    # Returned as written, without reading the row back after the commit
+    db.expunge(submission)
     db.commit()
-
-    # Calculate and update ELO ratings
-    winner_avg_rating = sum(winner_ratings) / len(winner_ratings) if winner_ratings else 0
-    loser_avg_rating = sum(loser_ratings) / len(loser_ratings) if loser_ratings else 0
-    elo_change_winner, elo_change_loser = calculate_rating_change(winner_avg_rating, loser_avg_rating)
-
-    # Update user ratings and match details using crud_update_rating
-    crud_update_rating(db, db_match.id, match.winners, match.losers)
-
-    # Update match attributes with calculated values
-    db_match.winner_usernames = winner_usernames
-    db_match.loser_usernames = loser_usernames
-    db_match.winner_avg_rating = winner_avg_rating
-    db_match.loser_avg_rating = loser_avg_rating
-    db_match.elo_change_winner = elo_change_winner
-    db_match.elo_change_loser = elo_change_loser
-
+    return submission
+
+def crud_get_submission(db: Session, submission_id: int) -> MatchOutbox:
+    return db.query(MatchOutbox).filter(MatchOutbox.id == submission_id).first()
+
+class SubmissionHandled(Exception):
+    # Another writer processed the submission first, the transaction that applied it again has to be rolled back
+    def __init__(self, submission_id: int):
+        super().__init__(f"Submission {submission_id} was already processed")
+        self.submission_id = submission_id
+
+
+def mark_processed(db: Session, submission: MatchOutbox, db_match: Match):
+    # Committed together with the match and only while the submission is still pending. Two writers can read the same
+    # pending submission where lock_ratings takes no lock (SQLite), whichever marks it second rolls its match back.
+    updated = db.execute(
+        update(MatchOutbox)
+        .where(MatchOutbox.id == submission.id, MatchOutbox.status == PENDING)
+        .values(status=DONE, match_id=db_match.id, attempts=MatchOutbox.attempts + 1, error=None, processed_at=utc_now())
+    ).rowcount
+    if not updated:
+        raise SubmissionHandled(submission.id)
+
+def publish_ratings(ratings: dict[int, float]):
+    # After the commit, the in-process views of the changed ratings catch up
+    leaderboard.update_many(ratings)
+    response_cache.invalidate([user_tag(user_id) for user_id in ratings] + [RANKING_TAG, RECENT_TAG])
+
+def crud_create_match(db: Session, match: MatchCreate, current_user_id: int, submission: Optional[MatchOutbox] = None) -> Match:
+    lock_ratings(db)
+    winners, losers = get_match_players(db, match.winners, match.losers)
+
+    if is_back_dated(db, match.date_played):
+        start_ratings = capture_ratings_at(db, match.date_played, None, [user.id for user in winners + losers])
+        db_match = _new_match(match, current_user_id, winners, losers)
+        db.add(db_match)
+        apply_pair_statistics(db, [user.id for user in winners], [user.id for user in losers])
+        db.flush()
+        if submission is not None:
+            mark_processed(db, submission, db_match)
+        rerate_from(db, match.date_played, db_match.id, start_ratings)
+        return db_match
+
+    db_match = append_match(db, match, current_user_id, winners, losers)
+    if submission is not None:
+        mark_processed(db, submission, db_match)
+
+    # Match row, rating updates, participants and snapshots are written in one transaction. The new ratings are
+    # taken before the commit expires the users, reading them afterwards would reload every player.
+    ratings = {user.id: user.rating for user in winners + losers}
+    data_version.bump(db)
     db.commit()
+    publish_ratings(ratings)
 
     return db_match
 
-#Edit match feature, to be updated later
-#def crud_update_match(db: Session, match_id: int, match_data: MatchUpdate, current_user_id: int) -> Match:
+def crud_update_match(db: Session, match_id: int, match_data: MatchUpdate, current_user_id: int) -> Match:
     db_match = db.query(Match).filter(Match.id == match_id).first()
     if db_match:
         # Check if the current user is the creator of the match
         if db_match.creator_id != current_user_id:
-            raise ValueError("Only the creator can update the match")
-
-        db_match.winner_score = match_data.winner_score
-        db_match.loser_score = match_data.loser_score
-
-        # Clear existing winners and losers
-        db_match.winners.clear()
-        db_match.losers.clear()
+            raise HTTPException(status_code=403, detail="Only the creator can update the match")
+        lock_ratings(db)
 
-        # Add updated winners and losers
-        winners = []
-        for user_id in match_data.winners:
-            user = db.query(User).filter(User.id == user_id).first()
-            if user:
-                db_match.winners.append(user)
-                winners.append(user)
+        winners, losers = get_match_players(db, match_data.winners, match_data.losers)
 
-        losers = []
-        for user_id in match_data.losers:
-            user = db.query(User).filter(User.id == user_id).first()
-            if user:
-                db_match.losers.append(user)
-                losers.append(user)
+        # Everything from the earlier of the old and new position onwards has to be re-rated
+        start_date = min(db_match.date_played, match_data.date_played)
+        start_ratings = capture_ratings_at(db, start_date, db_match.id, [user.id for user in winners + losers])
+        old_player_ids = [participant.user_id for participant in db_match.participants]
 
-        db.commit()
-        db.refresh(db_match)
+        db_match.winner_score = match_data.winner_score
+        db_match.loser_score = match_data.loser_score
+        db_match.date_played = match_data.date_played
+        db_match.participants = match_participants(winners, losers)
+        db.flush()
+        # Old and new players both have a pair that changed
+        crud_rebuild_pair_statistics(db, old_player_ids + [user.id for user in winners + losers])
 
-        # Calculate and update ELO ratings
-        crud_update_rating(db, match_id, winners, losers)
+        rerate_from(db, start_date, db_match.id, start_ratings)
 
     return db_match
 
-#Delete match feature, to be updated later
-#def crud_delete_match(db: Session, match_id: int, current_user_id: int) -> Match:
+def crud_delete_match(db: Session, match_id: int, current_user_id: int) -> Match:
     db_match = db.query(Match).filter(Match.id == match_id).first()
     if db_match:
         # Check if the current user is the creator of the match
         if db_match.creator_id != current_user_id:
-            raise ValueError("You do not have permission to delete this match")
+            raise HTTPException(status_code=403, detail="You do not have permission to delete this match")
+        lock_ratings(db)
 
+        start_ratings = capture_ratings_at(db, db_match.date_played, db_match.id)
+        player_ids = [participant.user_id for participant in db_match.participants]
         db.delete(db_match)
-        db.commit()
+        db.flush()
+        crud_rebuild_pair_statistics(db, player_ids)
+        rerate_from(db, db_match.date_played, db_match.id, start_ratings)
+
     return db_match
\ No newline at end of file
@@ -1,98 +1,301 @@
-from sqlalchemy.orm import Session
-from app.models.models import Match, User
+from array import array
+from datetime import date
+from typing import Iterable, Iterator, Optional
+from sqlalchemy import and_, case, delete, func, insert, literal_column, not_, or_, select
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import Session, aliased
+from sqlalchemy.orm.attributes import flag_modified
+from app.models.models import LOSER, OPPONENT, PARTNER, WINNER, Match, MatchParticipant, PairStatistic, RatingSnapshot, User, UserStatistic
+from app.rating.engines import DEFAULT_RATING, RatingResult, build_teams, rating_engine
 
+# Users per statement when the pair counters of many users are rebuilt
+PAIR_CHUNK_SIZE = 500
+# Written in full on every match, so all players' rows go out as one UPDATE whichever counters moved
+STATISTIC_COUNTERS = ("wins", "losses", "points_for", "points_against", "current_streak", "best_streak", "peak_rating", "last_played")
 
-def calculate_rating_change(winner_avg_rating: float, loser_avg_rating: float):
-    k_factor = 32
-    expected_score_winner = 1 / (1 + 10 ** ((loser_avg_rating - winner_avg_rating) / 400))
-    expected_score_loser = 1 / (1 + 10 ** ((winner_avg_rating - loser_avg_rating) / 400))
 
-    actual_score_winner = 1
-    actual_score_loser = 0
+def apply_rating_change(winners: list[User], losers: list[User], date_played: Optional[date] = None) -> tuple[float, float, float, float]:
+    # Rates one match played after all the others with the configured engine
+    players = winners + losers
+    state = rating_engine.new_state(len(players))
+    for u, user in enumerate(players):
+        state.ratings[u] = user.rating
+        if user.rating_deviation is not None:
+            state.deviations[u] = user.rating_deviation
+        if user.rating_volatility is not None:
+            state.volatilities[u] = user.rating_volatility
+        if user.statistic is not None and user.statistic.last_played is not None:
+            state.last_periods[u] = rating_engine.period_of(user.statistic.last_played)
 
-    elo_change_winner = k_factor * (actual_score_winner - expected_score_winner)
-    elo_change_loser = k_factor * (actual_score_loser - expected_score_loser)
+    teams = build_teams([(list(range(len(winners))), list(range(len(winners), len(players))))])
+    result = RatingResult.empty(teams)
+    rating_engine.rate(state, teams, array('q', [rating_engine.period_of(date_played or date.today())]), result)
 
-    return elo_change_winner, elo_change_loser
+    # Ratings are only changed on the loaded objects, the caller decides when to flush
+    for u, user in enumerate(players):
+        user.rating = state.ratings[u]
+        if rating_engine.default_deviation is not None:
+            user.rating_deviation = state.deviations[u]
+        if rating_engine.default_volatility is not None:
+            user.rating_volatility = state.volatilities[u]
 
-def crud_update_rating(db: Session, match_id: int, winners: list[int], losers: list[int]) -> dict:
-    match = db.query(Match).filter(Match.id == match_id).first()
-    if not match:
-        return None
+    return result.winner_avg_ratings[0], result.loser_avg_ratings[0], result.changes_winner[0], result.changes_loser[0]
 
-    winner_usernames = [db.query(User).filter(User.id == user_id).first().username for user_id in winners]
-    loser_usernames = [db.query(User).filter(User.id == user_id).first().username for user_id in losers]
+def _new_statistic(**values) -> UserStatistic:
+    # Column defaults only apply on insert, counters have to start at zero in Python too
+    counters = dict(wins=0, losses=0, points_for=0, points_against=0, current_streak=0, best_streak=0, peak_rating=DEFAULT_RATING)
+    return UserStatistic(**{**counters, **values})
 
-    winner_ratings = [db.query(User).filter(User.id == user_id).first().rating for user_id in winners]
-    loser_ratings = [db.query(User).filter(User.id == user_id).first().rating for user_id in losers]
+def _add_result(stats: UserStatistic, won: bool, points_for: int, points_against: int, rating_after: float, date_played: date):
+    if won:
+        stats.wins += 1
+        stats.current_streak = stats.current_streak + 1 if stats.current_streak > 0 else 1
+    else:
+        stats.losses += 1
+        stats.current_streak = stats.current_streak - 1 if stats.current_streak < 0 else -1
+    stats.best_streak = max(stats.best_streak, stats.current_streak)
+    stats.points_for += points_for or 0
+    stats.points_against += points_against or 0
 
-    winner_avg_rating = sum(winner_ratings) / len(winner_ratings) if winner_ratings else 0
-    loser_avg_rating = sum(loser_ratings) / len(loser_ratings) if loser_ratings else 0
+    if rating_after is not None:
+        stats.peak_rating = max(stats.peak_rating or DEFAULT_RATING, rating_after)
+    if stats.last_played is None or date_played > stats.last_played:
+        stats.last_played = date_played
 
-    elo_change_winner, elo_change_loser = calculate_rating_change(winner_avg_rating, loser_avg_rating)
+def apply_match_statistics(winners: list[User], losers: list[User], winner_score: int, loser_score: int, date_played: date):
+    # Incremental update for a match appended at the end of the history, users must already carry their new rating
+    for team, won, points_for, points_against in ((winners, True, winner_score, loser_score), (losers, False, loser_score, winner_score)):
+        for user in team:
+            if user.statistic is None:
+                user.statistic = _new_statistic()
+            _add_result(user.statistic, won, points_for, points_against, user.rating, date_played)
+            for column in STATISTIC_COUNTERS:
+                flag_modified(user.statistic, column)
 
-    # Update ratings in the database
-    for user_id in winners:
-        user = db.query(User).filter(User.id == user_id).first()
-        if user:
-            user.rating += elo_change_winner
+def _statistics_before(db: Session, user_ids: list[int], since) -> dict[int, UserStatistic]:
+    # Counters as of the cut, aggregated in the database over the matches before it. Consecutive results on the same
+    # side share a run number, the longest winning run is the best streak. The current streak is the distance between
+    # the positions of the last win and the last loss.
+    order_by = (Match.date_played, Match.id)
+    won = MatchParticipant.side == WINNER
+    position = func.row_number().over(partition_by=MatchParticipant.user_id, order_by=order_by)
+    ordered = (
+        select(
+            MatchParticipant.user_id,
+            MatchParticipant.side,
+            position.label("position"),
+            (position - func.row_number().over(partition_by=(MatchParticipant.user_id, MatchParticipant.side), order_by=order_by)).label("run"),
+            case((won, Match.winner_score), else_=Match.loser_score).label("points_for"),
+            case((won, Match.loser_score), else_=Match.winner_score).label("points_against"),
+            (MatchParticipant.rating_before + MatchParticipant.rating_delta).label("rating_after"),
+            Match.date_played
+        )
+        .join(Match, Match.id == MatchParticipant.match_id)
+        .where(MatchParticipant.user_id.in_(user_ids), not_(since))
+        .subquery()
+    )
+    runs = (
+        select(
+            ordered.c.user_id,
+            ordered.c.side,
+            func.count().label("length"),
+            func.max(ordered.c.position).label("last"),
+            func.sum(ordered.c.points_for).label("points_for"),
+            func.sum(ordered.c.points_against).label("points_against"),
+            func.max(ordered.c.rating_after).label("peak_rating"),
+            func.max(ordered.c.date_played).label("last_played")
+        )
+        .group_by(ordered.c.user_id, ordered.c.side, ordered.c.run)
+        .subquery()
+    )
+    run_won = runs.c.side == WINNER
+    rows = db.execute(
+        select(
+            runs.c.user_id,
+            func.sum(case((run_won, runs.c.length), else_=0)).label("wins"),
+            func.sum(case((run_won, 0), else_=runs.c.length)).label("losses"),
+            func.sum(runs.c.points_for).label("points_for"),
+            func.sum(runs.c.points_against).label("points_against"),
+            func.max(case((run_won, runs.c.length), else_=0)).label("best_streak"),
+            func.max(case((run_won, runs.c.last))).label("last_win"),
+            func.max(case((run_won, None), else_=runs.c.last)).label("last_loss"),
+            func.max(runs.c.peak_rating).label("peak_rating"),
+            func.max(runs.c.last_played).label("last_played")
+        )
+        .group_by(runs.c.user_id)
+    )
+    # Sums come back as decimals on PostgreSQL
+    return {
+        row.user_id: _new_statistic(
+            user_id=row.user_id,
+            wins=int(row.wins),
+            losses=int(row.losses),
+            points_for=int(row.points_for or 0),
+            points_against=int(row.points_against or 0),
+            current_streak=int(row.last_win or 0) - int(row.last_loss or 0),
+            best_streak=int(row.best_streak),
+            peak_rating=max(DEFAULT_RATING, row.peak_rating or DEFAULT_RATING),
+            last_played=row.last_played
+        )
+        for row in rows
+    }
 
-    for user_id in losers:
-        user = db.query(User).filter(User.id == user_id).first()
-        if user:
-            user.rating += elo_change_loser
+def crud_rebuild_user_statistics(db: Session, user_ids: Optional[list[int]] = None, since=None):
+    # Recompute the counters of the given users (all users when None) from their history, without committing. since
+    # is a condition on Match selecting a suffix of the (date_played, id) order: only those matches are replayed
+    # here, starting from the counters as of the cut.
+    query = (
+        select(
+            MatchParticipant.user_id, MatchParticipant.side, Match.id, Match.date_played, Match.winner_score, Match.loser_score,
+            (MatchParticipant.rating_before + MatchParticipant.rating_delta).label("rating_after")
+        )
+        .join(Match, Match.id == MatchParticipant.match_id)
+        # Streaks and peaks depend on the order the matches were played in
+        .order_by(Match.date_played, Match.id)
+    )
+    if user_ids is not None:
+        query = query.where(MatchParticipant.user_id.in_(user_ids))
+    if since is not None:
+        query = query.where(since)
 
-    db.commit()
+    statistics = {} if since is None else _statistics_before(db, user_ids, since)
+    for row in db.execute(query):
+        won = row.side == WINNER
+        if row.user_id not in statistics:
+            statistics[row.user_id] = _new_statistic(user_id=row.user_id)
+        stats = statistics[row.user_id]
+        points_for, points_against = (row.winner_score, row.loser_score) if won else (row.loser_score, row.winner_score)
+        _add_result(stats, won, points_for, points_against, row.rating_after, row.date_played)
 
-    match_details = {
-        "id": match.id,
-        "creator_id": match.creator_id,
-        "winner_usernames": winner_usernames,
-        "loser_usernames": loser_usernames,
-        "winner_score": match.winner_score,
-        "loser_score": match.loser_score,
-        "winner_avg_rating": winner_avg_rating,
-        "loser_avg_rating": loser_avg_rating,
-        "elo_change_winner": elo_change_winner,
-        "elo_change_loser": elo_change_loser
-    }
+    if user_ids is None:
+        db.execute(delete(UserStatistic))
+    else:
+        db.execute(delete(UserStatistic).where(UserStatistic.user_id.in_(user_ids)))
+    if statistics:
+        columns = UserStatistic.__table__.columns.keys()
+        db.execute(insert(UserStatistic), [{column: getattr(stats, column) for column in columns} for stats in statistics.values()])
 
-    return match_details
+def apply_pair_statistics(db: Session, winner_ids: list[int], loser_ids: list[int]):
+    # Incremental update of the partner and opponent counters for one new match, without committing. A single
+    # upsert, whether the pairs have met before or not.
+    rows = [
+        {"user_id": user_id, "relation": relation, "other_id": other_id, "wins": int(won), "losses": int(not won)}
+        for team, opponents, won in ((winner_ids, loser_ids, True), (loser_ids, winner_ids, False))
+        for user_id in team
+        for relation, other_id in (
+            [(PARTNER, other_id) for other_id in team if other_id != user_id] + [(OPPONENT, other_id) for other_id in opponents]
+        )
+    ]
+    table = PairStatistic.__table__
+    dialect_insert = postgresql.insert if db.get_bind().dialect.name == "postgresql" else sqlite.insert
+    statement = dialect_insert(table)
+    db.execute(
+        statement.on_conflict_do_update(
+            index_elements=[table.c.user_id, table.c.relation, table.c.other_id],
+            set_={"wins": table.c.wins + statement.excluded.wins, "losses": table.c.losses + statement.excluded.losses}
+        ),
+        rows
+    )
 
-def crud_get_full_match_history(db: Session) -> list[Match]:
-    return db.query(Match).all()
+def crud_rebuild_pair_statistics(db: Session, user_ids: Optional[Iterable[int]] = None):
+    # Recompute the partner and opponent counters of the given users (all users when None) in the database, without
+    # committing. The counters don't depend on the order of the matches, only the users of changed matches need this.
+    player, other = aliased(MatchParticipant), aliased(MatchParticipant)
+    # Inlined, so PostgreSQL sees the same expression in the select list and in GROUP BY
+    relation = case((player.side == other.side, literal_column(str(PARTNER))), else_=literal_column(str(OPPONENT)))
+    query = (
+        select(
+            player.user_id, relation, other.user_id,
+            func.sum(case((player.side == WINNER, 1), else_=0)), func.sum(case((player.side == LOSER, 1), else_=0))
+        )
+        .join(other, and_(other.match_id == player.match_id, other.user_id != player.user_id))
+        .group_by(player.user_id, relation, other.user_id)
+    )
+    columns = ["user_id", "relation", "other_id", "wins", "losses"]
 
-def crud_get_user_match_history(db: Session, user_id: int) -> list[dict]:
-    user = db.query(User).filter(User.id == user_id).first()
-    if not user:
-        return []
+    if user_ids is None:
+        db.execute(delete(PairStatistic))
+        db.execute(insert(PairStatistic).from_select(columns, query))
+        return
+    user_ids = sorted(set(user_ids))
+    for start in range(0, len(user_ids), PAIR_CHUNK_SIZE):
+        chunk = user_ids[start:start + PAIR_CHUNK_SIZE]
+        db.execute(delete(PairStatistic).where(PairStatistic.user_id.in_(chunk)))
+        db.execute(insert(PairStatistic).from_select(columns, query.where(player.user_id.in_(chunk))))
 
-    history = []
+def crud_get_pair_statistics(db: Session, user_id: int, relation: int, limit: int, order: str = "games", min_games: int = 1) -> list[dict]:
+    # The user's most frequent (or most successful) partners or opponents, straight from the precomputed counters
+    games = PairStatistic.wins + PairStatistic.losses
+    if order == "win_percentage":
+        ordering = [(PairStatistic.wins * 100.0 / games).desc(), games.desc()]
+    else:
+        ordering = [games.desc(), PairStatistic.wins.desc()]
+    rows = db.execute(
+        select(PairStatistic.other_id, User.username, PairStatistic.wins, PairStatistic.losses)
+        .join(User, User.id == PairStatistic.other_id)
+        .where(PairStatistic.user_id == user_id, PairStatistic.relation == relation, games >= min_games)
+        .order_by(*ordering, PairStatistic.other_id)
+        .limit(limit)
+    )
+    return [
+        {
+            "id": other_id,
+            "username": username,
+            "games": wins + losses,
+            "wins": wins,
+            "losses": losses,
+            "win_percentage": wins / (wins + losses) * 100
+        }
+        for other_id, username, wins, losses in rows
+    ]
 
-    for match in user.matches_won + user.matches_lost:
-        is_winner = user in match.winners
+def _match_history_query():
+    # Newest first, the usernames come with every row so a page or a streamed batch is a single query
+    return select(Match).order_by(Match.date_played.desc(), Match.id.desc())
 
-        match_details = {
-            "match_id": match.id,
-            "is_winner": is_winner,
-            "score": match.winner_score if is_winner else match.loser_score,
-            "opponent_usernames": [u.username for u in match.losers] if is_winner else [u.username for u in match.winners],
-            "opponent_ratings": [u.rating for u in match.losers] if is_winner else [u.rating for u in match.winners],
-            "elo_change": calculate_rating_change(user.rating, sum([u.rating for u in match.losers]) / len(match.losers))[0] if is_winner else calculate_rating_change(sum([u.rating for u in match.winners]) / len(match.winners), user.rating)[1]
-        }
+def crud_get_full_match_history(
+    db: Session, limit: Optional[int] = None, before: Optional[tuple[date, int]] = None
+) -> list[Match]:
+    query = _match_history_query()
+    if before:
+        # Keyset pagination, continue right after the last (date_played, id) of the previous page
+        before_date, before_id = before
+        query = query.where(or_(Match.date_played < before_date, and_(Match.date_played == before_date, Match.id < before_id)))
+    if limit:
+        query = query.limit(limit)
+    return db.execute(query).scalars().all()
 
-        history.append(match_details)
+def crud_stream_full_match_history(db: Session, batch_size: int = 500) -> Iterator[Match]:
+    # Rows come from a server-side cursor batch by batch, so memory stays flat for any history size
+    yield from db.execute(_match_history_query().execution_options(yield_per=batch_size)).scalars()
 
-    return history
+def downsample(points: list, max_points: int) -> list:
+    # Keep max_points evenly spaced points, always including the first and the last one
+    if not max_points or len(points) <= max_points:
+        return points
+    if max_points == 1:
+        return points[-1:]
+    step = (len(points) - 1) / (max_points - 1)
+    return [points[round(i * step)] for i in range(max_points)]
+
+def crud_get_user_rating_history(
+    db: Session, user_id: int, start: Optional[date] = None, end: Optional[date] = None, max_points: Optional[int] = None
+) -> list[RatingSnapshot]:
+    query = db.query(RatingSnapshot).filter(RatingSnapshot.user_id == user_id)
+    if start:
+        query = query.filter(RatingSnapshot.date_played >= start)
+    if end:
+        query = query.filter(RatingSnapshot.date_played <= end)
+    points = query.order_by(RatingSnapshot.date_played, RatingSnapshot.match_id).all()
+    return downsample(points, max_points)
 
 def crud_get_user_win_percentage(db: Session, user_id: int) -> float:
     user = db.query(User).filter(User.id == user_id).first()
     if not user:
         return 0.0
+    return get_win_percentage(user.statistic)
 
-    total_matches = len(user.matches_won) + len(user.matches_lost)
-    if total_matches == 0:
+def get_win_percentage(stats: Optional[UserStatistic]) -> float:
+    if stats is None or stats.wins + stats.losses == 0:
         return 0.0
-
-    win_percentage = (len(user.matches_won) / total_matches) * 100
-    return win_percentage
\ No newline at end of file
+    return (stats.wins / (stats.wins + stats.losses)) * 100
\ No newline at end of file
@@ -1,8 +1,13 @@
+from typing import Optional
 from fastapi import HTTPException
-from sqlalchemy import or_
+from sqlalchemy import delete, func, or_
 from sqlalchemy.orm import Session
 from app.auth.utils import get_password_hash
-from app.models.models import User, Match
+from app.cache.responses import RANKING_TAG, RECENT_TAG, response_cache, user_tag
+from app.cache.version import data_version
+from app.models.models import Match, MatchParticipant, PairStatistic, User
+from app.rating.leaderboard import leaderboard
+from app.search.username_index import SIMILARITY_THRESHOLD, username_index
 from app.schemas.schemas import UserCreate, UserUpdate
 
 # User functions
@@ -13,17 +18,49 @@ def crud_get_user_by_id(db: Session, user_id: int) -> User:
     return db.query(User).filter(User.id == user_id).first()
 
 def crud_get_users_by_username(db: Session, username: str):
-    return db.query(User).filter(User.username.ilike(f'%{username}%')).all()
+    user_ids = [result["id"] for result in crud_search_users(db, username, limit=50)]
+    users = {user.id: user for user in db.query(User).filter(User.id.in_(user_ids))}
+    return [users[user_id] for user_id in user_ids if user_id in users]
 
-def crud_get_users_by_rating(db: Session):
-    return db.query(User).order_by(User.rating.desc()).all()
+def crud_search_users(db: Session, term: str, offset: int = 0, limit: int = 20) -> list[dict]:
+    if db.get_bind().dialect.name == "postgresql":
+        # Served by the pg_trgm GIN index on users.username
+        similarity = func.similarity(User.username, term)
+        rows = (
+            db.query(User.id, User.username, similarity)
+            .filter(or_(User.username.icontains(term, autoescape=True), similarity >= SIMILARITY_THRESHOLD))
+            .order_by(User.username.istartswith(term, autoescape=True).desc(), similarity.desc(), User.username)
+            .offset(offset)
+            .limit(limit)
+            .all()
+        )
+    else:
+        username_index.ensure_loaded(db)
+        rows = username_index.search(term, offset + limit)[offset:]
+    return [{"id": user_id, "username": username, "score": score} for user_id, username, score in rows]
+
+def crud_get_users_by_rating(db: Session, offset: int = 0, limit: Optional[int] = None) -> list[dict]:
+    # Served from the in-memory leaderboard, the database is only read once per process
+    leaderboard.ensure_loaded(db)
+    return leaderboard.page(offset, limit)
+
+def crud_get_users_around(db: Session, user_id: int, radius: int) -> list[dict]:
+    leaderboard.ensure_loaded(db)
+    return leaderboard.around(user_id, radius)
 
-def crud_create_user(db: Session, user_data: UserCreate):
-    existing_user = db.query(User).filter(User.username == user_data.username).first()
-    if existing_user:
+def crud_get_user_rank(db: Session, user_id: int) -> Optional[dict]:
+    leaderboard.ensure_loaded(db)
+    return leaderboard.rank(user_id)
+
+def crud_check_username_available(db: Session, username: str):
+    if db.query(User.id).filter(User.username == username).first():
         raise HTTPException(status_code=400, detail="Username already exists")
-    
-    hashed_password = get_password_hash(user_data.password)
+
+def crud_create_user(db: Session, user_data: UserCreate, hashed_password: Optional[str] = None):
+    crud_check_username_available(db, user_data.username)
+
+    # Async routes hash in the hashing pool beforehand, other callers hash here
+    hashed_password = hashed_password or get_password_hash(user_data.password)
     db_user = User(
         username=user_data.username,
         hashed_password=hashed_password,
@@ -32,11 +69,17 @@ def crud_create_user(db: Session, user_data: UserCreate):
         picture=user_data.picture
     )
     db.add(db_user)
+    data_version.bump(db)
     db.commit()
     db.refresh(db_user)
+    leaderboard.update(db_user.id, db_user.rating, db_user.username)
+    username_index.update(db_user.id, db_user.username)
+    response_cache.invalidate([RANKING_TAG])
     return db_user
 
-def crud_update_user(db: Session, user_id: int, user_data: UserUpdate, current_user_id: int) -> User:
+def crud_update_user(
+    db: Session, user_id: int, user_data: UserUpdate, current_user_id: int, hashed_password: Optional[str] = None
+) -> User:
     db_user = db.query(User).filter(User.id == user_id).first()
     if not db_user:
         return None
@@ -46,14 +89,19 @@ def crud_update_user(db: Session, user_id: int, user_data: UserUpdate, current_u
 
     db_user.username = user_data.username
     if user_data.password:
-        db_user.hashed_password = get_password_hash(user_data.password)
+        db_user.hashed_password = hashed_password or get_password_hash(user_data.password)
     db_user.bio = user_data.bio
 
     if user_data.picture:
         db_user.picture = user_data.picture
 
+    data_version.bump(db)
     db.commit()
     db.refresh(db_user)
+    leaderboard.update(db_user.id, db_user.rating, db_user.username)
+    username_index.update(db_user.id, db_user.username)
+    # Usernames also show up in the ranking and in the recent matches
+    response_cache.invalidate([user_tag(user_id), RANKING_TAG, RECENT_TAG])
 
     return db_user
 
@@ -61,8 +109,14 @@ def crud_delete_user(db: Session, user_id: int, current_user_id: int):
     db_user = db.query(User).filter(User.id == user_id).first()
     if db_user:
         if current_user_id == user_id:
+            # Pairs with the user go on both sides, foreign keys don't cascade on every database
+            db.execute(delete(PairStatistic).where(or_(PairStatistic.user_id == user_id, PairStatistic.other_id == user_id)))
             db.delete(db_user)
+            data_version.bump(db)
             db.commit()
+            leaderboard.remove(user_id)
+            username_index.remove(user_id)
+            response_cache.invalidate([user_tag(user_id), RANKING_TAG, RECENT_TAG])
             return db_user
         else:
             raise HTTPException(status_code=403, detail="Not authorized to delete this user")
@@ -70,4 +124,11 @@ def crud_delete_user(db: Session, user_id: int, current_user_id: int):
         return None
 
 def crud_get_user_matches(db: Session, user_id: int) -> list[Match]:
-    return db.query(Match).filter(or_(Match.winners.any(id=user_id), Match.losers.any(id=user_id))).all()
\ No newline at end of file
+    # One range scan on the participants' (user_id, match_id) index
+    return (
+        db.query(Match)
+        .join(MatchParticipant, MatchParticipant.match_id == Match.id)
+        .filter(MatchParticipant.user_id == user_id)
+        .order_by(Match.id)
+        .all()
+    )
\ No newline at end of file
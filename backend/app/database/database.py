@@ -1,6 +1,8 @@
 from sqlalchemy import create_engine
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
+from starlette.concurrency import run_in_threadpool
 from dotenv import load_dotenv
 import os
 
@@ -12,9 +14,43 @@ engine = create_engine(SQLALCHEMY_DATABASE_URL)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 Base = declarative_base()
 
+# Async mode serves the async routes from asyncpg / aiosqlite instead of the threadpool
+DATABASE_ASYNC = os.getenv("DATABASE_ASYNC", "false").lower() in ("1", "true", "yes")
+
+ASYNC_DRIVERS = {
+    "postgresql": "postgresql+asyncpg",
+    "postgresql+psycopg2": "postgresql+asyncpg",
+    "sqlite": "sqlite+aiosqlite",
+}
+
+def get_async_database_url(url: str) -> str:
+    scheme, rest = url.split("://", 1)
+    return f"{ASYNC_DRIVERS.get(scheme, scheme)}://{rest}"
+
+async_engine = None
+AsyncSessionLocal = None
+if DATABASE_ASYNC:
+    async_engine = create_async_engine(get_async_database_url(SQLALCHEMY_DATABASE_URL))
+    # Objects stay usable after commit, lazy loads outside run_crud are not possible on an async session
+    AsyncSessionLocal = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
+
 def get_db():
     db = SessionLocal()
     try:
         yield db
     finally:
         db.close()
+
+async def get_async_db():
+    async with AsyncSessionLocal() as db:
+        yield db
+
+# Dependency for async routes, the session type follows DATABASE_ASYNC
+get_request_db = get_async_db if DATABASE_ASYNC else get_db
+
+async def run_crud(db, func, *args, **kwargs):
+    # Awaitable form of any crud function: on an AsyncSession the function runs on the async driver,
+    # on a regular Session it runs in the threadpool, either way the event loop is never blocked
+    if isinstance(db, AsyncSession):
+        return await db.run_sync(lambda session: func(session, *args, **kwargs))
+    return await run_in_threadpool(func, db, *args, **kwargs)
@@ -1,15 +1,54 @@
+import asyncio
 import os
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from starlette.staticfiles import StaticFiles
 from dotenv import load_dotenv
-from app.routers import users, matches, statistics, auth, register
-from app.database.database import Base, engine
+from app.routers import users, matches, statistics, auth, register, metrics
+from app.auth.hashing import password_hasher
+from app.auth.revocation import revocation_store
+from app.cache.version import data_version
+from app.database.database import Base, SessionLocal, async_engine, engine
+from app.monitoring.metrics import MetricsMiddleware, instrument_engine
+from app.rating.leaderboard import leaderboard
+from app.rating.writer import rating_writer
+from app.search.username_index import username_index
 
 # Load environment variables
 load_dotenv()
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Build the in-memory leaderboard once so ranking requests don't hit the database
+    db = SessionLocal()
+    try:
+        leaderboard.load(db)
+        data_version.load(db)
+        # PostgreSQL searches through its pg_trgm index, other databases use the in-process one
+        if engine.dialect.name != "postgresql":
+            username_index.load(db)
+    finally:
+        db.close()
+    # Start the bcrypt workers before the first login instead of during it
+    password_hasher.start()
+    rating_writer.start()
+    # Keeps the revoked tokens of this worker in step with the other workers
+    sweeper = asyncio.create_task(revocation_store.run_sweeper())
+    version_sync = asyncio.create_task(data_version.run_sync())
+    yield
+    version_sync.cancel()
+    sweeper.cancel()
+    # Matches already submitted are still rated before the process exits
+    await asyncio.to_thread(rating_writer.shutdown)
+    password_hasher.shutdown()
+
+app = FastAPI(lifespan=lifespan)
+
+# Count and time every SQL statement, per request and in total
+instrument_engine(engine)
+if async_engine is not None:
+    instrument_engine(async_engine.sync_engine)
 
 # Create the database tables
 Base.metadata.create_all(bind=engine)
@@ -27,6 +66,8 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+# Added last so it is the outermost middleware and times the whole request
+app.add_middleware(MetricsMiddleware)
 
 # Include your routers
 app.include_router(auth.router)
@@ -34,3 +75,4 @@ app.include_router(users.router)
 app.include_router(matches.router)
 app.include_router(statistics.router)
 app.include_router(register.router)
+app.include_router(metrics.router)
@@ -1,6 +1,8 @@
 from datetime import date
-from sqlalchemy import Column, Date, Integer, String, Float, Table, ForeignKey
-from sqlalchemy.orm import relationship
+from sqlalchemy import JSON, Column, Date, DateTime, Index, Integer, SmallInteger, String, Float, Table, ForeignKey, and_, select
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.orm import column_property, relationship
+from sqlalchemy.sql.functions import FunctionElement
 from app.database.database import Base
 
 match_user_association = Table(
@@ -9,19 +11,32 @@ match_user_association = Table(
     Column('user_id', ForeignKey('users.id'), primary_key=True)
 )
 
-winners_table = Table(
-    'winners',
-    Base.metadata,
-    Column('user_id', Integer, ForeignKey('users.id', ondelete='CASCADE')),
-    Column('match_id', Integer, ForeignKey('matches.id', ondelete='CASCADE'))
-)
+# Values of MatchParticipant.side
+WINNER = 1
+LOSER = 2
 
-losers_table = Table(
-    'losers',
-    Base.metadata,
-    Column('user_id', Integer, ForeignKey('users.id', ondelete='CASCADE')),
-    Column('match_id', Integer, ForeignKey('matches.id', ondelete='CASCADE'))
-)
+# Values of PairStatistic.relation
+PARTNER = 1
+OPPONENT = 2
+
+# Values of MatchOutbox.status
+PENDING = "pending"
+DONE = "done"
+FAILED = "failed"
+
+class MatchParticipant(Base):
+    __tablename__ = "match_participants"
+    __table_args__ = (
+        # A player's matches are one range scan on this index, the players of a match one on the primary key
+        Index('ix_match_participants_user_id_match_id', 'user_id', 'match_id'),
+    )
+
+    match_id = Column(Integer, ForeignKey('matches.id', ondelete='CASCADE'), primary_key=True)
+    user_id = Column(Integer, ForeignKey('users.id', ondelete='CASCADE'), primary_key=True)
+    side = Column(SmallInteger, nullable=False)
+    # Set when the match is rated, None for a team that can't be rated
+    rating_before = Column(Float, nullable=True)
+    rating_delta = Column(Float, nullable=True)
 
 class User(Base):
     __tablename__ = "users"
@@ -30,11 +45,70 @@ class User(Base):
     username = Column(String, unique=True, index=True, nullable=False)
     hashed_password = Column(String)
     rating = Column(Float, default=1000, index=True)
+    # Uncertainty of the rating for the engines that track it, NULL until the first rated match
+    rating_deviation = Column(Float, nullable=True)
+    rating_volatility = Column(Float, nullable=True)
     bio = Column(String, nullable=True)
     picture = Column(String, nullable=True)
 
-    matches_won = relationship("Match", secondary=winners_table, back_populates="winners")
-    matches_lost = relationship("Match", secondary=losers_table, back_populates="losers")
+    # Deleting a user takes them out of their matches
+    participations = relationship("MatchParticipant", cascade="all, delete-orphan")
+    matches_won = relationship(
+        "Match", secondary=MatchParticipant.__table__, viewonly=True,
+        primaryjoin=lambda: and_(User.id == MatchParticipant.user_id, MatchParticipant.side == WINNER),
+        secondaryjoin=lambda: Match.id == MatchParticipant.match_id
+    )
+    matches_lost = relationship(
+        "Match", secondary=MatchParticipant.__table__, viewonly=True,
+        primaryjoin=lambda: and_(User.id == MatchParticipant.user_id, MatchParticipant.side == LOSER),
+        secondaryjoin=lambda: Match.id == MatchParticipant.match_id
+    )
+    # Always loaded together with the user, so a profile is a single row lookup
+    statistic = relationship("UserStatistic", uselist=False, lazy="joined", cascade="all, delete-orphan")
+
+class UserStatistic(Base):
+    __tablename__ = "user_statistics"
+
+    # Counters maintained on match creation, rebuilt from history when ratings are recomputed
+    user_id = Column(Integer, ForeignKey('users.id', ondelete='CASCADE'), primary_key=True)
+    wins = Column(Integer, default=0, nullable=False)
+    losses = Column(Integer, default=0, nullable=False)
+    points_for = Column(Integer, default=0, nullable=False)
+    points_against = Column(Integer, default=0, nullable=False)
+    # Positive for a winning streak, negative for a losing streak
+    current_streak = Column(Integer, default=0, nullable=False)
+    best_streak = Column(Integer, default=0, nullable=False)
+    peak_rating = Column(Float, nullable=True)
+    last_played = Column(Date, nullable=True)
+
+class PairStatistic(Base):
+    __tablename__ = "pair_statistics"
+
+    # Results of a user together with or against another user, one row per pair that has played. Kept up to date on
+    # every match change, a user's partners or opponents are one range scan on the primary key.
+    user_id = Column(Integer, ForeignKey('users.id', ondelete='CASCADE'), primary_key=True)
+    relation = Column(SmallInteger, primary_key=True)
+    other_id = Column(Integer, ForeignKey('users.id', ondelete='CASCADE'), primary_key=True)
+    wins = Column(Integer, default=0, nullable=False)
+    losses = Column(Integer, default=0, nullable=False)
+
+class ordered_aggregate_strings(FunctionElement):
+    # aggregate_strings(value, separator) concatenated in the order of a third argument
+    type = String()
+    inherit_cache = True
+
+@compiles(ordered_aggregate_strings)
+def _compile_ordered_aggregate_strings(element, compiler, **kw):
+    value, separator, order_by = (compiler.process(clause, **kw) for clause in element.clauses)
+    # SQLite only takes ORDER BY inside an aggregate from 3.44, older versions concatenate in scan order
+    if getattr(compiler.dialect.dbapi, "sqlite_version_info", (0,)) < (3, 44):
+        return f"group_concat({value}, {separator})"
+    return f"group_concat({value}, {separator} ORDER BY {order_by})"
+
+@compiles(ordered_aggregate_strings, "postgresql")
+def _compile_ordered_aggregate_strings_postgresql(element, compiler, **kw):
+    value, separator, order_by = (compiler.process(clause, **kw) for clause in element.clauses)
+    return f"string_agg({value}, {separator} ORDER BY {order_by})"
 
 class Match(Base):
     __tablename__ = "matches"
@@ -43,14 +117,107 @@ class Match(Base):
     winner_score = Column(Integer, default=21)
     loser_score = Column(Integer)
     creator_id = Column(Integer, nullable=False)
-    date_played = Column(Date, default=date.today())
+    date_played = Column(Date, default=date.today(), index=True)
 
-    winner_usernames = Column(String, nullable=True)
-    loser_usernames = Column(String, nullable=True)
     winner_avg_rating = Column(Float, nullable=True)
     loser_avg_rating = Column(Float, nullable=True)
     elo_change_winner = Column(Integer, nullable=True)
     elo_change_loser = Column(Integer, nullable=True)
 
-    winners = relationship("User", secondary=winners_table, back_populates="matches_won")
-    losers = relationship("User", secondary=losers_table, back_populates="matches_lost")
\ No newline at end of file
+    # Comma-separated teams in user id order, aggregated from the participants' primary key in the same statement as
+    # the match
+    winner_usernames = column_property(
+        select(ordered_aggregate_strings(User.username, ',', MatchParticipant.user_id))
+        .join(MatchParticipant, MatchParticipant.user_id == User.id)
+        .where(MatchParticipant.match_id == id, MatchParticipant.side == WINNER)
+        .correlate_except(MatchParticipant, User)
+        .scalar_subquery()
+    )
+    loser_usernames = column_property(
+        select(ordered_aggregate_strings(User.username, ',', MatchParticipant.user_id))
+        .join(MatchParticipant, MatchParticipant.user_id == User.id)
+        .where(MatchParticipant.match_id == id, MatchParticipant.side == LOSER)
+        .correlate_except(MatchParticipant, User)
+        .scalar_subquery()
+    )
+
+    # Written through participants, winners and losers are read-only views of it
+    participants = relationship("MatchParticipant", cascade="all, delete-orphan")
+    winners = relationship(
+        "User", secondary=MatchParticipant.__table__, viewonly=True,
+        primaryjoin=lambda: and_(Match.id == MatchParticipant.match_id, MatchParticipant.side == WINNER),
+        secondaryjoin=lambda: User.id == MatchParticipant.user_id
+    )
+    losers = relationship(
+        "User", secondary=MatchParticipant.__table__, viewonly=True,
+        primaryjoin=lambda: and_(Match.id == MatchParticipant.match_id, MatchParticipant.side == LOSER),
+        secondaryjoin=lambda: User.id == MatchParticipant.user_id
+    )
+    rating_snapshots = relationship("RatingSnapshot", cascade="all, delete-orphan")
+
+class RatingSnapshot(Base):
+    __tablename__ = "rating_snapshots"
+    __table_args__ = (
+        # A player's rating graph is a single range scan on this index
+        Index('ix_rating_snapshots_user_id_date_played', 'user_id', 'date_played'),
+    )
+
+    # Rating of a player right before and after a match, used as re-rating checkpoints
+    user_id = Column(Integer, ForeignKey('users.id', ondelete='CASCADE'), primary_key=True)
+    match_id = Column(Integer, ForeignKey('matches.id', ondelete='CASCADE'), primary_key=True, index=True)
+    rating_before = Column(Float, nullable=False)
+    rating_after = Column(Float, nullable=False)
+    date_played = Column(Date, nullable=False)
+    # Rest of the player's rating state before the match, so re-rating can start from here with any engine
+    deviation_before = Column(Float, nullable=True)
+    volatility_before = Column(Float, nullable=True)
+
+class MatchOutbox(Base):
+    __tablename__ = "match_outbox"
+    __table_args__ = (
+        # The rating writer takes the oldest pending submissions first
+        Index('ix_match_outbox_status_id', 'status', 'id'),
+    )
+
+    # A submitted match waiting to be rated. The match row is created in the same transaction that marks it done,
+    # so a submission is applied once no matter how often processing is retried.
+    id = Column(Integer, primary_key=True)
+    creator_id = Column(Integer, nullable=False)
+    payload = Column(JSON, nullable=False)
+    status = Column(String(16), nullable=False, default=PENDING)
+    attempts = Column(Integer, nullable=False, default=0)
+    error = Column(String, nullable=True)
+    match_id = Column(Integer, ForeignKey('matches.id', ondelete='SET NULL'), nullable=True)
+    created_at = Column(DateTime, nullable=False)
+    next_attempt_at = Column(DateTime, nullable=False)
+    processed_at = Column(DateTime, nullable=True)
+
+class StagedMatch(Base):
+    __tablename__ = "staged_matches"
+
+    # A bulk imported match that isn't part of the history yet. Chunks are committed here so a failed import can be
+    # resumed, the import then moves them into matches in the same transaction that rates them.
+    import_id = Column(String(32), primary_key=True)
+    position = Column(Integer, primary_key=True)
+    creator_id = Column(Integer, nullable=False)
+    date_played = Column(Date, nullable=False)
+    winner_score = Column(Integer, nullable=False)
+    loser_score = Column(Integer, nullable=False)
+    winner_ids = Column(JSON, nullable=False)
+    loser_ids = Column(JSON, nullable=False)
+
+class RevokedToken(Base):
+    __tablename__ = "revoked_tokens"
+
+    # Shared by all workers, rows are deleted once the token has expired anyway
+    id = Column(Integer, primary_key=True)
+    token_id = Column(String(64), unique=True, nullable=False)
+    expires_at = Column(Integer, nullable=False, index=True)
+
+class DataVersion(Base):
+    __tablename__ = "data_versions"
+
+    # Single row, bumped in the same transaction as every write that changes what the read endpoints return
+    id = Column(Integer, primary_key=True)
+    version = Column(Integer, nullable=False, default=0)
+    updated_at = Column(DateTime, nullable=False)
\ No newline at end of file
@@ -0,0 +1,191 @@
+import logging
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextvars import ContextVar
+from typing import Callable, Optional
+from sqlalchemy import event
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Requests slower than this many seconds are logged with their SQL statements, unset disables the log
+SLOW_REQUEST_SECONDS = float(os.getenv("SLOW_REQUEST_SECONDS", "0")) or None
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+STATEMENT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100, 200, 500)
+BATCH_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256)
+
+logger = logging.getLogger(__name__)
+
+
+def _label_value(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _labels(names: tuple, values: tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{_label_value(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, labels: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        # Per label set: count per bucket (non-cumulative, the last one is +Inf), then the sum
+        self._series: dict[tuple, list] = {}
+
+    def observe(self, value: float, *label_values):
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[bisect_left(self.buckets, value)] += 1
+            series[-1] += value
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = {label_values: list(values) for label_values, values in self._series.items()}
+        for label_values, values in sorted(series.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), values):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(float(bound))
+                bucket_labels = _labels(self.labels, label_values, f'le="{le}"')
+                lines.append(f"{self.name}_bucket{bucket_labels} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.labels, label_values)} {values[-1]}")
+            lines.append(f"{self.name}_count{_labels(self.labels, label_values)} {cumulative}")
+        return lines
+
+
+class RequestStats:
+    # SQL activity of one request, filled in by the engine events below
+    __slots__ = ("statements", "db_seconds", "captured")
+
+    def __init__(self, capture: bool):
+        self.statements = 0
+        self.db_seconds = 0.0
+        self.captured: Optional[list[str]] = [] if capture else None
+
+
+current_request: ContextVar[Optional[RequestStats]] = ContextVar("current_request", default=None)
+
+request_duration = Histogram("http_request_duration_seconds", "Time spent serving HTTP requests.", ("method", "route", "status"))
+request_statements = Histogram(
+    "db_statements_per_request", "SQL statements executed per HTTP request.", ("route",), STATEMENT_BUCKETS
+)
+request_db_time = Histogram("db_time_per_request_seconds", "Time spent in SQL statements per HTTP request.", ("route",))
+bcrypt_duration = Histogram("bcrypt_duration_seconds", "Time spent hashing or verifying a password in a worker.", ("operation",))
+rating_queue_wait = Histogram("rating_queue_wait_seconds", "Time match submissions waited in the outbox for the rating writer.")
+rating_submission_duration = Histogram(
+    "rating_submission_duration_seconds", "Time from submitting a match to its ratings being committed."
+)
+rating_batch_size = Histogram("rating_batch_size", "Matches rated in one rating writer transaction.", (), BATCH_BUCKETS)
+
+_totals_lock = threading.Lock()
+_totals = {"statements": 0, "db_seconds": 0.0}
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_started", []).append(time.perf_counter())
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info["query_started"].pop()
+    with _totals_lock:
+        _totals["statements"] += 1
+        _totals["db_seconds"] += elapsed
+    stats = current_request.get()
+    if stats is not None:
+        stats.statements += 1
+        stats.db_seconds += elapsed
+        if stats.captured is not None:
+            stats.captured.append(f"{elapsed * 1000:.1f} ms  {statement}")
+
+def instrument_engine(engine):
+    event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(engine, "after_cursor_execute", _after_cursor_execute)
+
+
+class MetricsMiddleware:
+    # Pure ASGI so streamed bodies are included in the timing, the route template is known once the app has run
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        stats = RequestStats(capture=SLOW_REQUEST_SECONDS is not None)
+        token = current_request.set(stats)
+        status_code = 500
+        started = time.perf_counter()
+
+        async def send_with_status(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            elapsed = time.perf_counter() - started
+            current_request.reset(token)
+            route = scope.get("route")
+            # Unmatched paths share one label, so scanners can't blow up the number of series
+            route_path = route.path if route is not None else "unmatched"
+            request_duration.observe(elapsed, scope["method"], route_path, status_code)
+            request_statements.observe(stats.statements, route_path)
+            request_db_time.observe(stats.db_seconds, route_path)
+            if SLOW_REQUEST_SECONDS is not None and elapsed >= SLOW_REQUEST_SECONDS:
+                logger.warning(
+                    "Slow request %s %s: %.1f ms, %d statements, %.1f ms in the database\n%s",
+                    scope["method"], scope["path"], elapsed * 1000, stats.statements, stats.db_seconds * 1000,
+                    "\n".join(stats.captured)
+                )
+
+
+def metric(name: str, help: str, type: str, *samples: tuple[dict, float]) -> list[str]:
+    # One metric in the text format, samples are (labels, value) pairs
+    lines = [f"# HELP {name} {help}", f"# TYPE {name} {type}"]
+    for labels, value in samples:
+        lines.append(f"{name}{_labels(tuple(labels), tuple(labels.values()))} {value}")
+    return lines
+
+def _pool_metrics(engine) -> list[str]:
+    pool = engine.pool
+    lines = []
+    for name, help, attribute in (
+        ("db_pool_size", "Configured size of the connection pool.", "size"),
+        ("db_pool_checked_out", "Connections currently in use.", "checkedout"),
+        ("db_pool_checked_in", "Idle connections in the pool.", "checkedin"),
+        ("db_pool_overflow", "Connections opened beyond the pool size.", "overflow"),
+    ):
+        # Not every pool class (e.g. the one used for SQLite memory databases) keeps all of these
+        if hasattr(pool, attribute):
+            lines += metric(name, help, "gauge", ({}, getattr(pool, attribute)()))
+    return lines
+
+
+def render_metrics(engine, collectors: list[Callable[[], list[str]]] = ()) -> str:
+    lines = []
+    for histogram in (
+        request_duration, request_statements, request_db_time, bcrypt_duration,
+        rating_queue_wait, rating_submission_duration, rating_batch_size
+    ):
+        lines += histogram.render()
+    with _totals_lock:
+        totals = dict(_totals)
+    lines += metric("db_statements_total", "SQL statements executed.", "counter", ({}, totals["statements"]))
+    lines += metric("db_time_seconds_total", "Time spent in SQL statements.", "counter", ({}, totals["db_seconds"]))
+    lines += _pool_metrics(engine)
+    for collector in collectors:
+        lines += collector()
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,141 @@
+from datetime import date, timedelta
+from itertools import combinations
+from typing import Optional
+from sqlalchemy import and_, select
+from sqlalchemy.orm import Session, aliased
+from app.crud.match import validate_match_players
+from app.models.models import Match, MatchParticipant, User
+from app.rating.engines import DEFAULT_RATING, RatingState, rating_engine
+
+# Playing with a recent partner again outweighs any imbalance, (p - 0.5)² is at most 0.25
+REPEAT_PARTNER_PENALTY = 1.0
+# Rounds of swaps between courts, the search usually settles after a handful
+MAX_ROUNDS = 50
+# Courts only swap with this many courts after them in rating order, which keeps a round linear in the courts
+SWAP_WINDOW = 3
+# Positions within each of the two courts that trade places: every single player, then every pair
+SWAPS = [((x,), (y,)) for x in range(4) for y in range(4)] + [
+    (xs, ys) for xs in combinations(range(4), 2) for ys in combinations(range(4), 2)
+]
+
+
+def load_players(db: Session, user_ids: list[int]) -> tuple[list, RatingState]:
+    # One query for every player, positions in the state follow user_ids
+    if len(set(user_ids)) != len(user_ids):
+        raise ValueError("Every player can only be listed once")
+    rows = {
+        row.id: row
+        for row in db.execute(select(User.id, User.username, User.rating, User.rating_deviation).where(User.id.in_(user_ids)))
+    }
+    if len(rows) != len(user_ids):
+        raise ValueError("All players must be registered users")
+
+    players = [rows[user_id] for user_id in user_ids]
+    state = rating_engine.new_state(len(players))
+    for i, player in enumerate(players):
+        state.ratings[i] = player.rating if player.rating is not None else DEFAULT_RATING
+        if player.rating_deviation is not None:
+            state.deviations[i] = player.rating_deviation
+    return players, state
+
+def recent_partners(db: Session, user_ids: list[int], since: date) -> set[tuple[int, int]]:
+    # Pairs of these users who were on the same side of a match played since then, smaller id first
+    partner = aliased(MatchParticipant)
+    rows = db.execute(
+        select(MatchParticipant.user_id, partner.user_id)
+        .join(partner, and_(
+            partner.match_id == MatchParticipant.match_id,
+            partner.side == MatchParticipant.side,
+            partner.user_id > MatchParticipant.user_id,
+        ))
+        .join(Match, Match.id == MatchParticipant.match_id)
+        .where(MatchParticipant.user_id.in_(user_ids), partner.user_id.in_(user_ids), Match.date_played >= since)
+    )
+    return {(user_id, partner_id) for user_id, partner_id in rows}
+
+def _court_cost(state: RatingState, court: tuple, partners: set[tuple[int, int]]) -> tuple:
+    # The best of the three ways to split four players, court is sorted so every pair has its smaller position first
+    a, b, c, d = court
+    best = None
+    for team, opponents in (((a, b), (c, d)), ((a, c), (b, d)), ((a, d), (b, c))):
+        probability = rating_engine.win_probability(state, team, opponents)
+        repeats = (team in partners) + (opponents in partners)
+        cost = (probability - 0.5) ** 2 + REPEAT_PARTNER_PENALTY * repeats
+        if best is None or cost < best[0]:
+            best = (cost, team, opponents, probability, repeats)
+    return best
+
+def balance_courts(state: RatingState, n_courts: int, partners: set[tuple[int, int]]) -> list[tuple]:
+    # Local search over the first n_courts * 4 positions. It starts from courts of neighbouring ratings and swaps
+    # players or pairs between nearby courts while that lowers the total cost, every court is only ever rated once.
+    costs = {}
+
+    def cost(court: list[int]) -> tuple:
+        key = tuple(sorted(court))
+        if key not in costs:
+            costs[key] = _court_cost(state, key, partners)
+        return costs[key]
+
+    order = sorted(range(n_courts * 4), key=lambda u: -state.ratings[u])
+    courts = [order[i:i + 4] for i in range(0, len(order), 4)]
+    for _ in range(MAX_ROUNDS):
+        improved = False
+        for i in range(n_courts):
+            for j in range(i + 1, min(i + 1 + SWAP_WINDOW, n_courts)):
+                for xs, ys in SWAPS:
+                    court_i, court_j = courts[i], courts[j]
+                    swapped_i = [u for k, u in enumerate(court_i) if k not in xs] + [court_j[k] for k in ys]
+                    swapped_j = [u for k, u in enumerate(court_j) if k not in ys] + [court_i[k] for k in xs]
+                    if cost(swapped_i)[0] + cost(swapped_j)[0] < cost(court_i)[0] + cost(court_j)[0] - 1e-12:
+                        courts[i], courts[j] = swapped_i, swapped_j
+                        improved = True
+        if not improved:
+            break
+    return [cost(court) for court in courts]
+
+def _player(row) -> dict:
+    return {"id": row.id, "username": row.username, "rating": row.rating}
+
+def crud_predict_match(db: Session, team_a: list[int], team_b: list[int]) -> dict:
+    # Doubles only, the engines average each side and an empty one has no rating
+    if len(team_a) != 2 or len(team_b) != 2:
+        raise ValueError("Each team must have exactly 2 players")
+    validate_match_players(team_a, team_b)
+    players, state = load_players(db, team_a + team_b)
+    positions = list(range(len(players)))
+    return {
+        "team_a": [_player(row) for row in players[:len(team_a)]],
+        "team_b": [_player(row) for row in players[len(team_a):]],
+        "win_probability": rating_engine.win_probability(state, positions[:len(team_a)], positions[len(team_a):]),
+        "engine": rating_engine.name,
+    }
+
+def crud_balance_courts(db: Session, user_ids: list[int], avoid_partners_days: Optional[int] = None) -> dict:
+    # Players past the last full court sit out in the order given, so the caller decides who rotates out
+    if len(user_ids) < 4:
+        raise ValueError("At least 4 players are needed for a court")
+    players, state = load_players(db, user_ids)
+    n_courts = len(players) // 4
+
+    partners = set()
+    if avoid_partners_days is not None:
+        positions = {row.id: i for i, row in enumerate(players[:n_courts * 4])}
+        since = date.today() - timedelta(days=avoid_partners_days)
+        partners = {
+            tuple(sorted((positions[user_id], positions[partner_id])))
+            for user_id, partner_id in recent_partners(db, list(positions), since)
+        }
+
+    return {
+        "courts": [
+            {
+                "team_a": [_player(players[u]) for u in team],
+                "team_b": [_player(players[u]) for u in opponents],
+                "win_probability": probability,
+                "repeat_partners": repeats,
+            }
+            for _, team, opponents, probability, repeats in balance_courts(state, n_courts, partners)
+        ],
+        "sitting_out": [_player(row) for row in players[n_courts * 4:]],
+        "engine": rating_engine.name,
+    }
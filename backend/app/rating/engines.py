@@ -0,0 +1,374 @@
+import math
+import os
+from abc import ABC, abstractmethod
+from array import array
+from dataclasses import dataclass
+from datetime import date
+from typing import Optional
+from dotenv import load_dotenv
+
+load_dotenv()
+
+DEFAULT_RATING = 1000
+# elo, glicko2 or gaussian. Switching engines needs a full replay (python -m app.rating.replay) to recompute history.
+RATING_ENGINE = os.getenv("RATING_ENGINE", "elo")
+# Length of a Glicko-2 rating period, every match of a period is rated from the ratings at its start
+RATING_PERIOD_DAYS = int(os.getenv("RATING_PERIOD_DAYS", "7"))
+
+
+@dataclass
+class RatingState:
+    # Per-user arrays addressed by position. Deviation and volatility are only used by the engines that track them,
+    # last_periods is the rating period of a user's last match, -1 before the first one.
+    ratings: array
+    deviations: array
+    volatilities: array
+    last_periods: array
+
+
+@dataclass
+class Teams:
+    # Team members of match m are winner_idx[winner_ptr[m]:winner_ptr[m + 1]] (same for losers), as user positions
+    winner_ptr: array
+    winner_idx: array
+    loser_ptr: array
+    loser_idx: array
+
+
+@dataclass
+class RatingResult:
+    # Per match
+    winner_avg_ratings: array
+    loser_avg_ratings: array
+    changes_winner: array
+    changes_loser: array
+    # Per team member, aligned with winner_idx / loser_idx. The state before is the one stored on the snapshot.
+    winner_ratings_before: array
+    loser_ratings_before: array
+    winner_deltas: array
+    loser_deltas: array
+    winner_deviations_before: array
+    loser_deviations_before: array
+    winner_volatilities_before: array
+    loser_volatilities_before: array
+
+    @classmethod
+    def empty(cls, teams: Teams) -> "RatingResult":
+        n_matches = len(teams.winner_ptr) - 1
+        per_match = [array('d', [0.0]) * n_matches for _ in range(4)]
+        per_member = [array('d', [0.0]) * len(idx) for _ in range(4) for idx in (teams.winner_idx, teams.loser_idx)]
+        return cls(*per_match, *per_member)
+
+
+def build_teams(teams_per_match: list[tuple[list[int], list[int]]]) -> Teams:
+    # CSR layout from (winner positions, loser positions) per match
+    teams = Teams(array('q', [0]), array('q'), array('q', [0]), array('q'))
+    for winners, losers in teams_per_match:
+        teams.winner_idx.extend(winners)
+        teams.winner_ptr.append(len(teams.winner_idx))
+        teams.loser_idx.extend(losers)
+        teams.loser_ptr.append(len(teams.loser_idx))
+    return teams
+
+
+def expected_score(avg_rating: float, opponent_avg_rating: float) -> float:
+    return 1 / (1 + 10 ** ((opponent_avg_rating - avg_rating) / 400))
+
+
+def calculate_rating_change(winner_avg_rating: float, loser_avg_rating: float):
+    k_factor = 32
+    expected_score_winner = expected_score(winner_avg_rating, loser_avg_rating)
+    expected_score_loser = expected_score(loser_avg_rating, winner_avg_rating)
+
+    actual_score_winner = 1
+    actual_score_loser = 0
+
+    elo_change_winner = k_factor * (actual_score_winner - expected_score_winner)
+    elo_change_loser = k_factor * (actual_score_loser - expected_score_loser)
+
+    return elo_change_winner, elo_change_loser
+
+
+class RatingEngine(ABC):
+    name = ""
+    # Days per rating period, 0 rates every match on its own right after the previous one
+    period_days = 0
+    default_deviation: Optional[float] = None
+    default_volatility: Optional[float] = None
+
+    def new_state(self, n_users: int) -> RatingState:
+        return RatingState(
+            array('d', [DEFAULT_RATING]) * n_users,
+            array('d', [self.default_deviation or 0.0]) * n_users,
+            array('d', [self.default_volatility or 0.0]) * n_users,
+            array('q', [-1]) * n_users,
+        )
+
+    def period_of(self, date_played: date) -> int:
+        return date_played.toordinal() // self.period_days if self.period_days else date_played.toordinal()
+
+    def period_start(self, date_played: date) -> date:
+        # First day of the rating period date_played falls in
+        if not self.period_days:
+            return date_played
+        return date.fromordinal(self.period_of(date_played) * self.period_days)
+
+    def align(self, start_date: date, start_id: Optional[int]) -> tuple[date, Optional[int]]:
+        # A re-rate has to start where a rating period starts, from (date, 0) every match of that date is included
+        if not self.period_days:
+            return start_date, start_id
+        return self.period_start(start_date), 0
+
+    @abstractmethod
+    def rate_period(self, state: RatingState, teams: Teams, start: int, stop: int, period: int, result: RatingResult):
+        # Rates matches start..stop-1 of teams, all in the given period, updating state and filling result in place
+        ...
+
+    @abstractmethod
+    def win_probability(self, state: RatingState, team: list[int], opponents: list[int]) -> float:
+        # Chance that team, as user positions in state, beats opponents
+        ...
+
+    def rate(self, state: RatingState, teams: Teams, periods: array, result: RatingResult):
+        # The matches are in played order, every run of one period is rated in a single batch
+        n_matches = len(teams.winner_ptr) - 1
+        if not self.period_days:
+            if n_matches:
+                self.rate_period(state, teams, 0, n_matches, periods[0], result)
+            return
+        start = 0
+        for m in range(1, n_matches + 1):
+            if m == n_matches or periods[m] != periods[start]:
+                self.rate_period(state, teams, start, m, periods[start], result)
+                start = m
+
+
+class EloEngine(RatingEngine):
+    # K=32 Elo on the average rating of each team, every member gains or loses the same amount
+    name = "elo"
+
+    def rate_period(self, state: RatingState, teams: Teams, start: int, stop: int, period: int, result: RatingResult):
+        ratings = state.ratings
+        winner_ptr, winner_idx = teams.winner_ptr, teams.winner_idx
+        loser_ptr, loser_idx = teams.loser_ptr, teams.loser_idx
+        rating_change = calculate_rating_change
+
+        for m in range(start, stop):
+            winners = winner_idx[winner_ptr[m]:winner_ptr[m + 1]]
+            losers = loser_idx[loser_ptr[m]:loser_ptr[m + 1]]
+            if not winners or not losers:
+                continue
+
+            winner_avg_rating = sum([ratings[u] for u in winners]) / len(winners)
+            loser_avg_rating = sum([ratings[u] for u in losers]) / len(losers)
+            change_winner, change_loser = rating_change(winner_avg_rating, loser_avg_rating)
+
+            for ptr, idx, before, deltas, change in (
+                (winner_ptr, winner_idx, result.winner_ratings_before, result.winner_deltas, change_winner),
+                (loser_ptr, loser_idx, result.loser_ratings_before, result.loser_deltas, change_loser),
+            ):
+                for i in range(ptr[m], ptr[m + 1]):
+                    u = idx[i]
+                    before[i] = ratings[u]
+                    deltas[i] = change
+                    ratings[u] += change
+
+            result.winner_avg_ratings[m] = winner_avg_rating
+            result.loser_avg_ratings[m] = loser_avg_rating
+            result.changes_winner[m] = change_winner
+            result.changes_loser[m] = change_loser
+
+    def win_probability(self, state: RatingState, team: list[int], opponents: list[int]) -> float:
+        ratings = state.ratings
+        return expected_score(sum([ratings[u] for u in team]) / len(team), sum([ratings[u] for u in opponents]) / len(opponents))
+
+
+class Glicko2Engine(RatingEngine):
+    # Glicko-2 with rating periods. Every player is rated against the opposing team as one composite opponent,
+    # its mean rating and root-mean-square deviation, using the ratings from the start of the period.
+    name = "glicko2"
+    scale = 173.7178
+    default_deviation = 350.0
+    default_volatility = 0.06
+    # System constant, smaller values keep the volatility from moving much
+    tau = 0.5
+    epsilon = 1e-6
+
+    def __init__(self, period_days: int):
+        self.period_days = max(period_days, 1)
+
+    def _g(self, phi: float) -> float:
+        return 1 / math.sqrt(1 + 3 * phi * phi / (math.pi * math.pi))
+
+    def _volatility(self, phi: float, sigma: float, v: float, delta: float) -> float:
+        # Illinois iteration from step 5 of the Glicko-2 paper
+        a = math.log(sigma * sigma)
+        tau2 = self.tau * self.tau
+
+        def f(x):
+            ex = math.exp(x)
+            return ex * (delta * delta - phi * phi - v - ex) / (2 * (phi * phi + v + ex) ** 2) - (x - a) / tau2
+
+        upper = a
+        if delta * delta > phi * phi + v:
+            lower = math.log(delta * delta - phi * phi - v)
+        else:
+            k = 1
+            while f(a - k * self.tau) < 0:
+                k += 1
+            lower = a - k * self.tau
+        f_upper, f_lower = f(upper), f(lower)
+        while abs(lower - upper) > self.epsilon:
+            c = upper + (upper - lower) * f_upper / (f_lower - f_upper)
+            f_c = f(c)
+            if f_c * f_lower <= 0:
+                upper, f_upper = lower, f_lower
+            else:
+                f_upper /= 2
+            lower, f_lower = c, f_c
+        return math.exp(upper / 2)
+
+    def rate_period(self, state: RatingState, teams: Teams, start: int, stop: int, period: int, result: RatingResult):
+        ratings, deviations, volatilities, last_periods = state.ratings, state.deviations, state.volatilities, state.last_periods
+        scale = self.scale
+        max_phi = self.default_deviation / scale
+        matches = [
+            (m, teams.winner_idx[teams.winner_ptr[m]:teams.winner_ptr[m + 1]], teams.loser_idx[teams.loser_ptr[m]:teams.loser_ptr[m + 1]])
+            for m in range(start, stop)
+        ]
+        matches = [(m, winners, losers) for m, winners, losers in matches if winners and losers]
+
+        # Everyone is rated from their state at the start of the period, the deviation grown over the periods sat out
+        before = {}
+        players = {}
+        for _, winners, losers in matches:
+            for u in winners + losers:
+                if u not in players:
+                    before[u] = (ratings[u], deviations[u], volatilities[u])
+                    phi = deviations[u] / scale
+                    idle = period - last_periods[u] - 1 if last_periods[u] >= 0 else 0
+                    if idle > 0:
+                        phi = min(math.sqrt(phi * phi + idle * volatilities[u] ** 2), max_phi)
+                    # mu, phi, and the g-weighted score of every game, in match order
+                    players[u] = ((ratings[u] - DEFAULT_RATING) / scale, phi, [], [])
+
+        for _, winners, losers in matches:
+            for team, opponents, score in ((winners, losers, 1.0), (losers, winners, 0.0)):
+                opponent_mu = sum(players[u][0] for u in opponents) / len(opponents)
+                opponent_phi = math.sqrt(sum(players[u][1] ** 2 for u in opponents) / len(opponents))
+                g = self._g(opponent_phi)
+                for u in team:
+                    mu, _, scores, information = players[u]
+                    expected = 1 / (1 + math.exp(-g * (mu - opponent_mu)))
+                    scores.append(g * (score - expected))
+                    information.append(g * g * expected * (1 - expected))
+
+        # Steps 3 to 8 of the paper. The period's change is made of one term per game, each match gets its own term.
+        deltas = {}
+        for u, (mu, phi, scores, information) in players.items():
+            v = 1 / sum(information)
+            score_sum = sum(scores)
+            sigma = self._volatility(phi, volatilities[u], v, v * score_sum)
+            phi_star = math.sqrt(phi * phi + sigma * sigma)
+            new_phi = min(1 / math.sqrt(1 / (phi_star * phi_star) + 1 / v), max_phi)
+            deltas[u] = iter([new_phi * new_phi * score * scale for score in scores])
+            ratings[u] = DEFAULT_RATING + (mu + new_phi * new_phi * score_sum) * scale
+            deviations[u] = new_phi * scale
+            volatilities[u] = sigma
+            last_periods[u] = period
+
+        # Snapshots add up within the period, a match starts where the player's previous one in it ended
+        running = {u: rating for u, (rating, _, _) in before.items()}
+        for m, _, _ in matches:
+            for ptr, idx, ratings_before, member_deltas, deviations_before, volatilities_before, avg_ratings, changes in (
+                (teams.winner_ptr, teams.winner_idx, result.winner_ratings_before, result.winner_deltas,
+                 result.winner_deviations_before, result.winner_volatilities_before, result.winner_avg_ratings, result.changes_winner),
+                (teams.loser_ptr, teams.loser_idx, result.loser_ratings_before, result.loser_deltas,
+                 result.loser_deviations_before, result.loser_volatilities_before, result.loser_avg_ratings, result.changes_loser),
+            ):
+                total_rating = total_delta = 0.0
+                for i in range(ptr[m], ptr[m + 1]):
+                    u = idx[i]
+                    ratings_before[i] = running[u]
+                    member_deltas[i] = next(deltas[u])
+                    running[u] += member_deltas[i]
+                    _, deviations_before[i], volatilities_before[i] = before[u]
+                    total_rating += before[u][0]
+                    total_delta += member_deltas[i]
+                avg_ratings[m] = total_rating / (ptr[m + 1] - ptr[m])
+                changes[m] = total_delta / (ptr[m + 1] - ptr[m])
+
+    def win_probability(self, state: RatingState, team: list[int], opponents: list[int]) -> float:
+        # Both composite players are uncertain, so their deviations combine
+        mus, phis = [], []
+        for members in (team, opponents):
+            mus.append(sum((state.ratings[u] - DEFAULT_RATING) / self.scale for u in members) / len(members))
+            phis.append(sum((state.deviations[u] / self.scale) ** 2 for u in members) / len(members))
+        return 1 / (1 + math.exp(-self._g(math.sqrt(phis[0] + phis[1])) * (mus[0] - mus[1])))
+
+
+class GaussianEngine(RatingEngine):
+    # Two-team TrueSkill-style update without draws. A team performs at the sum of its members' skills, the update
+    # is shared out by each member's own uncertainty, so the player the system knows least about moves the most.
+    name = "gaussian"
+    # TrueSkill's defaults (25, 25/3, 25/6, 25/300) stretched onto the 1000-centered rating scale
+    default_deviation = DEFAULT_RATING / 3
+    beta = DEFAULT_RATING / 6
+    dynamics = DEFAULT_RATING / 300
+    min_variance_factor = 1e-4
+
+    def rate_period(self, state: RatingState, teams: Teams, start: int, stop: int, period: int, result: RatingResult):
+        ratings, deviations, last_periods = state.ratings, state.deviations, state.last_periods
+        beta2 = self.beta * self.beta
+        tau2 = self.dynamics * self.dynamics
+
+        for m in range(start, stop):
+            winners = teams.winner_idx[teams.winner_ptr[m]:teams.winner_ptr[m + 1]]
+            losers = teams.loser_idx[teams.loser_ptr[m]:teams.loser_ptr[m + 1]]
+            if not winners or not losers:
+                continue
+
+            variances = {u: deviations[u] ** 2 + tau2 for u in winners + losers}
+            c = math.sqrt(sum(variances.values()) + len(variances) * beta2)
+            t = (sum(ratings[u] for u in winners) - sum(ratings[u] for u in losers)) / c
+            cdf = 0.5 * math.erfc(-t / math.sqrt(2))
+            # A huge upset underflows the normal cdf, v tends to -t there
+            v = math.exp(-t * t / 2) / math.sqrt(2 * math.pi) / cdf if cdf > 1e-300 else -t
+            w = v * (v + t)
+
+            for ptr, idx, before, deltas, deviations_before, sign, avg_ratings, changes in (
+                (teams.winner_ptr, teams.winner_idx, result.winner_ratings_before, result.winner_deltas,
+                 result.winner_deviations_before, 1, result.winner_avg_ratings, result.changes_winner),
+                (teams.loser_ptr, teams.loser_idx, result.loser_ratings_before, result.loser_deltas,
+                 result.loser_deviations_before, -1, result.loser_avg_ratings, result.changes_loser),
+            ):
+                total_rating = total_delta = 0.0
+                for i in range(ptr[m], ptr[m + 1]):
+                    u = idx[i]
+                    variance = variances[u]
+                    before[i] = ratings[u]
+                    deviations_before[i] = deviations[u]
+                    deltas[i] = sign * variance / c * v
+                    total_rating += ratings[u]
+                    total_delta += deltas[i]
+                    ratings[u] += deltas[i]
+                    deviations[u] = math.sqrt(variance * max(1 - variance / (c * c) * w, self.min_variance_factor))
+                    last_periods[u] = period
+                avg_ratings[m] = total_rating / (ptr[m + 1] - ptr[m])
+                changes[m] = total_delta / (ptr[m + 1] - ptr[m])
+
+    def win_probability(self, state: RatingState, team: list[int], opponents: list[int]) -> float:
+        ratings, deviations = state.ratings, state.deviations
+        variance = sum(deviations[u] ** 2 + self.beta * self.beta for u in team + opponents)
+        t = (sum(ratings[u] for u in team) - sum(ratings[u] for u in opponents)) / math.sqrt(variance)
+        return 0.5 * math.erfc(-t / math.sqrt(2))
+
+
+def get_rating_engine(name: str) -> RatingEngine:
+    engines = {"elo": EloEngine, "glicko2": lambda: Glicko2Engine(RATING_PERIOD_DAYS), "gaussian": GaussianEngine}
+    if name not in engines:
+        raise ValueError(f"Unknown rating engine {name!r}, expected one of {', '.join(engines)}")
+    return engines[name]()
+
+
+rating_engine = get_rating_engine(RATING_ENGINE)
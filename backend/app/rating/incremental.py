@@ -0,0 +1,181 @@
+from array import array
+from datetime import date
+from typing import Optional
+from sqlalchemy import and_, delete, func, insert, or_, select, update
+from sqlalchemy.orm import Session
+from app.cache.responses import RANKING_TAG, RECENT_TAG, response_cache, user_tag
+from app.cache.version import data_version
+from app.crud.statistic import crud_rebuild_user_statistics
+from app.models.models import WINNER, Match, MatchParticipant, RatingSnapshot, User
+from app.rating.engines import RatingResult, build_teams, rating_engine
+from app.rating.leaderboard import leaderboard
+from app.rating.lock import lock_ratings
+from app.rating.replay import crud_replay_ratings
+
+
+def at_or_after(start_date: date, start_id: Optional[int]):
+    # Position filter on the (date_played, id) replay order, start_id None means after every match on start_date
+    if start_id is None:
+        return Match.date_played > start_date
+    return or_(Match.date_played > start_date, and_(Match.date_played == start_date, Match.id >= start_id))
+
+
+def capture_ratings_at(
+    db: Session, start_date: date, start_id: Optional[int], user_ids=()
+) -> Optional[dict[int, tuple[float, Optional[float], Optional[float]]]]:
+    # Rating, deviation and volatility as of a point in history, read from the snapshots of the first matches after it.
+    # Returns None when some of those matches have no snapshots, callers then fall back to a full replay.
+    start_date, start_id = rating_engine.align(start_date, start_id)
+    suffix_ids = select(Match.id).where(at_or_after(start_date, start_id))
+
+    participants = db.execute(select(func.count()).select_from(MatchParticipant).where(MatchParticipant.match_id.in_(suffix_ids))).scalar()
+
+    snapshots = db.execute(
+        select(RatingSnapshot.user_id, RatingSnapshot.rating_before, RatingSnapshot.deviation_before, RatingSnapshot.volatility_before)
+        .join(Match, Match.id == RatingSnapshot.match_id)
+        .where(at_or_after(start_date, start_id))
+        .order_by(Match.date_played.desc(), Match.id.desc())
+    ).all()
+    if len(snapshots) != participants:
+        return None
+
+    # Rows are newest first, so the last write per user is their first match after the cut
+    states = {}
+    for user_id, rating_before, deviation_before, volatility_before in snapshots:
+        states[user_id] = (rating_before, deviation_before, volatility_before)
+
+    # Players without a later match are still at their current state
+    missing = set(user_ids) - states.keys()
+    if missing:
+        states.update(
+            (user_id, (rating, deviation, volatility))
+            for user_id, rating, deviation, volatility in db.execute(
+                select(User.id, User.rating, User.rating_deviation, User.rating_volatility).where(User.id.in_(missing))
+            )
+        )
+    return states
+
+
+def rerate_from(
+    db: Session, start_date: date, start_id: Optional[int], start_ratings: Optional[dict[int, tuple[float, Optional[float], Optional[float]]]]
+) -> int:
+    # Replay only the matches at or after (start_date, start_id), so the cost follows the size of that suffix.
+    # Pending changes are flushed first so the replay sees the edited history.
+    db.flush()
+    lock_ratings(db)
+    if start_ratings is None:
+        crud_replay_ratings(db)
+        return db.query(func.count(Match.id)).scalar()
+
+    start_date, start_id = rating_engine.align(start_date, start_id)
+    matches = db.execute(
+        select(Match.id, Match.date_played)
+        .where(at_or_after(start_date, start_id))
+        .order_by(Match.date_played, Match.id)
+    ).all()
+    suffix_ids = select(Match.id).where(at_or_after(start_date, start_id))
+    teams = {match_id: ([], []) for match_id, _ in matches}
+    participants = db.execute(
+        select(MatchParticipant.match_id, MatchParticipant.user_id, MatchParticipant.side).where(MatchParticipant.match_id.in_(suffix_ids))
+    )
+    for match_id, user_id, side in participants:
+        teams[match_id][0 if side == WINNER else 1].append(user_id)
+
+    states = dict(start_ratings)
+    missing = {user_id for winners, losers in teams.values() for user_id in winners + losers} - states.keys()
+    if missing:
+        states.update(
+            (user_id, (rating, deviation, volatility))
+            for user_id, rating, deviation, volatility in db.execute(
+                select(User.id, User.rating, User.rating_deviation, User.rating_volatility).where(User.id.in_(missing))
+            )
+        )
+
+    # The engine works on positions, users without a stored deviation or volatility start from its defaults
+    user_ids = list(states)
+    user_pos = {user_id: u for u, user_id in enumerate(user_ids)}
+    state = rating_engine.new_state(len(user_ids))
+    for u, user_id in enumerate(user_ids):
+        rating, deviation, volatility = states[user_id]
+        state.ratings[u] = rating
+        if deviation is not None:
+            state.deviations[u] = deviation
+        if volatility is not None:
+            state.volatilities[u] = volatility
+    if rating_engine.period_days:
+        # Deviations grow with the periods sat out since the last match before the cut
+        for user_id, last_played in db.execute(
+            select(RatingSnapshot.user_id, func.max(RatingSnapshot.date_played))
+            .where(RatingSnapshot.user_id.in_(user_ids), RatingSnapshot.date_played < start_date)
+            .group_by(RatingSnapshot.user_id)
+        ):
+            state.last_periods[user_pos[user_id]] = rating_engine.period_of(last_played)
+
+    layout = build_teams([
+        ([user_pos[user_id] for user_id in teams[match_id][0]], [user_pos[user_id] for user_id in teams[match_id][1]])
+        for match_id, _ in matches
+    ])
+    result = RatingResult.empty(layout)
+    rating_engine.rate(state, layout, array('q', [rating_engine.period_of(date_played) for _, date_played in matches]), result)
+
+    tracks_deviation = rating_engine.default_deviation is not None
+    tracks_volatility = rating_engine.default_volatility is not None
+    match_rows = []
+    snapshot_rows = []
+    participant_rows = []
+    for m, (match_id, date_played) in enumerate(matches):
+        if layout.winner_ptr[m] == layout.winner_ptr[m + 1] or layout.loser_ptr[m] == layout.loser_ptr[m + 1]:
+            continue
+
+        for ptr, idx, ratings_before, deltas, deviations_before, volatilities_before in (
+            (layout.winner_ptr, layout.winner_idx, result.winner_ratings_before, result.winner_deltas,
+             result.winner_deviations_before, result.winner_volatilities_before),
+            (layout.loser_ptr, layout.loser_idx, result.loser_ratings_before, result.loser_deltas,
+             result.loser_deviations_before, result.loser_volatilities_before),
+        ):
+            for i in range(ptr[m], ptr[m + 1]):
+                user_id = user_ids[idx[i]]
+                snapshot_rows.append({
+                    "user_id": user_id,
+                    "match_id": match_id,
+                    "rating_before": ratings_before[i],
+                    "rating_after": ratings_before[i] + deltas[i],
+                    "date_played": date_played,
+                    "deviation_before": deviations_before[i] if tracks_deviation else None,
+                    "volatility_before": volatilities_before[i] if tracks_volatility else None
+                })
+                participant_rows.append({"match_id": match_id, "user_id": user_id, "rating_before": ratings_before[i], "rating_delta": deltas[i]})
+
+        match_rows.append({
+            "id": match_id,
+            "winner_avg_rating": result.winner_avg_ratings[m],
+            "loser_avg_rating": result.loser_avg_ratings[m],
+            "elo_change_winner": result.changes_winner[m],
+            "elo_change_loser": result.changes_loser[m]
+        })
+
+    if match_rows:
+        db.execute(update(Match), match_rows)
+    db.execute(delete(RatingSnapshot).where(RatingSnapshot.match_id.in_(suffix_ids)))
+    if snapshot_rows:
+        db.execute(insert(RatingSnapshot), snapshot_rows)
+        db.execute(update(MatchParticipant), participant_rows)
+    ratings = {user_id: state.ratings[u] for u, user_id in enumerate(user_ids)}
+    if ratings:
+        user_rows = [{"id": user_id, "rating": rating} for user_id, rating in ratings.items()]
+        for row in user_rows:
+            u = user_pos[row["id"]]
+            if tracks_deviation:
+                row["rating_deviation"] = state.deviations[u]
+            if tracks_volatility:
+                row["rating_volatility"] = state.volatilities[u]
+        db.execute(update(User), user_rows)
+    # Streaks and peaks of everyone re-rated may have moved, their counters are rebuilt from the cut onward
+    crud_rebuild_user_statistics(db, list(ratings), at_or_after(start_date, start_id))
+    data_version.bump(db)
+    db.commit()
+    leaderboard.update_many(ratings)
+    # Only the re-rated players changed, together with the lists every match shows up in
+    response_cache.invalidate([user_tag(user_id) for user_id in ratings] + [RANKING_TAG, RECENT_TAG])
+
+    return len(matches)
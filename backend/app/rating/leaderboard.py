@@ -0,0 +1,121 @@
+import threading
+from bisect import bisect_left, insort
+from typing import Optional
+from sqlalchemy.orm import Session
+from app.cache.responses import RANKING_TAG, response_cache
+from app.cache.version import data_version
+from app.models.models import User
+
+
+class Leaderboard:
+    # Users sorted by rating in process memory, kept in sync by the code paths that change ratings.
+    # Keys are (-rating, user_id) so the best player comes first and ties are broken by id.
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._keys: list[tuple[float, int]] = []
+        self._ratings: dict[int, float] = {}
+        self._usernames: dict[int, str] = {}
+        # Changes published while a reload reads the users, None for a removed user
+        self._changed: Optional[dict[int, Optional[tuple[float, Optional[str]]]]] = None
+        self.loaded = False
+
+    def load(self, db: Session):
+        # Changes published while the rows are read may be newer than them, they are applied on top
+        with self._lock:
+            self._changed = {}
+        try:
+            rows = db.query(User.id, User.username, User.rating).all()
+            with self._lock:
+                ratings = {user_id: rating or 0 for user_id, _, rating in rows}
+                usernames = {user_id: username for user_id, username, _ in rows}
+                for user_id, change in self._changed.items():
+                    if change is None:
+                        ratings.pop(user_id, None)
+                        usernames.pop(user_id, None)
+                    else:
+                        ratings[user_id] = change[0] or 0
+                        if change[1]:
+                            usernames[user_id] = change[1]
+                self._ratings, self._usernames = ratings, usernames
+                self._keys = sorted((-rating, user_id) for user_id, rating in ratings.items())
+                self.loaded = True
+        finally:
+            with self._lock:
+                self._changed = None
+
+    def reload(self, db: Session):
+        # Ratings changed by another worker's rating writer, the cached ranking was rendered from the old order
+        self.load(db)
+        response_cache.invalidate([RANKING_TAG])
+
+    def ensure_loaded(self, db: Session):
+        if not self.loaded:
+            self.load(db)
+
+    def _set(self, user_id: int, rating: float):
+        if user_id in self._ratings:
+            del self._keys[bisect_left(self._keys, (-self._ratings[user_id], user_id))]
+        self._ratings[user_id] = rating or 0
+        insort(self._keys, (-self._ratings[user_id], user_id))
+
+    def update(self, user_id: int, rating: float, username: Optional[str] = None):
+        self.update_many({user_id: rating}, {user_id: username} if username else None)
+
+    def update_many(self, ratings: dict[int, float], usernames: Optional[dict[int, str]] = None):
+        # Before the first load there is nothing to keep in sync, load() reads the committed state
+        if not self.loaded:
+            return
+        with self._lock:
+            for user_id, rating in ratings.items():
+                self._set(user_id, rating)
+                if self._changed is not None:
+                    self._changed[user_id] = (rating, (usernames or {}).get(user_id))
+            if usernames:
+                self._usernames.update(usernames)
+
+    def remove(self, user_id: int):
+        if not self.loaded:
+            return
+        with self._lock:
+            if self._changed is not None:
+                self._changed[user_id] = None
+            rating = self._ratings.pop(user_id, None)
+            if rating is not None:
+                del self._keys[bisect_left(self._keys, (-rating, user_id))]
+                self._usernames.pop(user_id, None)
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def rank(self, user_id: int) -> Optional[dict]:
+        with self._lock:
+            rating = self._ratings.get(user_id)
+            if rating is None:
+                return None
+            position = bisect_left(self._keys, (-rating, user_id))
+            return self._entries(position, position + 1)[0] | {"total": len(self._keys)}
+
+    def _entries(self, start: int, stop: int) -> list[dict]:
+        return [
+            {"id": user_id, "username": self._usernames[user_id], "rating": -neg_rating, "rank": start + i + 1}
+            for i, (neg_rating, user_id) in enumerate(self._keys[start:stop])
+        ]
+
+    def page(self, offset: int = 0, limit: Optional[int] = None) -> list[dict]:
+        with self._lock:
+            stop = len(self._keys) if limit is None else offset + limit
+            return self._entries(offset, stop)
+
+    def around(self, user_id: int, radius: int) -> list[dict]:
+        with self._lock:
+            rating = self._ratings.get(user_id)
+            if rating is None:
+                return []
+            position = bisect_left(self._keys, (-rating, user_id))
+            start = max(position - radius, 0)
+            return self._entries(start, position + radius + 1)
+
+
+leaderboard = Leaderboard()
+data_version.on_external_change(leaderboard.reload)
@@ -0,0 +1,12 @@
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+
+# Any constant works as long as every worker uses the same one
+RATING_LOCK_KEY = 4_271_903
+
+
+def lock_ratings(db: Session):
+    # Ratings are read, changed in Python and written back, so the writers of all workers take turns until their
+    # transaction ends. On PostgreSQL that is a transaction-level advisory lock, SQLite only allows one writer anyway.
+    if db.get_bind().dialect.name == "postgresql":
+        db.execute(text("SELECT pg_advisory_xact_lock(:key)"), {"key": RATING_LOCK_KEY})
@@ -0,0 +1,207 @@
+import argparse
+from array import array
+from dataclasses import dataclass
+from datetime import date
+from itertools import islice
+from typing import Iterable, Iterator
+from sqlalchemy import delete, insert, select, update
+from sqlalchemy.orm import Session
+from app.cache.responses import response_cache
+from app.cache.version import data_version
+from app.crud.statistic import crud_rebuild_pair_statistics, crud_rebuild_user_statistics
+from app.database.database import SessionLocal
+from app.models.models import LOSER, WINNER, Match, MatchParticipant, RatingSnapshot, User
+from app.rating.engines import RatingResult, RatingState, Teams, rating_engine
+from app.rating.leaderboard import leaderboard
+from app.rating.lock import lock_ratings
+
+WRITE_CHUNK_SIZE = 10000
+
+
+@dataclass
+class MatchHistory:
+    # Users and matches are addressed by position, matches are in (date_played, id) order
+    user_ids: array
+    match_ids: array
+    # date_played of every match as a proleptic ordinal
+    match_dates: array
+    winner_scores: array
+    loser_scores: array
+    # Team members of match m are winner_idx[winner_ptr[m]:winner_ptr[m + 1]] (same for losers)
+    winner_ptr: array
+    winner_idx: array
+    loser_ptr: array
+    loser_idx: array
+
+
+def _build_team_index(rows, match_pos: dict, user_pos: dict, n_matches: int) -> tuple[array, array]:
+    # Bucket (match_id, user_id) rows into a CSR layout keyed by match position
+    teams = [[] for _ in range(n_matches)]
+    for match_id, user_id in rows:
+        m = match_pos.get(match_id)
+        u = user_pos.get(user_id)
+        if m is not None and u is not None:
+            teams[m].append(u)
+
+    ptr = array('q', [0]) * (n_matches + 1)
+    idx = array('q')
+    for m, team in enumerate(teams):
+        idx.extend(team)
+        ptr[m + 1] = len(idx)
+    return ptr, idx
+
+
+def load_match_history(db: Session) -> MatchHistory:
+    user_ids = array('q', db.execute(select(User.id).order_by(User.id)).scalars())
+    user_pos = {user_id: u for u, user_id in enumerate(user_ids)}
+
+    match_ids = array('q')
+    match_dates = array('l')
+    winner_scores = array('q')
+    loser_scores = array('q')
+    rows = db.execute(
+        select(Match.id, Match.date_played, Match.winner_score, Match.loser_score)
+        .order_by(Match.date_played, Match.id)
+        .execution_options(yield_per=WRITE_CHUNK_SIZE)
+    )
+    for match_id, date_played, winner_score, loser_score in rows:
+        match_ids.append(match_id)
+        match_dates.append(date_played.toordinal())
+        winner_scores.append(winner_score or 0)
+        loser_scores.append(loser_score or 0)
+    match_pos = {match_id: m for m, match_id in enumerate(match_ids)}
+
+    teams = []
+    for side in (WINNER, LOSER):
+        rows = db.execute(
+            select(MatchParticipant.match_id, MatchParticipant.user_id)
+            .where(MatchParticipant.side == side)
+            .execution_options(yield_per=WRITE_CHUNK_SIZE)
+        )
+        teams.append(_build_team_index(rows, match_pos, user_pos, len(match_ids)))
+    (winner_ptr, winner_idx), (loser_ptr, loser_idx) = teams
+
+    return MatchHistory(user_ids, match_ids, match_dates, winner_scores, loser_scores, winner_ptr, winner_idx, loser_ptr, loser_idx)
+
+
+def replay_ratings(history: MatchHistory) -> tuple[RatingState, RatingResult]:
+    # Everyone starts from the engine's defaults, the whole history is rated one rating period per batch
+    state = rating_engine.new_state(len(history.user_ids))
+    teams = Teams(history.winner_ptr, history.winner_idx, history.loser_ptr, history.loser_idx)
+    result = RatingResult.empty(teams)
+    periods = array('q', (rating_engine.period_of(date.fromordinal(ordinal)) for ordinal in history.match_dates))
+    rating_engine.rate(state, teams, periods, result)
+    return state, result
+
+
+def _write_in_chunks(db: Session, statement, params: Iterable[dict]):
+    # Rows are built as they are written, only one chunk of them is held at a time
+    params = iter(params)
+    while chunk := list(islice(params, WRITE_CHUNK_SIZE)):
+        db.execute(statement, chunk)
+
+
+def _snapshot_rows(history: MatchHistory, result: RatingResult) -> Iterator[dict]:
+    tracks_deviation = rating_engine.default_deviation is not None
+    tracks_volatility = rating_engine.default_volatility is not None
+    teams = (
+        (history.winner_ptr, history.winner_idx, result.winner_ratings_before, result.winner_deltas,
+         result.winner_deviations_before, result.winner_volatilities_before),
+        (history.loser_ptr, history.loser_idx, result.loser_ratings_before, result.loser_deltas,
+         result.loser_deviations_before, result.loser_volatilities_before),
+    )
+    for ptr, idx, ratings_before, deltas, deviations_before, volatilities_before in teams:
+        for m in range(len(history.match_ids)):
+            # Matches with a missing side are not rated
+            if history.winner_ptr[m] == history.winner_ptr[m + 1] or history.loser_ptr[m] == history.loser_ptr[m + 1]:
+                continue
+            date_played = date.fromordinal(history.match_dates[m])
+            for i in range(ptr[m], ptr[m + 1]):
+                yield {
+                    "user_id": history.user_ids[idx[i]],
+                    "match_id": history.match_ids[m],
+                    "rating_before": ratings_before[i],
+                    "rating_after": ratings_before[i] + deltas[i],
+                    "date_played": date_played,
+                    "deviation_before": deviations_before[i] if tracks_deviation else None,
+                    "volatility_before": volatilities_before[i] if tracks_volatility else None
+                }
+
+
+def crud_replay_ratings(db: Session, dry_run: bool = False, tolerance: float = 1e-6) -> list[tuple[int, float, float]]:
+    if not dry_run:
+        lock_ratings(db)
+    history = load_match_history(db)
+    state, result = replay_ratings(history)
+
+    current = dict(db.execute(select(User.id, User.rating)).all())
+    diff = [
+        (user_id, current[user_id] or 0, state.ratings[u])
+        for u, user_id in enumerate(history.user_ids)
+        if abs((current[user_id] or 0) - state.ratings[u]) > tolerance
+    ]
+    if dry_run:
+        return diff
+
+    # Bulk UPDATE ... WHERE id = ? executemany, all in one transaction. Users who never played, or played under an
+    # engine without deviations, are back at the engine's defaults.
+    played = {history.user_ids[u] for idx in (history.winner_idx, history.loser_idx) for u in idx}
+    _write_in_chunks(db, update(User), (
+        {
+            "id": user_id,
+            "rating": state.ratings[u],
+            "rating_deviation": state.deviations[u] if rating_engine.default_deviation is not None and user_id in played else None,
+            "rating_volatility": state.volatilities[u] if rating_engine.default_volatility is not None and user_id in played else None
+        }
+        for u, user_id in enumerate(history.user_ids)
+    ))
+    _write_in_chunks(db, update(Match), (
+        {
+            "id": history.match_ids[m],
+            "winner_avg_rating": result.winner_avg_ratings[m],
+            "loser_avg_rating": result.loser_avg_ratings[m],
+            "elo_change_winner": result.changes_winner[m],
+            "elo_change_loser": result.changes_loser[m]
+        }
+        for m in range(len(history.match_ids))
+    ))
+
+    # Snapshots are rebuilt from scratch so later incremental re-rating can start from them. Each pass generates the
+    # rows again from the result arrays instead of keeping them around.
+    db.execute(delete(RatingSnapshot))
+    _write_in_chunks(db, insert(RatingSnapshot), _snapshot_rows(history, result))
+    _write_in_chunks(db, update(MatchParticipant), (
+        {"match_id": row["match_id"], "user_id": row["user_id"], "rating_before": row["rating_before"], "rating_delta": row["rating_after"] - row["rating_before"]}
+        for row in _snapshot_rows(history, result)
+    ))
+    crud_rebuild_user_statistics(db)
+    crud_rebuild_pair_statistics(db)
+    data_version.bump(db)
+    db.commit()
+    leaderboard.update_many({user_id: state.ratings[u] for u, user_id in enumerate(history.user_ids)})
+    response_cache.clear()
+
+    return diff
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Recompute every rating from the full match history with the configured engine")
+    parser.add_argument("--dry-run", action="store_true", help="only print the ratings that would change")
+    parser.add_argument("--show", type=int, default=20, help="number of changed ratings to print")
+    args = parser.parse_args()
+
+    db = SessionLocal()
+    try:
+        diff = crud_replay_ratings(db, dry_run=args.dry_run)
+    finally:
+        db.close()
+
+    diff.sort(key=lambda row: abs(row[2] - row[1]), reverse=True)
+    for user_id, old_rating, new_rating in diff[:args.show]:
+        print(f"user {user_id}: {old_rating:.2f} -> {new_rating:.2f} ({new_rating - old_rating:+.2f})")
+    action = "would change" if args.dry_run else "changed"
+    print(f"{len(diff)} ratings {action}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,242 @@
+import logging
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import Optional
+from sqlalchemy import delete, func, select, update
+from sqlalchemy.orm import Session
+from dotenv import load_dotenv
+from app.cache.version import data_version
+from app.crud.match import SubmissionHandled, append_match, crud_create_match, get_match_players, is_back_dated, mark_processed, publish_ratings, utc_now
+from app.database.database import SessionLocal
+from app.models.models import DONE, FAILED, PENDING, Match, MatchOutbox
+from app.monitoring.metrics import rating_batch_size, rating_queue_wait, rating_submission_duration
+from app.rating.lock import lock_ratings
+from app.schemas.schemas import MatchCreate
+
+load_dotenv()
+
+# Most submissions rated and committed together
+RATING_BATCH_SIZE = int(os.getenv("RATING_BATCH_SIZE", "64"))
+# How often the outbox is checked without a wake-up, picks up retries and whatever a restart left behind
+RATING_POLL_SECONDS = float(os.getenv("RATING_POLL_SECONDS", "1"))
+# A submission that keeps failing is retried with a doubling delay, then given up on
+RATING_MAX_ATTEMPTS = int(os.getenv("RATING_MAX_ATTEMPTS", "5"))
+RATING_RETRY_SECONDS = float(os.getenv("RATING_RETRY_SECONDS", "2"))
+# Processed submissions stay around this long for the status endpoint
+RATING_OUTBOX_RETENTION_HOURS = float(os.getenv("RATING_OUTBOX_RETENTION_HOURS", "24"))
+
+WRITER_THREAD_NAME = "rating-writer"
+
+logger = logging.getLogger(__name__)
+
+
+class RatingWriter:
+    # Works through the match outbox in submission order. Consecutive appended matches share one transaction, the
+    # transactions of all workers take turns through lock_ratings, and every submission is marked done in the same
+    # transaction that rates it. Nothing lives only in memory, a restart picks up where the last run stopped.
+
+    def __init__(self, batch_size: int, poll_seconds: float, max_attempts: int, retry_seconds: float, retention_hours: float):
+        self.batch_size = max(batch_size, 1)
+        self.poll_seconds = poll_seconds
+        self.max_attempts = max(max_attempts, 1)
+        self.retry_seconds = retry_seconds
+        self.retention = timedelta(hours=retention_hours)
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._idle = threading.Event()
+        self._stopping = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._last_cleanup = 0.0
+        self.applied = 0
+        self.failed = 0
+        self.retried = 0
+        self.batches = 0
+        self.commits = 0
+        self.pending = 0
+
+    def start(self):
+        with self._lock:
+            if self._thread is None:
+                self._stopping.clear()
+                self._idle.clear()
+                self._thread = threading.Thread(target=self._run, name=WRITER_THREAD_NAME, daemon=True)
+                self._thread.start()
+
+    def shutdown(self):
+        # The batch in progress is finished, submissions still pending wait in the outbox for the next start
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is not None:
+            self._stopping.set()
+            self._wake.set()
+            thread.join()
+
+    def notify(self):
+        # Called once a submission is committed, so it is rated now instead of at the next poll
+        with self._lock:
+            self._idle.clear()
+            self._wake.set()
+
+    def wait_until_idle(self, timeout: Optional[float] = None) -> bool:
+        # True once every submission made before the call has been worked through
+        return self._idle.wait(timeout)
+
+    def _run(self):
+        while not self._stopping.is_set():
+            self._wake.clear()
+            try:
+                while not self._stopping.is_set() and self._apply_batch():
+                    pass
+                self._tidy_up()
+            except Exception:
+                logger.exception("Rating writer could not work through the outbox")
+            with self._lock:
+                if not self._wake.is_set():
+                    self._idle.set()
+            self._wake.wait(self.poll_seconds)
+
+    def _apply_batch(self) -> bool:
+        # Rates the oldest due submissions, returns False once none are left
+        db = SessionLocal(expire_on_commit=False)
+        group: list[tuple[MatchOutbox, Match]] = []
+        ratings: dict[int, float] = {}
+        failed = 0
+        current = None
+        try:
+            lock_ratings(db)
+            submissions = db.execute(
+                select(MatchOutbox)
+                .where(MatchOutbox.status == PENDING, MatchOutbox.next_attempt_at <= utc_now())
+                .order_by(MatchOutbox.id)
+                .limit(self.batch_size)
+            ).scalars().all()
+            if not submissions:
+                return False
+            started = utc_now()
+            with self._lock:
+                self.batches += 1
+
+            for current in submissions:
+                match = MatchCreate.model_validate(current.payload)
+                try:
+                    winners, losers = get_match_players(db, match.winners, match.losers)
+                except ValueError as e:
+                    # A player was deleted after the submission, retrying would not change that
+                    failed += db.execute(
+                        update(MatchOutbox)
+                        .where(MatchOutbox.id == current.id, MatchOutbox.status == PENDING)
+                        .values(status=FAILED, attempts=MatchOutbox.attempts + 1, error=str(e), processed_at=utc_now())
+                    ).rowcount
+                    continue
+
+                if is_back_dated(db, match.date_played):
+                    if not group:
+                        # Re-rates everything after it and commits, together with the submission
+                        crud_create_match(db, match, current.creator_id, current)
+                        self._record(started, failed, [current])
+                        return True
+                    # Otherwise the appended matches are committed first and this one starts the next batch
+                    break
+
+                db_match = append_match(db, match, current.creator_id, winners, losers)
+                mark_processed(db, current, db_match)
+                group.append((current, db_match))
+                ratings.update((user.id, user.rating) for user in winners + losers)
+            current = None
+
+            if group:
+                data_version.bump(db)
+            db.commit()
+            publish_ratings(ratings)
+            self._record(started, failed, [submission for submission, _ in group])
+            return True
+        except SubmissionHandled:
+            # Another writer got there first, this batch is dropped and the next one reads what is still pending
+            db.rollback()
+            return True
+        except Exception as e:
+            # Only the submission that broke the transaction is held back, the rest are tried again right away
+            db.rollback()
+            culprits = [current.id] if current is not None else [submission.id for submission, _ in group]
+            if not culprits:
+                raise
+            logger.exception("Rating writer failed to apply submissions %s", culprits)
+            self._retry_later(db, culprits, e)
+            return True
+        finally:
+            db.close()
+
+    def _record(self, started: datetime, failed: int, done: list[MatchOutbox]):
+        rating_batch_size.observe(len(done))
+        finished = utc_now()
+        for submission in done:
+            rating_queue_wait.observe((started - submission.created_at).total_seconds())
+            rating_submission_duration.observe((finished - submission.created_at).total_seconds())
+        with self._lock:
+            self.applied += len(done)
+            self.failed += failed
+            self.commits += 1
+
+    def _retry_later(self, db: Session, submission_ids: list[int], error: Exception):
+        lock_ratings(db)
+        now = utc_now()
+        retried = given_up = 0
+        pending = db.execute(
+            select(MatchOutbox.id, MatchOutbox.attempts).where(MatchOutbox.id.in_(submission_ids), MatchOutbox.status == PENDING)
+        ).all()
+        for submission_id, attempts in pending:
+            values = {"attempts": attempts + 1, "error": str(error) or type(error).__name__}
+            if attempts + 1 >= self.max_attempts:
+                values.update(status=FAILED, processed_at=now)
+            else:
+                values["next_attempt_at"] = now + timedelta(seconds=self.retry_seconds * 2 ** attempts)
+            # Only while still pending and unchanged: a writer in another process may have applied or retried it since
+            # it was read, nothing is left to do for this one then
+            updated = db.execute(
+                update(MatchOutbox)
+                .where(MatchOutbox.id == submission_id, MatchOutbox.status == PENDING, MatchOutbox.attempts == attempts)
+                .values(**values)
+            ).rowcount
+            if updated and attempts + 1 >= self.max_attempts:
+                given_up += 1
+            elif updated:
+                retried += 1
+        db.commit()
+        with self._lock:
+            self.retried += retried
+            self.failed += given_up
+
+    def _tidy_up(self):
+        # Between batches: count what is still waiting and, now and then, drop processed submissions past retention
+        db = SessionLocal()
+        try:
+            pending = db.execute(select(func.count()).select_from(MatchOutbox).where(MatchOutbox.status == PENDING)).scalar()
+            if time.monotonic() - self._last_cleanup > 3600:
+                db.execute(delete(MatchOutbox).where(
+                    MatchOutbox.status.in_((DONE, FAILED)), MatchOutbox.processed_at < utc_now() - self.retention
+                ))
+                db.commit()
+                self._last_cleanup = time.monotonic()
+        finally:
+            db.close()
+        with self._lock:
+            self.pending = pending
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "pending": self.pending,
+                "batch_size": self.batch_size,
+                "applied": self.applied,
+                "failed": self.failed,
+                "retried": self.retried,
+                "batches": self.batches,
+                "commits": self.commits,
+            }
+
+
+rating_writer = RatingWriter(
+    RATING_BATCH_SIZE, RATING_POLL_SECONDS, RATING_MAX_ATTEMPTS, RATING_RETRY_SECONDS, RATING_OUTBOX_RETENTION_HOURS
+)
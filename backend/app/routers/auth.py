@@ -1,10 +1,12 @@
 from datetime import timedelta
 from typing import Annotated
 from fastapi import APIRouter, Depends, HTTPException, Request
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
 from starlette import status
-from app.crud.user import crud_create_user
-from app.database.database import get_db
+from app.auth.hashing import hash_password
+from app.crud.user import crud_check_username_available, crud_create_user
+from app.database.database import get_db, get_request_db, run_crud
 from fastapi.security import OAuth2PasswordRequestForm
 from app.schemas.schemas import UserCreate
 from app.auth.utils import ACCESS_TOKEN_EXPIRE_MINUTES, LoginRequest, create_access_token, authenticate_user, Token, get_current_user, revoke_token, oauth2_bearer
@@ -17,7 +19,7 @@ router = APIRouter(
 @router.post("/login", response_model=Token)
 async def login_for_access_token(
     request: Request,
-    db: Session = Depends(get_db)
+    db: Session | AsyncSession = Depends(get_request_db)
 ):
     try:
         data = await request.json()
@@ -25,7 +27,7 @@ async def login_for_access_token(
     except ValueError:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid JSON format")
     
-    user = authenticate_user(login_request.username, login_request.password, db)
+    user = await authenticate_user(login_request.username, login_request.password, db)
     if not user:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid username or password")
     
@@ -36,7 +38,7 @@ async def login_for_access_token(
 @router.post("/register", status_code=status.HTTP_201_CREATED)
 async def create_user(
     request: Request,
-    db: Session = Depends(get_db)
+    db: Session | AsyncSession = Depends(get_request_db)
 ):
     data = await request.json()
     username = data.get('username')
@@ -46,14 +48,16 @@ async def create_user(
 
     user_data = UserCreate(username=username, password=password, bio=bio, picture=picture_name)
     try:
-        db_user = crud_create_user(db, user_data)
+        # A taken name is turned away before it takes up a hashing slot, crud_create_user checks again when inserting
+        await run_crud(db, crud_check_username_available, user_data.username)
+    except Exception as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"User creation failed: {e}")
+    hashed_password = await hash_password(user_data.password)
+    try:
+        # The preset picture name is stored by crud_create_user together with the user
+        db_user = await run_crud(db, crud_create_user, user_data, hashed_password)
     except Exception as e:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"User creation failed: {e}")
-
-    if picture_name:
-        picture_path = f"{picture_name}"
-        db_user.picture = picture_path
-        db.commit()
 
     return db_user
 
@@ -61,9 +65,9 @@ async def create_user(
 @router.post("/token", response_model=Token)
 async def login_for_access_token(
     form_data: Annotated[OAuth2PasswordRequestForm, Depends()],
-    db: Annotated[Session, Depends(get_db)]
+    db: Annotated[Session | AsyncSession, Depends(get_request_db)]
 ):
-    user = authenticate_user(form_data.username, form_data.password, db)
+    user = await authenticate_user(form_data.username, form_data.password, db)
     if not user:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED,
                             detail="Could not validate user.")
@@ -84,7 +88,7 @@ async def get_self(user: dict = Depends(get_current_user)):
 @router.post("/logout")
 def logout(token: str = Depends(oauth2_bearer), db: Session = Depends(get_db)):
     try:
-        revoke_token(token)
+        revoke_token(token, db)
         return {"message": "Successfully logged out"}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
\ No newline at end of file
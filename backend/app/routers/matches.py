@@ -1,9 +1,14 @@
-from fastapi import APIRouter, Depends, HTTPException
+from typing import Optional
+from fastapi import APIRouter, Depends, HTTPException, Query, Request
 from sqlalchemy.orm import Session
+from starlette import status
 from app.auth.utils import get_current_user
-from app.crud.match import crud_create_match, crud_get_match_by_id
-from app.schemas.schemas import Match, MatchCreate
-from app.database.database import get_db
+from app.crud.match import crud_delete_match, crud_get_match_by_id, crud_get_submission, crud_submit_match, crud_update_match
+from app.schemas.schemas import CourtBalance, CourtBalanceResult, Match, MatchCreate, MatchImportResult, MatchPredict, MatchPrediction, MatchSubmission, MatchUpdate
+from app.database.database import get_db, run_crud
+from app.rating.balance import crud_balance_courts, crud_predict_match
+from app.rating.writer import rating_writer
+from app.transfer.match_import import FORMATS, ImportInterrupted, crud_import_matches, read_upload
 
 router = APIRouter(
     prefix="/matches",
@@ -11,20 +16,53 @@ router = APIRouter(
     responses={404: {"description": "Not found"}},
 )
 
-@router.post("/create", response_model=Match)
+@router.post("/create", response_model=MatchSubmission, status_code=status.HTTP_202_ACCEPTED)
 def create_match(match: MatchCreate, db: Session = Depends(get_db), current_user: dict = Depends(get_current_user)):
-    db_match = crud_create_match(db=db, match=match, current_user_id=current_user["id"])
-    
-    # Convert the User objects in winners and losers to their IDs
-    response_match = Match(
-        id=db_match.id,
-        winner_score=db_match.winner_score,
-        loser_score=db_match.loser_score,
-        creator_id=current_user["id"],
-        winners=[user.id for user in db_match.winners],
-        losers=[user.id for user in db_match.losers]
-    )
-    return response_match
+    # Only the submission is stored here, the rating writer creates and rates the match right after
+    try:
+        submission = crud_submit_match(db, match, current_user["id"])
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    rating_writer.notify()
+
+    return submission
+
+@router.get("/submissions/{submission_id}", response_model=MatchSubmission)
+def get_match_submission(submission_id: int, db: Session = Depends(get_db)):
+    submission = crud_get_submission(db, submission_id)
+    if not submission:
+        raise HTTPException(status_code=404, detail="Submission not found")
+
+    return submission
+
+@router.post("/predict", response_model=MatchPrediction)
+def predict_match(match: MatchPredict, db: Session = Depends(get_db)):
+    try:
+        return crud_predict_match(db, match.team_a, match.team_b)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@router.post("/balance", response_model=CourtBalanceResult)
+def balance_courts(balance: CourtBalance, db: Session = Depends(get_db)):
+    try:
+        return crud_balance_courts(db, balance.player_ids, balance.avoid_partners_days)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@router.post("/import", response_model=MatchImportResult)
+async def import_matches(
+    request: Request,
+    format: str = Query("csv", pattern=f"^({'|'.join(FORMATS)})$"),
+    import_id: Optional[str] = Query(None, max_length=32),
+    db: Session = Depends(get_db),
+    current_user: dict = Depends(get_current_user)
+):
+    # The body is parsed while it streams in, the import itself runs in the threadpool
+    reader = await read_upload(request.stream(), format)
+    try:
+        return await run_crud(db, crud_import_matches, reader.records, current_user["id"], reader.errors, import_id)
+    except ImportInterrupted as e:
+        raise HTTPException(status_code=500, detail={"error": str(e), "import_id": e.import_id, "resume_from": e.resume_from})
 
 @router.get("/{match_id}", response_model=Match)
 def get_match_by_match_id(match_id: int, db: Session = Depends(get_db)):
@@ -32,47 +70,24 @@ def get_match_by_match_id(match_id: int, db: Session = Depends(get_db)):
     if not match:
         raise HTTPException(status_code=404, detail="Match not found")
 
-    # Convert the winners and losers into comma-separated strings
-    if match.winners:
-        match.winner_usernames = ','.join([user.username for user in match.winners])
-    if match.losers:
-        match.loser_usernames = ','.join([user.username for user in match.losers])
-    
     return match
 
 
-#Edit match feature, to be updated later
-#@router.put("/{match_id}", response_model=Match)
-#def update_match(match_id: int, match: MatchCreate, db: Session = Depends(get_db), current_user: dict = Depends(get_current_user)):
-    db_match = crud_update_match(db=db, match_id=match_id, match_data=match, current_user_id=current_user["id"])
+@router.put("/{match_id}", response_model=Match)
+def update_match(match_id: int, match: MatchUpdate, db: Session = Depends(get_db), current_user: dict = Depends(get_current_user)):
+    try:
+        db_match = crud_update_match(db=db, match_id=match_id, match_data=match, current_user_id=current_user["id"])
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     if db_match is None:
         raise HTTPException(status_code=404, detail="Match not found")
     
-    # Convert the User objects in winners and losers to their IDs
-    response_match = Match(
-        id=db_match.id,
-        winner_score=db_match.winner_score,
-        loser_score=db_match.loser_score,
-        creator_id=current_user["id"],
-        winners=[user.id for user in db_match.winners],
-        losers=[user.id for user in db_match.losers]
-    )
-    return response_match
+    return db_match
 
-#delete match feature, to be updated later
-#@router.delete("/{match_id}", response_model=Match)
-#def delete_match(match_id: int, db: Session = Depends(get_db), current_user: dict = Depends(get_current_user)):
+@router.delete("/{match_id}", response_model=Match)
+def delete_match(match_id: int, db: Session = Depends(get_db), current_user: dict = Depends(get_current_user)):
     db_match = crud_delete_match(db=db, match_id=match_id, current_user_id=current_user["id"])
     if db_match is None:
         raise HTTPException(status_code=404, detail="Match not found")
     
-    # Convert the User objects in winners and losers to their IDs
-    response_match = Match(
-        id=db_match.id,
-        winner_score=db_match.winner_score,
-        loser_score=db_match.loser_score,
-        creator_id=db_match.creator_id,
-        winners=[user.id for user in db_match.winners],
-        losers=[user.id for user in db_match.losers]
-    )
-    return response_match
\ No newline at end of file
+    return db_match
\ No newline at end of file
@@ -0,0 +1,59 @@
+from fastapi import APIRouter
+from fastapi.responses import PlainTextResponse
+from app.auth.hashing import password_hasher
+from app.auth.revocation import revocation_store
+from app.auth.token_cache import token_cache
+from app.cache.responses import response_cache
+from app.database.database import engine
+from app.monitoring.metrics import metric, render_metrics
+from app.rating.writer import rating_writer
+
+router = APIRouter(
+    tags=["metrics"]
+)
+
+def hashing_metrics() -> list[str]:
+    stats = password_hasher.stats()
+    return (
+        metric("bcrypt_workers", "Processes hashing passwords.", "gauge", ({}, stats["workers"]))
+        + metric("bcrypt_in_flight", "Passwords being hashed right now.", "gauge", ({}, stats["in_flight"]))
+        + metric("bcrypt_queue_depth", "Passwords waiting for a free worker.", "gauge", ({}, stats["queue_depth"]))
+        + metric("bcrypt_rejected_total", "Hash requests turned away with a 503.", "counter", ({}, stats["rejected"]))
+        + metric("bcrypt_wait_seconds_total", "Time hash requests spent waiting for a worker.", "counter", ({}, stats["wait_seconds"]))
+    )
+
+def rating_writer_metrics() -> list[str]:
+    stats = rating_writer.stats()
+    return (
+        metric("rating_matches_applied_total", "Matches rated and committed by the rating writer.", "counter", ({}, stats["applied"]))
+        + metric("rating_matches_failed_total", "Match submissions the rating writer gave up on.", "counter", ({}, stats["failed"]))
+        + metric("rating_submissions_retried_total", "Match submissions put back for a later attempt.", "counter", ({}, stats["retried"]))
+        + metric("rating_commits_total", "Transactions committed by the rating writer.", "counter", ({}, stats["commits"]))
+        + metric("rating_outbox_pending", "Match submissions waiting in the outbox.", "gauge", ({}, stats["pending"]))
+    )
+
+def cache_metrics() -> list[str]:
+    tokens = token_cache.stats()
+    responses = response_cache.stats()
+    names = sorted(responses["hits"].keys() | responses["misses"].keys())
+    return (
+        metric("token_cache_hits_total", "Tokens served from the verified-token cache.", "counter", ({}, tokens["hits"]))
+        + metric("token_cache_misses_total", "Tokens that had to be decoded.", "counter", ({}, tokens["misses"]))
+        + metric("token_cache_entries", "Tokens in the verified-token cache.", "gauge", ({}, tokens["size"]))
+        + metric("revoked_tokens", "Unexpired revoked tokens known to this worker.", "gauge", ({}, len(revocation_store)))
+        + metric(
+            "response_cache_hits_total", "Responses served from the response cache.", "counter",
+            *(({"endpoint": name}, responses["hits"].get(name, 0)) for name in names)
+        )
+        + metric(
+            "response_cache_misses_total", "Responses that had to be rendered.", "counter",
+            *(({"endpoint": name}, responses["misses"].get(name, 0)) for name in names)
+        )
+        + metric("response_cache_bytes", "Size of the cached response bodies.", "gauge", ({}, responses["bytes"]))
+        + metric("response_cache_evictions_total", "Responses evicted to stay within the size limit.", "counter", ({}, responses["evictions"]))
+    )
+
+@router.get("/metrics", response_class=PlainTextResponse, include_in_schema=False)
+def get_metrics():
+    body = render_metrics(engine, [hashing_metrics, rating_writer_metrics, cache_metrics])
+    return PlainTextResponse(body, media_type="text/plain; version=0.0.4")
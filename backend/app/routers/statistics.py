@@ -1,10 +1,19 @@
-from fastapi import APIRouter, Depends, HTTPException
+from datetime import date
+from typing import Optional
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, Response
+from fastapi.responses import StreamingResponse
 from sqlalchemy.orm import Session
 
-from app.crud.statistic import crud_get_full_match_history
-from app.database.database import get_db
+from app.cache.http import not_modified
+from app.cache.responses import RECENT_TAG, cache_key, json_response, render, response_cache
+from app.crud.statistic import crud_get_full_match_history, crud_stream_full_match_history
+from app.database.database import SessionLocal, get_db
 from app.schemas.schemas import Match
 from app.crud.match import crud_get_recent_matches
+from app.transfer.match_export import DATASETS, FORMATS, MEDIA_TYPES, check_format, stream_export
+
+# Largest page of the match history, the whole history is served by ?stream=true instead
+MAX_HISTORY_PAGE = 1000
 
 router = APIRouter(
     prefix="/statistics",
@@ -12,32 +21,84 @@ router = APIRouter(
     responses={404: {"description": "Not found"}},
 )
 
+def get_match_response(match):
+    return Match.model_validate(match)
+
+def parse_cursor(cursor: str) -> tuple[date, int]:
+    try:
+        date_played, match_id = cursor.split(':')
+        return date.fromisoformat(date_played), int(match_id)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+def stream_match_history():
+    # The request's session is closed before the body is sent, so the stream owns its own session
+    db = SessionLocal()
+    try:
+        for match in crud_stream_full_match_history(db):
+            yield get_match_response(match).model_dump_json() + '\n'
+    finally:
+        db.close()
+
 @router.get("/full_match_history", response_model=list[Match])
-def get_full_match_history(db: Session = Depends(get_db)):
-    matches = crud_get_full_match_history(db)
-    if not matches:
+def get_full_match_history(
+    request: Request,
+    response: Response,
+    limit: Optional[int] = Query(None, ge=1, le=MAX_HISTORY_PAGE),
+    cursor: Optional[str] = None,
+    stream: bool = False,
+    db: Session = Depends(get_db)
+):
+    if cached := not_modified(request, response):
+        return cached
+
+    if stream:
+        # The validators set by not_modified go on the streamed response as well
+        headers = {key: value for key, value in response.headers.items() if key != "content-length"}
+        return StreamingResponse(stream_match_history(), media_type="application/x-ndjson", headers=headers)
+
+    before = parse_cursor(cursor) if cursor else None
+    matches = crud_get_full_match_history(db, limit=limit, before=before)
+    if not matches and before is None:
         raise HTTPException(status_code=404, detail="No matches found")
 
-    # Convert the winners and losers into comma-separated strings
-    for match in matches:
-        if match.winners:
-            match.winner_usernames = ','.join([user.username for user in match.winners])
-        if match.losers:
-            match.loser_usernames = ','.join([user.username for user in match.losers])
-    
-    return matches
+    # A full page means there may be more, the client passes this back as ?cursor=
+    if limit and len(matches) == limit:
+        last = matches[-1]
+        response.headers["X-Next-Cursor"] = f"{last.date_played.isoformat()}:{last.id}"
+
+    return [get_match_response(match) for match in matches]
+
+@router.get("/export/{dataset}")
+def export_dataset(
+    dataset: str,
+    format: str = Query("csv", pattern=f"^({'|'.join(FORMATS)})$"),
+    start: Optional[date] = None,
+    end: Optional[date] = None
+):
+    if dataset not in DATASETS:
+        raise HTTPException(status_code=404, detail="Unknown dataset")
+    try:
+        check_format(format)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    return StreamingResponse(
+        stream_export(dataset, format, start, end),
+        media_type=MEDIA_TYPES[format],
+        headers={"Content-Disposition": f'attachment; filename="{dataset}.{format}"'}
+    )
 
 @router.get("/recent", response_model=list[Match])
-def get_recent_matches(db: Session = Depends(get_db), limit: int = 5):
-    recent_matches = crud_get_recent_matches(db, limit)
-    if not recent_matches:
-        raise HTTPException(status_code=404, detail="No recent matches found")
-    
-    # Convert the winners and losers into comma-separated strings
-    for match in recent_matches:
-        if match.winners:
-            match.winner_usernames = ','.join([user.username for user in match.winners])
-        if match.losers:
-            match.loser_usernames = ','.join([user.username for user in match.losers])
-    
-    return recent_matches
+def get_recent_matches(request: Request, response: Response, db: Session = Depends(get_db), limit: int = 5):
+    if cached := not_modified(request, response):
+        return cached
+
+    def build() -> bytes:
+        recent_matches = crud_get_recent_matches(db, limit)
+        if not recent_matches:
+            raise HTTPException(status_code=404, detail="No recent matches found")
+        return render(list[Match], [get_match_response(match) for match in recent_matches])
+
+    body = response_cache.get_or_render("recent", cache_key(request), [RECENT_TAG], build)
+    return json_response(body, response)
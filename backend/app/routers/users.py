@@ -1,13 +1,20 @@
-from fastapi import APIRouter, Depends, HTTPException, Request
+from datetime import date
+from typing import Optional
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, Response
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
+from app.auth.hashing import hash_password
 from app.auth.utils import get_current_user
-from app.crud.statistic import crud_get_user_win_percentage
+from app.cache.http import not_modified
+from app.cache.responses import RANKING_TAG, cache_key, json_response, render, response_cache, user_tag
+from app.crud.statistic import crud_get_pair_statistics, crud_get_user_rating_history, get_win_percentage
 from app.crud.user import (
-    crud_get_user, crud_get_user_matches, crud_get_users_by_rating, 
-    crud_update_user, crud_delete_user
+    crud_get_user, crud_get_user_matches, crud_get_users_by_rating, crud_get_users_around,
+    crud_get_user_rank, crud_search_users, crud_update_user, crud_delete_user
 )
-from app.schemas.schemas import Match, User, UserRanking, UserUpdate
-from app.database.database import get_db
+from app.models.models import OPPONENT, PARTNER
+from app.schemas.schemas import Match, PairStatistic, RatingPoint, User, UserRank, UserRanking, UserSearchResult, UserUpdate
+from app.database.database import get_db, get_request_db, run_crud
 
 router = APIRouter(
     prefix="/users",
@@ -15,38 +22,92 @@ router = APIRouter(
     responses={404: {"description": "Not found"}},
 )
 
-def get_user_response(db_user, win_percentage):
-    return {
+def get_user_response(db_user):
+    # Counters come from the materialized statistics row loaded with the user, not from the match lists
+    stats = db_user.statistic
+    response = {
         "id": db_user.id,
         "username": db_user.username,
         "rating": db_user.rating,
-        "matches_won": [match.id for match in db_user.matches_won],
-        "matches_lost": [match.id for match in db_user.matches_lost],
-        "win_percentage": win_percentage,
+        "rating_deviation": db_user.rating_deviation,
+        "win_percentage": get_win_percentage(stats),
         "bio": db_user.bio or None,
         "picture": db_user.picture or None
     }
+    if stats:
+        response.update({
+            "wins": stats.wins,
+            "losses": stats.losses,
+            "points_for": stats.points_for,
+            "points_against": stats.points_against,
+            "current_streak": stats.current_streak,
+            "best_streak": stats.best_streak,
+            "peak_rating": stats.peak_rating,
+            "last_played": stats.last_played
+        })
+    return response
 
 @router.get("/ranking", response_model=list[UserRanking])
-def get_users_by_rating(db: Session = Depends(get_db)):
-    users = crud_get_users_by_rating(db)
-    if not users:
-        raise HTTPException(status_code=404, detail="No users found")
-    return users
+def get_users_by_rating(
+    request: Request,
+    response: Response,
+    offset: int = Query(0, ge=0),
+    limit: Optional[int] = Query(None, ge=1),
+    around: Optional[int] = None,
+    radius: int = Query(5, ge=0),
+    db: Session = Depends(get_db)
+):
+    if cached := not_modified(request, response):
+        return cached
 
-@router.get("/{user_id}", response_model=User)
-def read_user_by_id(user_id: int, db: Session = Depends(get_db)):
-    db_user = crud_get_user(db, user_id=user_id)
-    if not db_user:
+    def build() -> bytes:
+        # around=<user_id> returns the window of players ranked right above and below that user
+        if around is not None:
+            users = crud_get_users_around(db, user_id=around, radius=radius)
+        else:
+            users = crud_get_users_by_rating(db, offset=offset, limit=limit)
+        if not users:
+            raise HTTPException(status_code=404, detail="No users found")
+        return render(list[UserRanking], users)
+
+    body = response_cache.get_or_render("ranking", cache_key(request), [RANKING_TAG], build)
+    return json_response(body, response)
+
+@router.get("/search", response_model=list[UserSearchResult])
+def search_users(
+    q: str = Query(..., min_length=1),
+    offset: int = Query(0, ge=0),
+    limit: int = Query(20, ge=1, le=100),
+    db: Session = Depends(get_db)
+):
+    return crud_search_users(db, q, offset=offset, limit=limit)
+
+@router.get("/{user_id}/rank", response_model=UserRank)
+def read_user_rank(user_id: int, db: Session = Depends(get_db)):
+    rank = crud_get_user_rank(db, user_id=user_id)
+    if rank is None:
         raise HTTPException(status_code=404, detail="User not found")
-    win_percentage = crud_get_user_win_percentage(db, user_id=user_id)
-    return get_user_response(db_user, win_percentage)
+    return rank
+
+@router.get("/{user_id}", response_model=User)
+def read_user_by_id(request: Request, response: Response, user_id: int, db: Session = Depends(get_db)):
+    if cached := not_modified(request, response):
+        return cached
+
+    def build() -> bytes:
+        db_user = crud_get_user(db, user_id=user_id)
+        if not db_user:
+            raise HTTPException(status_code=404, detail="User not found")
+        return render(User, get_user_response(db_user))
+
+    body = response_cache.get_or_render("user", cache_key(request), [user_tag(user_id)], build)
+    return json_response(body, response)
 
 @router.put("/{user_id}/edit", response_model=User)
 async def update_user(
     request: Request,
     user_id: int,
-    db: Session = Depends(get_db),
+    db: Session | AsyncSession = Depends(get_request_db),
     current_user: dict = Depends(get_current_user)
 ):
     if user_id != current_user["id"]:
@@ -60,13 +121,20 @@ async def update_user(
         password=data.get('password') if data.get('password') else None
     )
 
-    db_user = crud_update_user(db=db, user_id=user_id, user_data=user_data, current_user_id=current_user["id"])
-    if not db_user:
+    hashed_password = await hash_password(user_data.password) if user_data.password else None
+
+    def update(session):
+        db_user = crud_update_user(
+            db=session, user_id=user_id, user_data=user_data, current_user_id=current_user["id"], hashed_password=hashed_password
+        )
+        return get_user_response(db_user) if db_user else None
+
+    # Runs on the async driver or in the threadpool, never on the event loop
+    user_response = await run_crud(db, update)
+    if not user_response:
         raise HTTPException(status_code=404, detail="User not found")
     
-    total_matches = len(db_user.matches_won) + len(db_user.matches_lost)
-    win_percentage = (len(db_user.matches_won) / total_matches) * 100 if total_matches > 0 else 0
-    return get_user_response(db_user, win_percentage)
+    return user_response
 
 @router.delete("/{user_id}/delete", response_model=User)
 def delete_user(user_id: int, db: Session = Depends(get_db), current_user: dict = Depends(get_current_user)):
@@ -74,7 +142,7 @@ def delete_user(user_id: int, db: Session = Depends(get_db), current_user: dict
     if not db_user:
         raise HTTPException(status_code=404, detail="User not found")
     
-    return get_user_response(db_user, 0)
+    return get_user_response(db_user)
 
 @router.get("/{user_id}/matches", response_model=list[Match])
 def read_user_matches(user_id: int, db: Session = Depends(get_db)):
@@ -86,8 +154,8 @@ def read_user_matches(user_id: int, db: Session = Depends(get_db)):
         {
             "id": match.id,
             "creator_id": match.creator_id,
-            "winner_usernames": match.winner_usernames.strip('{}').replace(',', ', ') if match.winner_usernames else 'N/A',
-            "loser_usernames": match.loser_usernames.strip('{}').replace(',', ', ') if match.loser_usernames else 'N/A',
+            "winner_usernames": match.winner_usernames.replace(',', ', ') if match.winner_usernames else 'N/A',
+            "loser_usernames": match.loser_usernames.replace(',', ', ') if match.loser_usernames else 'N/A',
             "winner_avg_rating": match.winner_avg_rating,
             "loser_avg_rating": match.loser_avg_rating,
             "elo_change_winner": match.elo_change_winner,
@@ -97,4 +165,43 @@ def read_user_matches(user_id: int, db: Session = Depends(get_db)):
             "date_played": match.date_played.isoformat()
         }
         for match in user_matches
-    ]
\ No newline at end of file
+    ]
+
+@router.get("/{user_id}/rating_history", response_model=list[RatingPoint])
+def read_user_rating_history(
+    user_id: int,
+    start: Optional[date] = None,
+    end: Optional[date] = None,
+    max_points: Optional[int] = Query(None, ge=1),
+    db: Session = Depends(get_db)
+):
+    return crud_get_user_rating_history(db, user_id=user_id, start=start, end=end, max_points=max_points)
+
+def _read_pairs(request: Request, response: Response, db: Session, user_id: int, relation: int, limit: int, order: str, min_games: int):
+    if cached := not_modified(request, response):
+        return cached
+    return crud_get_pair_statistics(db, user_id, relation, limit=limit, order=order, min_games=min_games)
+
+@router.get("/{user_id}/partners", response_model=list[PairStatistic])
+def read_user_partners(
+    request: Request,
+    response: Response,
+    user_id: int,
+    limit: int = Query(10, ge=1, le=100),
+    order: str = Query("games", pattern="^(games|win_percentage)$"),
+    min_games: int = Query(1, ge=1),
+    db: Session = Depends(get_db)
+):
+    return _read_pairs(request, response, db, user_id, PARTNER, limit, order, min_games)
+
+@router.get("/{user_id}/opponents", response_model=list[PairStatistic])
+def read_user_opponents(
+    request: Request,
+    response: Response,
+    user_id: int,
+    limit: int = Query(10, ge=1, le=100),
+    order: str = Query("games", pattern="^(games|win_percentage)$"),
+    min_games: int = Query(1, ge=1),
+    db: Session = Depends(get_db)
+):
+    return _read_pairs(request, response, db, user_id, OPPONENT, limit, order, min_games)
\ No newline at end of file
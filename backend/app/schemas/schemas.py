@@ -1,4 +1,4 @@
-from datetime import date
+from datetime import date, datetime
 from typing import Optional
 from pydantic import BaseModel, Field
 
@@ -13,7 +13,9 @@ class MatchCreate(MatchBase):
     date_played: date
 
 class MatchUpdate(MatchBase):
-    pass
+    winners: list[int] = []
+    losers: list[int] = []
+    date_played: date
 
 class Match(MatchBase):
     id: int
@@ -29,6 +31,61 @@ class Match(MatchBase):
     class Config:
         from_attributes = True
 
+class MatchSubmission(BaseModel):
+    id: int
+    status: str
+    attempts: int
+    error: Optional[str] = None
+    match_id: Optional[int] = None
+    created_at: datetime
+    processed_at: Optional[datetime] = None
+
+    class Config:
+        from_attributes = True
+
+class MatchImportError(BaseModel):
+    line: int
+    error: str
+
+class MatchImportResult(BaseModel):
+    total: int
+    imported: int
+    rerated: int
+    error_count: int
+    errors: list[MatchImportError] = []
+
+class TeamPlayer(BaseModel):
+    id: int
+    username: str
+    rating: float
+
+class MatchPredict(BaseModel):
+    team_a: list[int]
+    team_b: list[int]
+
+class MatchPrediction(BaseModel):
+    team_a: list[TeamPlayer]
+    team_b: list[TeamPlayer]
+    # Chance that team_a wins
+    win_probability: float
+    engine: str
+
+class CourtBalance(BaseModel):
+    player_ids: list[int]
+    # Avoid pairing players who were partners in a match played in the last this many days, 0 is today only
+    avoid_partners_days: Optional[int] = Field(None, ge=0)
+
+class Court(BaseModel):
+    team_a: list[TeamPlayer]
+    team_b: list[TeamPlayer]
+    win_probability: float
+    repeat_partners: int
+
+class CourtBalanceResult(BaseModel):
+    courts: list[Court]
+    sitting_out: list[TeamPlayer]
+    engine: str
+
 # User
 class UserBase(BaseModel):
     username: str = Field(...)
@@ -52,14 +109,49 @@ class UserRanking(BaseModel):
     id: int
     username: str
     rating: float
+    rank: Optional[int] = None
+
+class UserSearchResult(BaseModel):
+    id: int
+    username: str
+    score: float
+
+class UserRank(UserRanking):
+    rank: int
+    total: int
 
 
 class User(UserBase):
     id: int
     rating: float
-    matches_won: list[int] = []
-    matches_lost: list[int] = []
+    rating_deviation: Optional[float] = None
+    wins: int = 0
+    losses: int = 0
     win_percentage: float
+    points_for: int = 0
+    points_against: int = 0
+    current_streak: int = 0
+    best_streak: int = 0
+    peak_rating: Optional[float] = None
+    last_played: Optional[date] = None
+
+    class Config:
+        from_attributes = True
+
+class PairStatistic(BaseModel):
+    # The other user of the pair and how the two did together or against each other
+    id: int
+    username: str
+    games: int
+    wins: int
+    losses: int
+    win_percentage: float
+
+class RatingPoint(BaseModel):
+    match_id: int
+    date_played: date
+    rating_before: float
+    rating_after: float
 
     class Config:
         from_attributes = True
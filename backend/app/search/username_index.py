@@ -0,0 +1,128 @@
+import heapq
+import threading
+from bisect import bisect_left
+from collections import Counter
+from sqlalchemy.orm import Session
+from app.models.models import User
+
+# Same cut-off as pg_trgm's default similarity_threshold
+SIMILARITY_THRESHOLD = 0.3
+
+
+def trigrams(text: str) -> set[str]:
+    # Same padding as PostgreSQL pg_trgm, so both backends rank names alike
+    padded = f"  {text.lower()} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def short_grams(text: str) -> set[str]:
+    # Unpadded 1 and 2 character substrings, for terms too short to have an inner trigram
+    text = text.lower()
+    return {text[i:i + n] for n in (1, 2) for i in range(len(text) - n + 1)}
+
+
+def similarity(query_grams: set[str], username: str) -> float:
+    grams = trigrams(username)
+    common = len(query_grams & grams)
+    return common / (len(query_grams) + len(grams) - common)
+
+
+class UsernameIndex:
+    # In-process trigram and prefix index over usernames, used when the database has no pg_trgm
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._usernames: dict[int, str] = {}
+        self._gram_counts: dict[int, int] = {}
+        self._postings: dict[str, set[int]] = {}
+        self._short_postings: dict[str, set[int]] = {}
+        self._sorted: list[tuple[str, int]] = []
+        self.loaded = False
+
+    def load(self, db: Session):
+        rows = db.query(User.id, User.username).all()
+        with self._lock:
+            self._usernames = {}
+            self._gram_counts = {}
+            self._postings = {}
+            self._short_postings = {}
+            for user_id, username in rows:
+                self._add(user_id, username)
+            self._sorted = sorted((username.lower(), user_id) for user_id, username in rows)
+            self.loaded = True
+
+    def ensure_loaded(self, db: Session):
+        if not self.loaded:
+            self.load(db)
+
+    def _add(self, user_id: int, username: str):
+        grams = trigrams(username)
+        self._usernames[user_id] = username
+        self._gram_counts[user_id] = len(grams)
+        for gram in grams:
+            self._postings.setdefault(gram, set()).add(user_id)
+        for gram in short_grams(username):
+            self._short_postings.setdefault(gram, set()).add(user_id)
+
+    def _remove(self, user_id: int):
+        username = self._usernames.pop(user_id, None)
+        if username is None:
+            return
+        del self._gram_counts[user_id]
+        for gram in trigrams(username):
+            self._postings[gram].discard(user_id)
+        for gram in short_grams(username):
+            self._short_postings[gram].discard(user_id)
+        del self._sorted[bisect_left(self._sorted, (username.lower(), user_id))]
+
+    def update(self, user_id: int, username: str):
+        if not self.loaded:
+            return
+        with self._lock:
+            self._remove(user_id)
+            self._add(user_id, username)
+            key = (username.lower(), user_id)
+            self._sorted.insert(bisect_left(self._sorted, key), key)
+
+    def remove(self, user_id: int):
+        if not self.loaded:
+            return
+        with self._lock:
+            self._remove(user_id)
+
+    def search(self, term: str, limit: int) -> list[tuple[int, str, float]]:
+        term = term.lower()
+        query_grams = trigrams(term)
+        with self._lock:
+            # Prefix hits rank first and come straight off the sorted list, shortest (most similar) names first
+            prefix = []
+            position = bisect_left(self._sorted, (term, -1))
+            while position < len(self._sorted) and self._sorted[position][0].startswith(term):
+                prefix.append(self._sorted[position][1])
+                position += 1
+            best = heapq.nsmallest(limit, prefix, key=lambda user_id: (len(self._usernames[user_id]), self._usernames[user_id]))
+
+            # Only when prefixes don't fill the page, fall back to substring and trigram similarity hits
+            if len(best) < limit:
+                shared = Counter()
+                for gram in query_grams:
+                    shared.update(self._postings.get(gram, ()))
+                if len(term) < 3:
+                    for user_id in self._short_postings.get(term, ()):
+                        shared.setdefault(user_id, 0)
+
+                scored = []
+                prefix = set(prefix)
+                for user_id, common in shared.items():
+                    if user_id in prefix:
+                        continue
+                    score = common / (len(query_grams) + self._gram_counts[user_id] - common)
+                    is_substring = term in self._usernames[user_id].lower()
+                    if is_substring or score >= SIMILARITY_THRESHOLD:
+                        scored.append((not is_substring, -score, self._usernames[user_id], user_id))
+                best += [user_id for *_, user_id in heapq.nsmallest(limit - len(best), scored)]
+
+            return [(user_id, self._usernames[user_id], similarity(query_grams, self._usernames[user_id])) for user_id in best]
+
+
+username_index = UsernameIndex()
@@ -0,0 +1,195 @@
+import argparse
+import csv
+import io
+import json
+import sys
+from datetime import date
+from typing import Iterator, Optional
+from sqlalchemy import case, select
+from sqlalchemy.orm import Session
+from app.database.database import SessionLocal
+from app.models.models import WINNER, Match, MatchParticipant, User, UserStatistic
+
+# Parquet output is optional, it needs pyarrow installed
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+EXPORT_CHUNK_SIZE = 1000
+FORMATS = ("csv", "ndjson", "parquet")
+MEDIA_TYPES = {"csv": "text/csv", "ndjson": "application/x-ndjson", "parquet": "application/vnd.apache.parquet"}
+
+# Column names and types of every dataset, the types are only used for Parquet
+DATASETS = {
+    "matches": [
+        ("id", "int"), ("date_played", "date"), ("winner_score", "int"), ("loser_score", "int"),
+        ("winner_usernames", "str"), ("loser_usernames", "str"), ("winner_avg_rating", "float"), ("loser_avg_rating", "float"),
+        ("elo_change_winner", "float"), ("elo_change_loser", "float"), ("creator_id", "int"),
+    ],
+    "participants": [
+        ("match_id", "int"), ("date_played", "date"), ("user_id", "int"), ("side", "str"),
+        ("rating_before", "float"), ("rating_after", "float"),
+    ],
+    "users": [
+        ("id", "int"), ("username", "str"), ("rating", "float"), ("wins", "int"), ("losses", "int"),
+        ("peak_rating", "float"), ("last_played", "date"),
+    ],
+}
+
+
+def _date_range(query, column, start: Optional[date], end: Optional[date]):
+    if start:
+        query = query.where(column >= start)
+    if end:
+        query = query.where(column <= end)
+    return query
+
+def export_query(dataset: str, start: Optional[date] = None, end: Optional[date] = None):
+    # The date range applies to when matches were played, users are always exported in full
+    if dataset == "matches":
+        query = select(*(getattr(Match, name) for name, _ in DATASETS["matches"]))
+        return _date_range(query, Match.date_played, start, end).order_by(Match.date_played, Match.id)
+
+    if dataset == "participants":
+        query = (
+            select(
+                MatchParticipant.match_id, Match.date_played, MatchParticipant.user_id,
+                case((MatchParticipant.side == WINNER, "winner"), else_="loser").label("side"),
+                MatchParticipant.rating_before, (MatchParticipant.rating_before + MatchParticipant.rating_delta).label("rating_after")
+            )
+            .join(Match, Match.id == MatchParticipant.match_id)
+        )
+        # Winners first within a match
+        return _date_range(query, Match.date_played, start, end).order_by(Match.date_played, MatchParticipant.match_id, MatchParticipant.side)
+
+    if dataset == "users":
+        return (
+            select(
+                User.id, User.username, User.rating, UserStatistic.wins, UserStatistic.losses,
+                UserStatistic.peak_rating, UserStatistic.last_played
+            )
+            .outerjoin(UserStatistic, UserStatistic.user_id == User.id)
+            .order_by(User.id)
+        )
+
+    raise ValueError(f"Unknown dataset {dataset}, expected one of {', '.join(DATASETS)}")
+
+
+def iter_row_chunks(db: Session, query, chunk_size: int = EXPORT_CHUNK_SIZE) -> Iterator[list]:
+    # yield_per streams from a server-side cursor, only one chunk of rows is in memory at a time
+    yield from db.execute(query.execution_options(yield_per=chunk_size)).partitions()
+
+
+def _csv_chunks(columns: list[str], chunks) -> Iterator[bytes]:
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(columns)
+    yield buffer.getvalue().encode()
+    for chunk in chunks:
+        buffer.seek(0)
+        buffer.truncate()
+        writer.writerows(chunk)
+        yield buffer.getvalue().encode()
+
+def _ndjson_chunks(columns: list[str], chunks) -> Iterator[bytes]:
+    for chunk in chunks:
+        yield "".join(json.dumps(dict(zip(columns, row)), default=str) + "\n" for row in chunk).encode()
+
+
+class _ByteSink(io.RawIOBase):
+    # Write-only file that hands out what was written so far, Parquet data goes out one row group at a time
+    def __init__(self):
+        self._parts: list[bytes] = []
+        self._position = 0
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        self._parts.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self._position
+
+    def take(self) -> bytes:
+        data = b"".join(self._parts)
+        self._parts = []
+        return data
+
+def _parquet_chunks(fields: list[tuple[str, str]], chunks) -> Iterator[bytes]:
+    types = {"int": pa.int64(), "float": pa.float64(), "str": pa.string(), "date": pa.date32()}
+    schema = pa.schema([(name, types[kind]) for name, kind in fields])
+    sink = _ByteSink()
+    writer = pq.ParquetWriter(sink, schema)
+    for chunk in chunks:
+        columns = [pa.array([row[i] for row in chunk], type=field.type) for i, field in enumerate(schema)]
+        writer.write_table(pa.Table.from_arrays(columns, schema=schema))
+        yield sink.take()
+    writer.close()
+    yield sink.take()
+
+
+def check_format(format: str):
+    if format not in FORMATS:
+        raise ValueError(f"Unsupported format {format}, expected one of {', '.join(FORMATS)}")
+    if format == "parquet" and pa is None:
+        raise ValueError("Parquet export needs pyarrow, install it with `pip install pyarrow`")
+
+def export_dataset(
+    db: Session, dataset: str, format: str, start: Optional[date] = None, end: Optional[date] = None, chunk_size: int = EXPORT_CHUNK_SIZE
+) -> Iterator[bytes]:
+    check_format(format)
+    query = export_query(dataset, start, end)
+    fields = DATASETS[dataset]
+    chunks = iter_row_chunks(db, query, chunk_size)
+    if format == "csv":
+        return _csv_chunks([name for name, _ in fields], chunks)
+    if format == "ndjson":
+        return _ndjson_chunks([name for name, _ in fields], chunks)
+    return _parquet_chunks(fields, chunks)
+
+def stream_export(dataset: str, format: str, start: Optional[date] = None, end: Optional[date] = None) -> Iterator[bytes]:
+    # Owns its session like the other streaming responses, the request's session is closed before the body is sent
+    db = SessionLocal()
+    try:
+        yield from export_dataset(db, dataset, format, start, end)
+    finally:
+        db.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export matches, participants or users as CSV, NDJSON or Parquet")
+    parser.add_argument("dataset", choices=DATASETS)
+    parser.add_argument("-o", "--output", help="output file, defaults to stdout")
+    parser.add_argument("--format", choices=FORMATS, help="defaults to the output file extension, csv otherwise")
+    parser.add_argument("--start", type=date.fromisoformat, help="first date_played to include (YYYY-MM-DD)")
+    parser.add_argument("--end", type=date.fromisoformat, help="last date_played to include (YYYY-MM-DD)")
+    parser.add_argument("--chunk-size", type=int, default=EXPORT_CHUNK_SIZE, help="rows fetched and written at a time")
+    args = parser.parse_args()
+
+    format = args.format
+    if format is None:
+        extension = args.output.rsplit(".", 1)[-1] if args.output and "." in args.output else ""
+        format = {"jsonl": "ndjson"}.get(extension, extension) if extension in FORMATS + ("jsonl",) else "csv"
+    try:
+        check_format(format)
+    except ValueError as e:
+        parser.error(str(e))
+
+    db = SessionLocal()
+    output = open(args.output, "wb") if args.output else sys.stdout.buffer
+    try:
+        for data in export_dataset(db, args.dataset, format, args.start, args.end, args.chunk_size):
+            output.write(data)
+    finally:
+        if args.output:
+            output.close()
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
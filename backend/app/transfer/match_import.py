@@ -0,0 +1,282 @@
+import argparse
+import codecs
+import csv
+import json
+import os
+import sys
+import uuid
+from dataclasses import dataclass
+from datetime import date
+from typing import AsyncIterator, Callable, Optional
+from sqlalchemy import delete, func, insert, select
+from sqlalchemy.orm import Session
+from app.crud.match import validate_match_players
+from app.crud.statistic import crud_rebuild_pair_statistics
+from app.database.database import SessionLocal
+from app.models.models import LOSER, WINNER, Match, MatchParticipant, StagedMatch, User
+from app.rating.incremental import capture_ratings_at, rerate_from
+from app.rating.lock import lock_ratings
+from app.schemas.schemas import MatchCreate
+
+IMPORT_CHUNK_SIZE = 1000
+MAX_REPORTED_ERRORS = 100
+FORMATS = ("csv", "ndjson")
+
+
+@dataclass
+class ImportRecord:
+    line: int
+    date_played: date
+    winner_score: int
+    loser_score: int
+    winners: list[str]
+    losers: list[str]
+
+
+class ImportInterrupted(Exception):
+    # Raised when a chunk fails, everything before resume_from is staged under import_id
+    def __init__(self, import_id: str, resume_from: int, error: Exception):
+        super().__init__(f"Import stopped after {resume_from} matches: {error}")
+        self.import_id = import_id
+        self.resume_from = resume_from
+
+
+def _split_names(value) -> list[str]:
+    if isinstance(value, str):
+        value = value.replace(";", ",").split(",")
+    return [name.strip() for name in value or [] if name and name.strip()]
+
+def _team(raw: dict, side: str) -> list[str]:
+    # A team is either one "winners" field or numbered "winner1", "winner2" columns
+    if side + "s" in raw:
+        return _split_names(raw[side + "s"])
+    return _split_names([value for key, value in sorted(raw.items()) if key.startswith(side) and key[len(side):].isdigit()])
+
+
+class RecordReader:
+    # Parses an upload line by line, so the file is never held as text. Malformed lines are collected as errors.
+
+    def __init__(self, format: str):
+        if format not in FORMATS:
+            raise ValueError(f"Unsupported format {format}, expected one of {', '.join(FORMATS)}")
+        self.format = format
+        self.header: Optional[list[str]] = None
+        self.line = 0
+        self.records: list[ImportRecord] = []
+        self.errors: list[dict] = []
+
+    def feed(self, text: str):
+        self.line += 1
+        text = text.strip()
+        if not text:
+            return
+        try:
+            if self.format == "ndjson":
+                raw = json.loads(text)
+            else:
+                row = next(csv.reader([text]))
+                if self.header is None:
+                    self.header = [column.strip().lower() for column in row]
+                    return
+                raw = dict(zip(self.header, row))
+            # Scores and date go through the same schema as /matches/create
+            match = MatchCreate(winner_score=raw.get("winner_score"), loser_score=raw.get("loser_score"), date_played=raw.get("date_played"))
+            self.records.append(ImportRecord(
+                self.line, match.date_played, match.winner_score, match.loser_score, _team(raw, "winner"), _team(raw, "loser")
+            ))
+        except (ValueError, AttributeError) as e:
+            self.errors.append({"line": self.line, "error": str(e)})
+
+
+async def read_upload(chunks: AsyncIterator[bytes], format: str) -> RecordReader:
+    reader = RecordReader(format)
+    decoder = codecs.getincrementaldecoder("utf-8-sig")()
+    buffer = ""
+    async for chunk in chunks:
+        buffer += decoder.decode(chunk)
+        *lines, buffer = buffer.split("\n")
+        for text in lines:
+            reader.feed(text)
+    buffer += decoder.decode(b"", final=True)
+    if buffer:
+        reader.feed(buffer)
+    return reader
+
+def read_file(path: str, format: Optional[str] = None) -> RecordReader:
+    reader = RecordReader(format or ("ndjson" if path.endswith((".ndjson", ".jsonl")) else "csv"))
+    with open(path, encoding="utf-8-sig") as f:
+        for text in f:
+            reader.feed(text)
+    return reader
+
+
+def _resolve_players(db: Session, records: list[ImportRecord], errors: list[dict]) -> list[tuple[ImportRecord, list[int], list[int]]]:
+    # Every username in the file is resolved with one lookup, chunked to stay under parameter limits
+    names = sorted({name for record in records for name in record.winners + record.losers})
+    user_ids = {}
+    for start in range(0, len(names), IMPORT_CHUNK_SIZE):
+        user_ids.update(db.execute(select(User.username, User.id).where(User.username.in_(names[start:start + IMPORT_CHUNK_SIZE]))).all())
+
+    valid = []
+    for record in records:
+        unknown = [name for name in record.winners + record.losers if name not in user_ids]
+        try:
+            if unknown:
+                raise ValueError(f"Unknown players: {', '.join(unknown)}")
+            winner_ids = [user_ids[name] for name in record.winners]
+            loser_ids = [user_ids[name] for name in record.losers]
+            validate_match_players(winner_ids, loser_ids)
+        except ValueError as e:
+            errors.append({"line": record.line, "error": str(e)})
+            continue
+        valid.append((record, winner_ids, loser_ids))
+    return valid
+
+
+def _move_staged(db: Session, import_id: str, chunk_size: int) -> Optional[int]:
+    # Staged rows become matches in file order, so their ids follow the replay order. Returns the first new id.
+    first_id = None
+    position = -1
+    while True:
+        staged = db.execute(
+            select(StagedMatch.position, StagedMatch.creator_id, StagedMatch.date_played, StagedMatch.winner_score,
+                   StagedMatch.loser_score, StagedMatch.winner_ids, StagedMatch.loser_ids)
+            .where(StagedMatch.import_id == import_id, StagedMatch.position > position)
+            .order_by(StagedMatch.position)
+            .limit(chunk_size)
+        ).all()
+        if not staged:
+            break
+        # One multi-row INSERT per batch on PostgreSQL, SQLite inserts row by row to keep the ids in order
+        match_ids = db.execute(
+            insert(Match).returning(Match.id, sort_by_parameter_order=True),
+            [
+                {"winner_score": row.winner_score, "loser_score": row.loser_score, "creator_id": row.creator_id, "date_played": row.date_played}
+                for row in staged
+            ]
+        ).scalars().all()
+        db.execute(insert(MatchParticipant), [
+            {"match_id": match_id, "user_id": user_id, "side": side}
+            for match_id, row in zip(match_ids, staged)
+            for side, team in ((WINNER, row.winner_ids), (LOSER, row.loser_ids))
+            for user_id in team
+        ])
+        first_id = first_id or match_ids[0]
+        position = staged[-1].position
+    db.execute(delete(StagedMatch).where(StagedMatch.import_id == import_id))
+    return first_id
+
+
+def crud_import_matches(
+    db: Session,
+    records: list[ImportRecord],
+    creator_id: int,
+    errors: Optional[list[dict]] = None,
+    import_id: Optional[str] = None,
+    chunk_size: int = IMPORT_CHUNK_SIZE,
+    progress: Optional[Callable[[int, int], None]] = None
+) -> dict:
+    # Matches are staged in chunked transactions, then moved into the history and rated together in one pass.
+    # A failed import is resumed with the import_id it reports, the file is processed in the same order again and
+    # whatever is already staged under that id is skipped.
+    errors = [] if errors is None else errors
+    import_id = import_id or uuid.uuid4().hex
+    records = sorted(records, key=lambda record: (record.date_played, record.line))
+    valid = _resolve_players(db, records, errors)
+    imported = db.execute(
+        select(func.count()).select_from(StagedMatch).where(StagedMatch.import_id == import_id, StagedMatch.creator_id == creator_id)
+    ).scalar()
+    result = {"total": len(valid), "imported": min(imported, len(valid)), "rerated": 0, "error_count": len(errors), "errors": errors[:MAX_REPORTED_ERRORS]}
+    if not valid:
+        return result
+
+    pending = valid[imported:]
+    for start in range(0, len(pending), chunk_size):
+        chunk = pending[start:start + chunk_size]
+        try:
+            db.execute(insert(StagedMatch), [
+                {
+                    "import_id": import_id,
+                    "position": imported + i,
+                    "creator_id": creator_id,
+                    "date_played": record.date_played,
+                    "winner_score": record.winner_score,
+                    "loser_score": record.loser_score,
+                    "winner_ids": winner_ids,
+                    "loser_ids": loser_ids
+                }
+                for i, (record, winner_ids, loser_ids) in enumerate(chunk)
+            ])
+            db.commit()
+        except Exception as e:
+            db.rollback()
+            raise ImportInterrupted(import_id, imported, e) from e
+
+        imported += len(chunk)
+        if progress:
+            progress(imported, len(valid))
+
+    first_date = valid[0][0].date_played
+    player_ids = {user_id for _, winner_ids, loser_ids in valid for user_id in winner_ids + loser_ids}
+    try:
+        # The staged matches enter the history under the rating lock and are rated before it is released, so the
+        # rating writer never appends on top of matches without ratings
+        lock_ratings(db)
+        # Ratings right before the first imported match, existing matches on that date stay in front of it
+        start_ratings = capture_ratings_at(db, first_date, None, player_ids)
+        first_id = _move_staged(db, import_id, chunk_size)
+        crud_rebuild_pair_statistics(db, player_ids)
+        result["rerated"] = rerate_from(db, first_date, first_id, start_ratings)
+    except Exception as e:
+        db.rollback()
+        raise ImportInterrupted(import_id, imported, e) from e
+    result["imported"] = imported
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Import matches from a CSV or NDJSON file")
+    parser.add_argument("path", help="CSV with a header row, or one JSON object per line")
+    parser.add_argument("--creator", required=True, help="username recorded as the creator of the imported matches")
+    parser.add_argument("--format", choices=FORMATS, help="defaults to ndjson for .ndjson/.jsonl files, csv otherwise")
+    parser.add_argument("--chunk-size", type=int, default=IMPORT_CHUNK_SIZE, help="matches per transaction")
+    parser.add_argument("--resume", action="store_true", help="continue after the matches staged by a failed run")
+    args = parser.parse_args()
+
+    # The import id is kept next to the file so an interrupted run can be resumed
+    checkpoint = args.path + ".progress"
+    import_id = None
+    if args.resume and os.path.exists(checkpoint):
+        with open(checkpoint) as f:
+            import_id = f.read().strip() or None
+    import_id = import_id or uuid.uuid4().hex
+    with open(checkpoint, "w") as f:
+        f.write(import_id)
+
+    def progress(done: int, total: int):
+        print(f"{done}/{total} matches staged", file=sys.stderr)
+
+    reader = read_file(args.path, args.format)
+    db = SessionLocal()
+    try:
+        creator = db.query(User.id).filter(User.username == args.creator).first()
+        if not creator:
+            parser.error(f"unknown creator {args.creator}")
+        result = crud_import_matches(
+            db, reader.records, creator.id, reader.errors, import_id=import_id, chunk_size=args.chunk_size, progress=progress
+        )
+    except ImportInterrupted as e:
+        print(f"{e}, run again with --resume to continue", file=sys.stderr)
+        sys.exit(1)
+    finally:
+        db.close()
+
+    if os.path.exists(checkpoint):
+        os.remove(checkpoint)
+    for error in result["errors"]:
+        print(f"line {error['line']}: {error['error']}", file=sys.stderr)
+    print(f"{result['imported']} of {result['total']} matches imported, {result['error_count']} lines skipped, {result['rerated']} matches rated")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+import argparse
+import random
+import time
+from datetime import date, timedelta
+from itertools import accumulate
+from sqlalchemy import insert, text
+from sqlalchemy.orm import Session
+from app.auth.hashing import bcrypt_context
+from app.database.database import Base, SessionLocal, engine
+from app.models.models import LOSER, WINNER, Match, MatchParticipant, User
+from app.rating.replay import crud_replay_ratings
+
+BENCHMARK_PASSWORD = "benchmark"
+CHUNK_SIZE = 10000
+
+FIRST_NAMES = (
+    "alex", "sam", "kim", "lee", "jo", "max", "ana", "li", "noah", "mia", "ravi", "yuki", "omar", "eva", "lars",
+    "nina", "tom", "zoe", "ivan", "sara", "chen", "aya", "ben", "lena", "hugo", "ines", "ken", "lucia", "mateo", "ola"
+)
+
+
+def _username(rng: random.Random, user_id: int) -> str:
+    # Realistic enough for the fuzzy search, the id keeps them unique
+    return f"{rng.choice(FIRST_NAMES)}_{rng.choice(FIRST_NAMES)}{user_id}"
+
+def _match_date(rng: random.Random, start: date, days: int) -> date:
+    # Club nights cluster on weekends, weekdays still see some play
+    day = start + timedelta(days=rng.randrange(days))
+    if day.weekday() < 5 and rng.random() < 0.5:
+        day += timedelta(days=5 - day.weekday())
+    return min(day, start + timedelta(days=days - 1))
+
+def _score(rng: random.Random) -> tuple[int, int]:
+    if rng.random() < 0.15:
+        # Deuce, won by two points or at 30
+        loser_score = rng.randint(20, 28)
+        return loser_score + 2, loser_score
+    return 21, rng.randint(3, 19)
+
+
+def generate_dataset(db: Session, users: int, matches: int, days: int = 730, seed: int = 0, progress=None) -> dict:
+    # Replaces everything in the database with a reproducible synthetic league
+    rng = random.Random(seed)
+    started = time.perf_counter()
+
+    for table in reversed(Base.metadata.sorted_tables):
+        db.execute(table.delete())
+    db.commit()
+
+    # One real hash for everyone, so logins cost what they cost in production without hashing a million times
+    hashed_password = bcrypt_context.hash(BENCHMARK_PASSWORD)
+    for first in range(1, users + 1, CHUNK_SIZE):
+        db.execute(insert(User), [
+            {"id": user_id, "username": _username(rng, user_id), "hashed_password": hashed_password, "rating": 1000}
+            for user_id in range(first, min(first + CHUNK_SIZE, users + 1))
+        ])
+    db.commit()
+
+    # Activity follows a long tail, a few regulars play most of the matches
+    user_ids = list(range(1, users + 1))
+    rng.shuffle(user_ids)
+    cum_weights = list(accumulate(1 / (rank + 1) ** 0.8 for rank in range(users)))
+
+    start = date.today() - timedelta(days=days)
+    for first in range(1, matches + 1, CHUNK_SIZE):
+        match_rows, participant_rows = [], []
+        for match_id in range(first, min(first + CHUNK_SIZE, matches + 1)):
+            players = set()
+            while len(players) < 4:
+                players.update(rng.choices(user_ids, cum_weights=cum_weights, k=4 - len(players)))
+            players = list(players)
+            winner_score, loser_score = _score(rng)
+            match_rows.append({
+                "id": match_id,
+                "winner_score": winner_score,
+                "loser_score": loser_score,
+                "creator_id": players[0],
+                "date_played": _match_date(rng, start, days)
+            })
+            participant_rows += [{"match_id": match_id, "user_id": user_id, "side": WINNER} for user_id in players[:2]]
+            participant_rows += [{"match_id": match_id, "user_id": user_id, "side": LOSER} for user_id in players[2:]]
+        db.execute(insert(Match), match_rows)
+        db.execute(insert(MatchParticipant), participant_rows)
+        db.commit()
+        if progress:
+            progress(min(first + CHUNK_SIZE - 1, matches), matches)
+
+    # Ratings, snapshots and statistics come from the regular replay
+    crud_replay_ratings(db)
+    if engine.dialect.name == "postgresql":
+        # Explicit ids leave the sequences behind, new matches and users would collide with them
+        for table in ("users", "matches"):
+            db.execute(text(f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), (SELECT MAX(id) FROM {table}))"))
+        db.commit()
+
+    return {"users": users, "matches": matches, "days": days, "seed": seed, "seconds": round(time.perf_counter() - started, 2)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fill the database with a synthetic league for benchmarking")
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--matches", type=int, default=20000)
+    parser.add_argument("--days", type=int, default=730, help="span of the match dates, ending today")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    Base.metadata.create_all(bind=engine)
+    db = SessionLocal()
+    try:
+        summary = generate_dataset(
+            db, args.users, args.matches, args.days, args.seed,
+            progress=lambda done, total: print(f"{done}/{total} matches generated", flush=True)
+        )
+    finally:
+        db.close()
+    print(summary)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,317 @@
+import argparse
+import os
+import sys
+import threading
+from collections import Counter
+from datetime import date, timedelta
+
+# Every route is probed against two dataset sizes, a route whose statement count changes with the data fails
+
+EXEMPT_ROUTES = {
+    # Static files and the OpenAPI pages never touch the database
+    ("GET", "/docs"), ("GET", "/docs/oauth2-redirect"), ("GET", "/redoc"), ("GET", "/openapi.json"),
+}
+
+# name, method, route, in run order: the reads first, then the writes, the heavy user is deleted last
+PROBES = (
+    ("auth_login", "POST", "/auth/login"),
+    ("auth_token", "POST", "/auth/token"),
+    ("auth_register", "POST", "/auth/register"),
+    ("auth_self", "GET", "/auth/self"),
+    ("preset_pictures", "GET", "/preset_pictures"),
+    ("metrics", "GET", "/metrics"),
+    ("ranking", "GET", "/users/ranking"),
+    ("ranking_around", "GET", "/users/ranking"),
+    ("user_search", "GET", "/users/search"),
+    ("user_rank", "GET", "/users/{user_id}/rank"),
+    ("user_profile", "GET", "/users/{user_id}"),
+    ("user_matches", "GET", "/users/{user_id}/matches"),
+    ("rating_history", "GET", "/users/{user_id}/rating_history"),
+    ("user_partners", "GET", "/users/{user_id}/partners"),
+    ("user_opponents", "GET", "/users/{user_id}/opponents"),
+    ("match_get", "GET", "/matches/{match_id}"),
+    ("match_predict", "POST", "/matches/predict"),
+    ("match_balance", "POST", "/matches/balance"),
+    ("full_match_history", "GET", "/statistics/full_match_history"),
+    ("full_match_history_stream", "GET", "/statistics/full_match_history"),
+    ("recent", "GET", "/statistics/recent"),
+    ("export_matches", "GET", "/statistics/export/{dataset}"),
+    ("export_participants", "GET", "/statistics/export/{dataset}"),
+    ("export_users", "GET", "/statistics/export/{dataset}"),
+    ("match_create", "POST", "/matches/create"),
+    ("match_submission", "GET", "/matches/submissions/{submission_id}"),
+    ("match_import", "POST", "/matches/import"),
+    ("match_update", "PUT", "/matches/{match_id}"),
+    ("match_delete", "DELETE", "/matches/{match_id}"),
+    ("user_edit", "PUT", "/users/{user_id}/edit"),
+    ("user_delete", "DELETE", "/users/{user_id}/delete"),
+    ("auth_logout", "POST", "/auth/logout"),
+)
+
+
+class Probes:
+    # One request per route. The heavy user is the one with the most matches, so per-match work shows up in their routes.
+
+    def __init__(self, client, size: str, heavy_user: tuple[int, str], other_users: list[str], latest_match_id: int, password: str):
+        self.client = client
+        self.size = size
+        self.user_id, self.username = heavy_user
+        self.other_users = other_users
+        self.latest_match_id = latest_match_id
+        self.password = password
+        # After the whole history, so writes take the same path at both sizes instead of re-rating everything after them
+        self.match_date = (date.today() + timedelta(days=1)).isoformat()
+        self.submission_id = None
+        self.created_match_id = None
+        token = client.post("/auth/token", data={"username": self.username, "password": password}).json()["access_token"]
+        self.headers = {"Authorization": f"Bearer {token}"}
+
+    def _players(self) -> dict:
+        return {"winners": [self.user_id, self.other_ids[0]], "losers": self.other_ids[1:3]}
+
+    @property
+    def other_ids(self) -> list[int]:
+        return [user_id for user_id, _ in self.other_users]
+
+    def auth_login(self):
+        return self.client.post("/auth/login", json={"username": self.username, "password": self.password})
+
+    def auth_token(self):
+        return self.client.post("/auth/token", data={"username": self.username, "password": self.password})
+
+    def auth_register(self):
+        return self.client.post("/auth/register", json={"username": f"budget_{self.size}", "password": self.password})
+
+    def auth_self(self):
+        return self.client.get("/auth/self", headers=self.headers)
+
+    def preset_pictures(self):
+        return self.client.get("/preset_pictures")
+
+    def metrics(self):
+        return self.client.get("/metrics")
+
+    def ranking(self):
+        return self.client.get("/users/ranking")
+
+    def ranking_around(self):
+        return self.client.get(f"/users/ranking?around={self.user_id}")
+
+    def user_search(self):
+        return self.client.get(f"/users/search?q={self.username[:4]}")
+
+    def user_rank(self):
+        return self.client.get(f"/users/{self.user_id}/rank")
+
+    def user_profile(self):
+        return self.client.get(f"/users/{self.user_id}")
+
+    def user_matches(self):
+        return self.client.get(f"/users/{self.user_id}/matches")
+
+    def rating_history(self):
+        return self.client.get(f"/users/{self.user_id}/rating_history")
+
+    def user_partners(self):
+        return self.client.get(f"/users/{self.user_id}/partners")
+
+    def user_opponents(self):
+        return self.client.get(f"/users/{self.user_id}/opponents?order=win_percentage&min_games=2")
+
+    def match_get(self):
+        return self.client.get(f"/matches/{self.latest_match_id}")
+
+    def match_predict(self):
+        return self.client.post("/matches/predict", json={"team_a": [self.user_id, self.other_ids[0]], "team_b": self.other_ids[1:3]})
+
+    def match_balance(self):
+        # The heavy user's partners over the whole history are looked up as well
+        return self.client.post("/matches/balance", json={
+            "player_ids": [self.user_id] + self.other_ids, "avoid_partners_days": 100000
+        })
+
+    def full_match_history(self):
+        # Unpaged, so a per-match query shows up as a difference between the sizes
+        return self.client.get("/statistics/full_match_history")
+
+    def full_match_history_stream(self):
+        return self.client.get("/statistics/full_match_history?stream=true")
+
+    def recent(self):
+        return self.client.get("/statistics/recent")
+
+    def export_matches(self):
+        return self.client.get("/statistics/export/matches?format=ndjson")
+
+    def export_participants(self):
+        return self.client.get("/statistics/export/participants?format=ndjson")
+
+    def export_users(self):
+        return self.client.get("/statistics/export/users?format=ndjson")
+
+    def match_create(self):
+        from app.rating.writer import rating_writer
+        response = self.client.post("/matches/create", headers=self.headers, json={
+            "winner_score": 21, "loser_score": 15, "date_played": self.match_date, **self._players()
+        })
+        if response.status_code < 400:
+            self.submission_id = response.json()["id"]
+            # The rating writer's statements belong to this probe as well
+            rating_writer.wait_until_idle(60)
+        return response
+
+    def match_submission(self):
+        response = self.client.get(f"/matches/submissions/{self.submission_id}")
+        if response.status_code < 400:
+            self.created_match_id = response.json()["match_id"]
+        return response
+
+    def match_import(self):
+        winner, *others = [self.username] + [username for _, username in self.other_users[:3]]
+        body = "date_played,winner_score,loser_score,winners,losers\n" + "".join(
+            f'{self.match_date},21,{loser_score},"{winner},{others[0]}","{others[1]},{others[2]}"\n' for loser_score in (12, 17)
+        )
+        return self.client.post("/matches/import?format=csv", headers=self.headers, content=body)
+
+    def match_update(self):
+        return self.client.put(f"/matches/{self.created_match_id}", headers=self.headers, json={
+            "winner_score": 21, "loser_score": 18, "date_played": self.match_date, **self._players()
+        })
+
+    def match_delete(self):
+        return self.client.delete(f"/matches/{self.created_match_id}", headers=self.headers)
+
+    def user_edit(self):
+        return self.client.put(f"/users/{self.user_id}/edit", headers=self.headers, json={"username": self.username, "bio": f"Probed at {self.size}"})
+
+    def user_delete(self):
+        return self.client.delete(f"/users/{self.user_id}/delete", headers=self.headers)
+
+    def auth_logout(self):
+        return self.client.post("/auth/logout", headers=self.headers)
+
+
+def uncovered_routes(app) -> list[tuple[str, str]]:
+    # A new route without a probe fails the guard as well, so nothing slips past it
+    from fastapi.routing import APIRoute
+    probed = {(method, path) for _, method, path in PROBES}
+    routes = {
+        (method, route.path) for route in app.routes if isinstance(route, APIRoute) for method in route.methods
+    }
+    return sorted(routes - probed - EXEMPT_ROUTES)
+
+def summarize(statements: list[str]) -> list[str]:
+    # Repeated statements are shown once with their count, which is what a per-row query looks like
+    counts = Counter(" ".join(statement.split()) for statement in statements)
+    return [f"{count:5d} x {statement}" for statement, count in counts.most_common()]
+
+
+def record_statements(recorder: dict):
+    # Only statements issued while serving a request count, not the background syncs running next to it.
+    # Probes run one at a time, so whatever the rating writer does meanwhile is on behalf of the current one.
+    from sqlalchemy import event
+    from app.database.database import async_engine, engine
+    from app.monitoring.metrics import current_request
+    from app.rating.writer import WRITER_THREAD_NAME
+
+    def record_statement(conn, cursor, statement, parameters, context, executemany):
+        in_request = current_request.get() is not None or threading.current_thread().name == WRITER_THREAD_NAME
+        if recorder["statements"] is not None and in_request:
+            recorder["statements"].append(statement)
+    event.listen(engine, "before_cursor_execute", record_statement)
+    if async_engine is not None:
+        event.listen(async_engine.sync_engine, "before_cursor_execute", record_statement)
+
+
+def measure(app, size: str, users: int, matches_per_user: int, seed: int, recorder: dict) -> dict:
+    from fastapi.testclient import TestClient
+    from sqlalchemy import func, select
+    from app.cache.responses import response_cache
+    from app.database.database import SessionLocal
+    from app.models.models import MatchParticipant, User
+    from app.rating.writer import rating_writer
+    from benchmarks.generate import BENCHMARK_PASSWORD, generate_dataset
+
+    # Every match has four players, so this gives each user about matches_per_user matches
+    matches = users * matches_per_user // 4
+    print(f"Generating {size}: {users} users, {matches} matches", file=sys.stderr)
+    db = SessionLocal()
+    try:
+        generate_dataset(db, users, matches, days=max(matches // 10, 30), seed=seed)
+        heavy_user_id, heavy_user_matches = db.execute(
+            select(MatchParticipant.user_id, func.count()).group_by(MatchParticipant.user_id).order_by(func.count().desc()).limit(1)
+        ).one()
+        heavy_user = db.execute(select(User.id, User.username).where(User.id == heavy_user_id)).one()
+        other_users = db.execute(select(User.id, User.username).where(User.id != heavy_user_id).order_by(User.id).limit(7)).all()
+        latest_match_id = db.execute(
+            select(MatchParticipant.match_id).where(MatchParticipant.user_id == heavy_user_id).order_by(MatchParticipant.match_id.desc()).limit(1)
+        ).scalar_one()
+    finally:
+        db.close()
+    print(f"Heavy user {heavy_user.username} has {heavy_user_matches} matches", file=sys.stderr)
+
+    results = {}
+    # A fresh app lifespan per size, so the in-memory leaderboard and indexes load the new data
+    with TestClient(app) as client:
+        # The rating writer's first look at the outbox happens at startup, before anything is measured
+        rating_writer.wait_until_idle(60)
+        probes = Probes(client, size, tuple(heavy_user), [tuple(user) for user in other_users], latest_match_id, BENCHMARK_PASSWORD)
+        for name, _, _ in PROBES:
+            # Cached bodies would hide the queries behind them
+            response_cache.clear()
+            recorder["statements"] = []
+            response = getattr(probes, name)()
+            results[name] = {"status": response.status_code, "statements": recorder["statements"]}
+            recorder["statements"] = None
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fail when a route's SQL statement count grows with the amount of data")
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--small", type=int, default=10, help="matches per user in the small dataset")
+    parser.add_argument("--large", type=int, default=1000, help="matches per user in the large dataset")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--probe", action="append", choices=[name for name, _, _ in PROBES], help="only compare these probes, can be repeated")
+    args = parser.parse_args()
+
+    # The guard wipes the database, so it gets a throwaway one unless told otherwise
+    from benchmarks.run import DEFAULT_DATABASE
+    os.environ.setdefault("DATABASE_URL", f"sqlite:///{DEFAULT_DATABASE}")
+    os.environ.setdefault("SECRET_KEY", "benchmark")
+    # The rating writer only runs when a probe wakes it, its polling would land in whichever probe runs at the time
+    os.environ["RATING_POLL_SECONDS"] = "3600"
+    from app.main import app
+
+    recorder = {"statements": None}
+    record_statements(recorder)
+
+    failures = 0
+    for method, path in uncovered_routes(app):
+        print(f"FAIL {method} {path}: no probe in benchmarks/query_budget.py")
+        failures += 1
+
+    small = measure(app, "small", args.users, args.small, args.seed, recorder)
+    large = measure(app, "large", args.users, args.large, args.seed, recorder)
+
+    for name, method, path in PROBES:
+        if args.probe and name not in args.probe:
+            continue
+        before, after = small[name], large[name]
+        line = f"{name:28s} {method:6s} {path:36s} {len(before['statements']):5d} -> {len(after['statements']):5d}"
+        if before["status"] >= 400 or after["status"] >= 400:
+            print(f"FAIL {line}  status {before['status']} / {after['status']}")
+            failures += 1
+        elif len(after["statements"]) != len(before["statements"]):
+            print(f"FAIL {line}")
+            print("\n".join("       " + statement for statement in summarize(after["statements"])))
+            failures += 1
+        else:
+            print(f"ok   {line}")
+
+    print(f"{failures} failure(s)" if failures else "All routes within their query budget")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
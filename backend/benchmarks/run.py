@@ -0,0 +1,206 @@
+import argparse
+import json
+import os
+import random
+import sys
+import time
+from datetime import date, timedelta
+
+DEFAULT_DATABASE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmark.db")
+
+
+def percentile(sorted_values: list[float], fraction: float) -> float:
+    # Nearest-rank percentile
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, max(0, round(fraction * len(sorted_values)) - 1))]
+
+
+class Scenarios:
+    # One request per call, parameters are drawn from the dataset so caches see a realistic spread of keys
+
+    def __init__(self, client, rng: random.Random, user_ids: list[int], usernames: list[str], password: str):
+        self.client = client
+        self.rng = rng
+        self.user_ids = user_ids
+        self.usernames = usernames
+        self.password = password
+        self.match_date = date.today() + timedelta(days=1)
+        username = usernames[0]
+        token = client.post("/auth/token", data={"username": username, "password": password}).json()["access_token"]
+        self.headers = {"Authorization": f"Bearer {token}"}
+
+    def _user_id(self) -> int:
+        return self.rng.choice(self.user_ids)
+
+    def auth_login(self):
+        username = self.rng.choice(self.usernames)
+        return self.client.post("/auth/token", data={"username": username, "password": self.password})
+
+    def auth_self(self):
+        return self.client.get("/auth/self", headers=self.headers)
+
+    def match_create(self):
+        # Dated after the whole history, the common case of a result entered after play
+        players = self.rng.sample(self.user_ids, 4)
+        return self.client.post("/matches/create", headers=self.headers, json={
+            "winner_score": 21, "loser_score": self.rng.randint(3, 19),
+            "winners": players[:2], "losers": players[2:], "date_played": self.match_date.isoformat()
+        })
+
+    def match_predict(self):
+        players = self.rng.sample(self.user_ids, 4)
+        return self.client.post("/matches/predict", json={"team_a": players[:2], "team_b": players[2:]})
+
+    def match_balance(self):
+        # A busy club night, avoiding partners from the last week
+        players = self.rng.sample(self.user_ids, min(len(self.user_ids), 48))
+        return self.client.post("/matches/balance", json={"player_ids": players, "avoid_partners_days": 7})
+
+    def ranking(self):
+        offset = self.rng.randrange(max(len(self.user_ids) - 50, 1))
+        return self.client.get(f"/users/ranking?offset={offset}&limit=50")
+
+    def ranking_around(self):
+        return self.client.get(f"/users/ranking?around={self._user_id()}&radius=5")
+
+    def user_profile(self):
+        return self.client.get(f"/users/{self._user_id()}")
+
+    def user_matches(self):
+        return self.client.get(f"/users/{self._user_id()}/matches")
+
+    def rating_history(self):
+        return self.client.get(f"/users/{self._user_id()}/rating_history?max_points=200")
+
+    def user_partners(self):
+        return self.client.get(f"/users/{self._user_id()}/partners")
+
+    def user_search(self):
+        return self.client.get(f"/users/search?q={self.rng.choice(self.usernames)[:4]}")
+
+    def full_match_history(self):
+        return self.client.get("/statistics/full_match_history?limit=50")
+
+    def recent(self):
+        return self.client.get("/statistics/recent")
+
+
+SCENARIOS = (
+    "auth_login", "auth_self", "match_create", "match_predict", "match_balance", "ranking", "ranking_around",
+    "user_profile", "user_matches", "rating_history", "user_partners", "user_search", "full_match_history", "recent",
+)
+
+
+def run_scenario(call, requests: int, warmup: int, statement_counter: list, max_seconds: float) -> dict:
+    for _ in range(warmup):
+        call()
+
+    latencies, statements, errors = [], [], 0
+    started = time.perf_counter()
+    for _ in range(requests):
+        # A pathological endpoint reports what it managed instead of stalling the whole run
+        if time.perf_counter() - started > max_seconds:
+            break
+        statement_counter[0] = 0
+        request_started = time.perf_counter()
+        response = call()
+        latencies.append(time.perf_counter() - request_started)
+        statements.append(statement_counter[0])
+        if response.status_code >= 400:
+            errors += 1
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    result = {
+        "requests": len(latencies),
+        "truncated": len(latencies) < requests,
+        "errors": errors,
+        "throughput_rps": round(len(latencies) / elapsed, 1) if elapsed else None,
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 3),
+        "p95_ms": round(percentile(latencies, 0.95) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 3),
+        "mean_ms": round(sum(latencies) / len(latencies) * 1000, 3) if latencies else 0.0,
+    }
+    # Statements are only visible when the app runs in this process
+    if statement_counter[1]:
+        result["queries_per_request"] = round(sum(statements) / len(statements), 2) if statements else 0.0
+        result["max_queries"] = max(statements, default=0)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark every router against a synthetic dataset, results are printed as JSON")
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--matches", type=int, default=20000)
+    parser.add_argument("--days", type=int, default=730)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--reuse", action="store_true", help="keep the data already in the database instead of generating it")
+    parser.add_argument("--requests", type=int, default=200, help="measured requests per scenario")
+    parser.add_argument("--warmup", type=int, default=20, help="unmeasured requests per scenario")
+    parser.add_argument("--max-seconds", type=float, default=60, help="stop measuring a scenario after this long")
+    parser.add_argument("--scenario", action="append", choices=SCENARIOS, help="only run these scenarios, can be repeated")
+    parser.add_argument("--url", help="benchmark a running server instead of the app in this process")
+    parser.add_argument("--output", help="write the JSON report to this file instead of stdout")
+    args = parser.parse_args()
+
+    # The app reads its configuration on import, so the defaults have to be in place first
+    os.environ.setdefault("DATABASE_URL", f"sqlite:///{DEFAULT_DATABASE}")
+    os.environ.setdefault("SECRET_KEY", "benchmark")
+    from sqlalchemy import event, select
+    from app.database.database import Base, SessionLocal, engine
+    from app.models.models import User
+    from benchmarks.generate import BENCHMARK_PASSWORD, generate_dataset
+
+    Base.metadata.create_all(bind=engine)
+    db = SessionLocal()
+    try:
+        dataset = {"reused": True}
+        if not args.reuse:
+            print(f"Generating {args.users} users and {args.matches} matches", file=sys.stderr)
+            dataset = generate_dataset(db, args.users, args.matches, args.days, args.seed)
+        users = db.execute(select(User.id, User.username).order_by(User.id)).all()
+    finally:
+        db.close()
+
+    statement_counter = [0, args.url is None]
+    if args.url is None:
+        from fastapi.testclient import TestClient
+        from app.main import app
+
+        def count_statement(*_):
+            statement_counter[0] += 1
+        event.listen(engine, "before_cursor_execute", count_statement)
+        client_context = TestClient(app)
+    else:
+        import httpx
+        client_context = httpx.Client(base_url=args.url, timeout=60)
+
+    report = {
+        "config": {
+            "database": engine.dialect.name,
+            "target": args.url or "in-process",
+            "requests": args.requests,
+            "warmup": args.warmup,
+            "max_seconds": args.max_seconds,
+            "python": sys.version.split()[0],
+        },
+        "dataset": dataset | {"users_in_database": len(users)},
+        "scenarios": {},
+    }
+    with client_context as client:
+        scenarios = Scenarios(client, random.Random(args.seed), [user.id for user in users], [user.username for user in users], BENCHMARK_PASSWORD)
+        for name in args.scenario or SCENARIOS:
+            print(f"Running {name}", file=sys.stderr)
+            report["scenarios"][name] = run_scenario(getattr(scenarios, name), args.requests, args.warmup, statement_counter, args.max_seconds)
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
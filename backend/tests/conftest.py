@@ -0,0 +1,30 @@
+import os
+import tempfile
+
+# Settings are read when the app modules are imported, so the database is set up before any of them. The tests wipe
+# every table, an exported DATABASE_URL (as in the backend container) is never used. TEST_DATABASE_URL opts into
+# running them against a throwaway PostgreSQL database instead.
+os.environ["DATABASE_URL"] = os.getenv("TEST_DATABASE_URL") or "sqlite:///" + os.path.join(tempfile.mkdtemp(prefix="badminton-tests-"), "test.db")
+os.environ.setdefault("SECRET_KEY", "test")
+# The rating writer only runs when a submission wakes it, so its polling doesn't land in a measured request
+os.environ.setdefault("RATING_POLL_SECONDS", "3600")
+
+import pytest
+from sqlalchemy import event
+import app.models.models
+from app.database.database import Base, engine
+
+Base.metadata.create_all(bind=engine)
+
+
+@pytest.fixture
+def statements():
+    # Every SQL statement sent through the app's engine while the test runs
+    recorded = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        recorded.append(statement)
+
+    event.listen(engine, "before_cursor_execute", record)
+    yield recorded
+    event.remove(engine, "before_cursor_execute", record)
@@ -0,0 +1,62 @@
+from sqlalchemy import select, update
+from app.cache.responses import response_cache
+from app.cache.version import data_version
+from app.database.database import SessionLocal
+from app.models.models import DataVersion, User
+from app.rating.leaderboard import leaderboard
+from benchmarks.generate import generate_dataset
+
+
+def _cache_entry():
+    response_cache.clear()
+    response_cache.get_or_render("test", "/test?", ["test"], lambda: b"body")
+    return len(response_cache.backend)
+
+
+def test_only_other_processes_writes_clear_the_memory_cache():
+    data_version._sync_now()
+    db = SessionLocal()
+    try:
+        # A write committed in this process keeps what its own tags didn't drop
+        assert _cache_entry() == 1
+        data_version.bump(db)
+        db.commit()
+        data_version._sync_now()
+        assert len(response_cache.backend) == 1
+
+        # Another process bumps the row without this process publishing it
+        db.execute(update(DataVersion).where(DataVersion.id == 1).values(version=DataVersion.version + 1))
+        db.commit()
+        data_version._sync_now()
+        assert len(response_cache.backend) == 0
+
+        # A local write that skips over another process's version counts as well
+        assert _cache_entry() == 1
+        db.execute(update(DataVersion).where(DataVersion.id == 1).values(version=DataVersion.version + 1))
+        db.commit()
+        data_version.bump(db)
+        db.commit()
+        data_version._sync_now()
+        assert len(response_cache.backend) == 0
+    finally:
+        db.close()
+
+
+def test_leaderboard_follows_ratings_written_by_other_processes():
+    db = SessionLocal()
+    try:
+        generate_dataset(db, users=10, matches=30, days=30, seed=0)
+        leaderboard.load(db)
+        data_version._sync_now()
+        last = leaderboard.page()[-1]["id"]
+
+        # Another process's rating writer moves the last player to the top
+        db.execute(update(User).where(User.id == last).values(rating=5000))
+        db.execute(update(DataVersion).where(DataVersion.id == 1).values(version=DataVersion.version + 1))
+        db.commit()
+        assert leaderboard.page()[0]["id"] != last
+        data_version._sync_now()
+        assert leaderboard.page()[0]["id"] == last
+        assert len(leaderboard) == len(db.execute(select(User.id)).all())
+    finally:
+        db.close()
@@ -0,0 +1,37 @@
+from datetime import date, timedelta
+from sqlalchemy import func, select
+from app.crud.match import crud_create_match
+from app.database.database import SessionLocal
+from app.models.models import MatchParticipant
+from app.schemas.schemas import MatchCreate
+from benchmarks.generate import generate_dataset
+
+# Statements for one match played after the whole history: players, the back-dated check, the match and its
+# participants, snapshots, ratings, statistics, pair counters and the data version
+MATCH_CREATE_BUDGET = 9
+
+
+def _create_match_statements(statements: list[str], matches: int) -> list[str]:
+    db = SessionLocal()
+    try:
+        generate_dataset(db, users=20, matches=matches, days=60, seed=0)
+        # The four most active players, so their history is what grows between the sizes
+        players = db.execute(
+            select(MatchParticipant.user_id).group_by(MatchParticipant.user_id).order_by(func.count().desc()).limit(4)
+        ).scalars().all()
+        match = MatchCreate(
+            winner_score=21, loser_score=15, winners=players[:2], losers=players[2:], date_played=date.today() + timedelta(days=1)
+        )
+        statements.clear()
+        crud_create_match(db, match, players[0])
+        return list(statements)
+    finally:
+        db.close()
+
+
+def test_match_create_statement_count_is_constant(statements):
+    small = _create_match_statements(statements, 50)
+    large = _create_match_statements(statements, 2000)
+
+    assert len(small) == len(large), "\n".join(["small:"] + small + ["large:"] + large)
+    assert len(large) <= MATCH_CREATE_BUDGET, "\n".join(large)
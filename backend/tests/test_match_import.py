@@ -0,0 +1,49 @@
+from datetime import date, timedelta
+import pytest
+from sqlalchemy import func, select
+from app.database.database import SessionLocal
+from app.models.models import Match, RatingSnapshot, StagedMatch, User
+from app.rating.replay import crud_replay_ratings
+from app.transfer.match_import import ImportRecord, crud_import_matches
+from benchmarks.generate import generate_dataset
+
+
+class Interrupted(Exception):
+    pass
+
+
+def _records(usernames: list[str], count: int) -> list[ImportRecord]:
+    # Spread over the generated history, so existing matches are re-rated after the imported ones
+    first = date.today() - timedelta(days=50)
+    return [
+        ImportRecord(line, first + timedelta(days=line), 21, 10 + line % 9, usernames[line % 4:line % 4 + 2], usernames[line % 4 + 2:line % 4 + 4])
+        for line in range(1, count + 1)
+    ]
+
+
+def test_interrupted_import_stays_out_of_the_history_until_resumed():
+    db = SessionLocal()
+    try:
+        generate_dataset(db, users=10, matches=100, days=60, seed=0)
+        usernames = db.execute(select(User.username).order_by(User.id).limit(7)).scalars().all()
+        creator_id = db.execute(select(User.id).order_by(User.id).limit(1)).scalar()
+        records = _records(usernames, 25)
+
+        def stop_after_first_chunk(done: int, total: int):
+            raise Interrupted()
+
+        with pytest.raises(Interrupted):
+            crud_import_matches(db, records, creator_id, import_id="resumed", chunk_size=10, progress=stop_after_first_chunk)
+        # The first chunk is committed but only staged, the history and every rating are untouched
+        assert db.execute(select(func.count()).select_from(StagedMatch)).scalar() == 10
+        assert db.execute(select(func.count()).select_from(Match)).scalar() == 100
+        assert crud_replay_ratings(db, dry_run=True) == []
+
+        result = crud_import_matches(db, records, creator_id, import_id="resumed", chunk_size=10)
+        assert result["imported"] == 25
+        assert db.execute(select(func.count()).select_from(StagedMatch)).scalar() == 0
+        assert db.execute(select(func.count()).select_from(Match)).scalar() == 125
+        assert db.execute(select(func.count()).select_from(RatingSnapshot)).scalar() == 125 * 4
+        assert crud_replay_ratings(db, dry_run=True) == []
+    finally:
+        db.close()
@@ -0,0 +1,31 @@
+import pytest
+from app.main import app
+from benchmarks.query_budget import PROBES, measure, record_statements, summarize, uncovered_routes
+
+# The same guard as benchmarks/query_budget.py, at sizes small enough to run with the rest of the tests
+USERS = 20
+SMALL_MATCHES_PER_USER = 10
+LARGE_MATCHES_PER_USER = 200
+
+
+@pytest.fixture(scope="module")
+def budgets():
+    recorder = {"statements": None}
+    record_statements(recorder)
+    small = measure(app, "small", USERS, SMALL_MATCHES_PER_USER, 0, recorder)
+    large = measure(app, "large", USERS, LARGE_MATCHES_PER_USER, 0, recorder)
+    return small, large
+
+
+def test_every_route_has_a_probe():
+    assert uncovered_routes(app) == []
+
+
+@pytest.mark.parametrize("name", [name for name, _, _ in PROBES])
+def test_statement_count_does_not_grow_with_data(budgets, name):
+    small, large = budgets
+    before, after = small[name], large[name]
+    assert before["status"] < 400 and after["status"] < 400
+    assert len(after["statements"]) == len(before["statements"]), "\n".join(
+        ["small:"] + summarize(before["statements"]) + ["large:"] + summarize(after["statements"])
+    )
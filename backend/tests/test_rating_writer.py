@@ -0,0 +1,58 @@
+from datetime import date, timedelta
+import pytest
+from sqlalchemy import delete, func, insert, select, update
+from app.crud.match import SubmissionHandled, crud_create_match, utc_now
+from app.database.database import SessionLocal
+from app.models.models import DONE, FAILED, PENDING, Match, MatchOutbox, User
+from app.rating.writer import RatingWriter
+from app.schemas.schemas import MatchCreate
+from benchmarks.generate import generate_dataset
+
+
+def test_retry_later_leaves_handled_submissions_alone():
+    writer = RatingWriter(batch_size=8, poll_seconds=3600, max_attempts=2, retry_seconds=1, retention_hours=1)
+    db = SessionLocal()
+    try:
+        db.execute(delete(MatchOutbox))
+        now = utc_now()
+        ids = db.execute(insert(MatchOutbox).returning(MatchOutbox.id, sort_by_parameter_order=True), [
+            {"creator_id": 1, "payload": {}, "status": status, "attempts": attempts, "created_at": now, "next_attempt_at": now}
+            for status, attempts in ((PENDING, 0), (PENDING, 1), (DONE, 0))
+        ]).scalars().all()
+        db.commit()
+
+        writer._retry_later(db, ids, RuntimeError("boom"))
+        rows = {row.id: row for row in db.execute(select(MatchOutbox)).scalars()}
+        assert (rows[ids[0]].status, rows[ids[0]].attempts, rows[ids[0]].error) == (PENDING, 1, "boom")
+        assert rows[ids[0]].next_attempt_at > now
+        assert (rows[ids[1]].status, rows[ids[1]].attempts) == (FAILED, 2)
+        # Applied by another writer in the meantime, it stays done
+        assert (rows[ids[2]].status, rows[ids[2]].attempts, rows[ids[2]].error) == (DONE, 0, None)
+        assert (writer.retried, writer.failed) == (1, 1)
+    finally:
+        db.close()
+
+
+def test_submission_applied_by_another_writer_is_rolled_back():
+    db, other = SessionLocal(), SessionLocal()
+    try:
+        generate_dataset(db, users=8, matches=20, days=30, seed=0)
+        players = db.execute(select(User.id).order_by(User.id).limit(4)).scalars().all()
+        match = MatchCreate(winner_score=21, loser_score=15, winners=players[:2], losers=players[2:], date_played=date.today() + timedelta(days=1))
+        now = utc_now()
+        submission = MatchOutbox(
+            creator_id=players[0], payload=match.model_dump(mode="json"), status=PENDING, attempts=0, created_at=now, next_attempt_at=now
+        )
+        db.add(submission)
+        db.commit()
+
+        # Both writers read it as pending, the other one commits first
+        other.execute(update(MatchOutbox).where(MatchOutbox.id == submission.id).values(status=DONE))
+        other.commit()
+        with pytest.raises(SubmissionHandled):
+            crud_create_match(db, match, players[0], submission)
+        db.rollback()
+        assert db.execute(select(func.count()).select_from(Match)).scalar() == 20
+    finally:
+        other.close()
+        db.close()
@@ -0,0 +1,43 @@
+from datetime import date, timedelta
+import pytest
+from sqlalchemy import select
+from app.crud.match import crud_create_match, crud_delete_match, crud_update_match
+from app.database.database import SessionLocal
+from app.models.models import User
+from app.rating.engines import get_rating_engine
+from app.rating.replay import crud_replay_ratings
+from app.schemas.schemas import MatchCreate, MatchUpdate
+from benchmarks.generate import generate_dataset
+
+
+@pytest.fixture(params=["elo", "glicko2", "gaussian"])
+def engine(request, monkeypatch):
+    # Every module that rates matches imports the engine by name
+    rating_engine = get_rating_engine(request.param)
+    for module in ("app.rating.replay", "app.rating.incremental", "app.rating.balance", "app.crud.statistic"):
+        monkeypatch.setattr(f"{module}.rating_engine", rating_engine)
+    return rating_engine
+
+
+def test_rerating_matches_a_full_replay(engine):
+    db = SessionLocal()
+    try:
+        generate_dataset(db, users=10, matches=100, days=60, seed=0)
+        assert crud_replay_ratings(db, dry_run=True) == []
+        user_ids = db.execute(select(User.id).order_by(User.id)).scalars().all()
+        creator_id = user_ids[0]
+
+        back_dated = date.today() - timedelta(days=40)
+        db_match = crud_create_match(db, MatchCreate(winners=user_ids[:2], losers=user_ids[2:4], winner_score=21, loser_score=15, date_played=back_dated), creator_id)
+        match_id = db_match.id
+        assert crud_replay_ratings(db, dry_run=True) == []
+
+        # Moved earlier with other players, both the old and the new players are re-rated
+        update = MatchUpdate(winners=user_ids[4:6], losers=[user_ids[1], user_ids[6]], winner_score=21, loser_score=19, date_played=back_dated - timedelta(days=10))
+        crud_update_match(db, match_id, update, creator_id)
+        assert crud_replay_ratings(db, dry_run=True) == []
+
+        crud_delete_match(db, match_id, creator_id)
+        assert crud_replay_ratings(db, dry_run=True) == []
+    finally:
+        db.close()
@@ -0,0 +1,31 @@
+import pytest
+from sqlalchemy import select
+from app.crud.statistic import crud_rebuild_user_statistics
+from app.database.database import SessionLocal
+from app.models.models import Match, User, UserStatistic
+from app.rating.incremental import at_or_after
+from benchmarks.generate import generate_dataset
+
+
+def _statistics(db) -> dict:
+    columns = UserStatistic.__table__.columns.keys()
+    return {stats.user_id: {column: getattr(stats, column) for column in columns} for stats in db.execute(select(UserStatistic)).scalars()}
+
+
+@pytest.mark.parametrize("fraction", [0.0, 0.3, 0.9, 1.0])
+def test_rebuild_from_a_cut_matches_a_full_rebuild(fraction):
+    db = SessionLocal()
+    try:
+        generate_dataset(db, users=12, matches=400, days=90, seed=1)
+        crud_rebuild_user_statistics(db)
+        db.commit()
+        expected = _statistics(db)
+
+        matches = db.execute(select(Match.date_played, Match.id).order_by(Match.date_played, Match.id)).all()
+        start_date, start_id = matches[min(int(len(matches) * fraction), len(matches) - 1)]
+        crud_rebuild_user_statistics(db, db.execute(select(User.id)).scalars().all(), at_or_after(start_date, start_id))
+        db.commit()
+        db.expire_all()
+        assert _statistics(db) == expected
+    finally:
+        db.close()
@@ -28,6 +28,16 @@ const CreateMatch = () => {
         fetchUsernames();
     }, []);
 
+    // The match is rated in the background, its submission says when it exists or why it failed
+    const waitForMatch = async (submission) => {
+        for (let attempt = 0; attempt < 20 && submission.status === 'pending'; attempt++) {
+            await new Promise((resolve) => setTimeout(resolve, 250));
+            const response = await axiosInstance.get(`/matches/submissions/${submission.id}`);
+            submission = response.data;
+        }
+        return submission;
+    };
+
     const handleSubmit = async (e) => {
         e.preventDefault();
     
@@ -60,14 +70,16 @@ const CreateMatch = () => {
                 },
             });
     
-            if (response.status === 200) {
+            if (response.status === 202) {
                 console.log('Response data:', response.data);
-                const { id: matchId } = response.data;
+                const submission = await waitForMatch(response.data);
                 
-                if (matchId) {
-                    navigate(`/matches/${matchId}`);
+                if (submission.match_id) {
+                    navigate(`/matches/${submission.match_id}`);
+                } else if (submission.status === 'failed') {
+                    setError(`Match was not saved: ${submission.error || 'unknown error'}`);
                 } else {
-                    setError('Match ID not received. Unable to navigate.');
+                    setError('Match was saved but is not rated yet. Check the match history shortly.');
                 }
             } else {
                 setError('Failed to create match. Please try again.');